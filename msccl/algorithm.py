@@ -33,15 +33,10 @@ class Algorithm(object):
         input_map = {}
         output_map = {}
         for rank in chunked.ranks():
-            input_addrs = set()
-            output_addrs = set()
-            for chunk in chunked.chunks():
-                # An address is an input address if any of its chunks is in the precondition
-                if chunked.precondition(rank, chunk):
-                    input_addrs.add(chunked.address(chunk))
-                # An address is an output address if any of its chunks is in the postcondition
-                if chunked.postcondition(rank, chunk):
-                    output_addrs.add(chunked.address(chunk))
+            # An address is an input address if any of its chunks is in the precondition
+            input_addrs = set(chunked.address(chunk) for chunk in chunked.precondition_chunks(rank))
+            # An address is an output address if any of its chunks is in the postcondition
+            output_addrs = set(chunked.address(chunk) for chunk in chunked.postcondition_chunks(rank))
             if len(input_addrs) > 0:
                 input_map[rank] = input_addrs
             if len(output_addrs) > 0:
@@ -80,47 +75,63 @@ class Algorithm(object):
         chunks_at_address = defaultdict(list)
         for chunk in collective.chunks():
             chunks_at_address[collective.address(chunk)].append(chunk)
-        # State records if a rank holds a chunk
-        def idx(rank, chunk):
-            return rank * collective.num_chunks + chunk
-        state = [False] * (collective.num_nodes * collective.num_chunks)
-        # Initialize state from precondition
-        for rank in collective.ranks():
-            for chunk in collective.chunks():
-                state[idx(rank, chunk)] = collective.precondition(rank, chunk)
+        # State records the ranks holding each chunk as a bitmask, initialized from the precondition
+        state = [collective.precondition_mask(chunk) for chunk in collective.chunks()]
         # Propagate state through sends of every step
         for step in self.steps:
-            next_state = state.copy()
+            received = defaultdict(int)
             for addr, src, dst in step.sends:
                 for chunk in chunks_at_address[addr]:
-                    next_state[idx(dst, chunk)] |= state[idx(src, chunk)]
-            state = next_state
-        # Check that the postcondition holds
-        for rank in collective.ranks():
-            for chunk in collective.chunks():
-                if collective.postcondition(rank, chunk) and not state[idx(rank, chunk)]:
-                    raise RuntimeError(f'rank {rank} does not get chunk {chunk} as required by the postcondition')
+                    if (state[chunk] >> src) & 1:
+                        received[chunk] |= 1 << dst
+            for chunk, ranks in received.items():
+                state[chunk] |= ranks
+        # Check that the postcondition holds, reporting the missing chunk of the lowest rank first
+        missing = None
+        for chunk in collective.chunks():
+            ranks = collective.postcondition_mask(chunk) & ~state[chunk]
+            if ranks:
+                rank = (ranks & -ranks).bit_length() - 1
+                if missing == None or rank < missing[0]:
+                    missing = (rank, chunk)
+        if missing != None:
+            rank, chunk = missing
+            raise RuntimeError(f'rank {rank} does not get chunk {chunk} as required by the postcondition')
 
     def _update_link_utilizations(self):
+        # Sparse utilizations per step, mapping (src, dst) pairs to the number of sends
         self._link_utilizations = []
-        ranks = range(self.topology.num_nodes())
         for step in self.steps:
-            step_utilizations = [[0 for _ in ranks] for _ in ranks]
+            step_utilizations = defaultdict(int)
             for addr, src, dst in step.sends:
-                step_utilizations[dst][src] += 1 # Same order as topology
+                step_utilizations[(src, dst)] += 1
             self._link_utilizations.append(step_utilizations)
 
     def _check_bandwidth_constraints(self):
-        for srcs, dsts, bw, name in self.topology.bandwidth_constraints():
+        if self.is_pipelined():
+            # Steps overlap with every pipeline-th later step, so accumulate utilizations from the last step backwards
+            utilizations = [None] * len(self.steps)
+            for step_num in reversed(range(len(self.steps))):
+                accumulated = defaultdict(int, self._link_utilizations[step_num])
+                if step_num + self.instance.pipeline < len(self.steps):
+                    for pair, util in utilizations[step_num + self.instance.pipeline].items():
+                        accumulated[pair] += util
+                utilizations[step_num] = accumulated
+        else:
+            utilizations = self._link_utilizations
+
+        # Only constraints containing a used pair can be violated. Constraints are checked in the order of the
+        # topology, so that the same violation is reported first.
+        constraints = self.topology.bandwidth_constraints()
+        constraint_utilizations = defaultdict(lambda: [0] * len(self.steps))
+        for step_num, step_utilizations in enumerate(utilizations):
+            for (src, dst), util in step_utilizations.items():
+                for idx in self.topology.constraints_of(src, dst):
+                    constraint_utilizations[idx][step_num] += util
+        for idx in sorted(constraint_utilizations):
+            _, _, bw, name = constraints[idx]
             for step_num, step in enumerate(self.steps):
-                util = 0
-                for dst in dsts:
-                    for src in srcs:
-                        if self.is_pipelined():
-                            for overlapping_step in range(step_num, len(self.steps), self.instance.pipeline):
-                                util += self._link_utilizations[overlapping_step][dst][src]
-                        else:
-                            util += self._link_utilizations[step_num][dst][src]
+                util = constraint_utilizations[idx][step_num]
                 assert util <= bw * step.rounds, \
                     f'Step {step_num} uses {util} bandwidth but constraint {name} only allows for {bw * step.rounds} bandwidth (when rounds={step.rounds}).'
 
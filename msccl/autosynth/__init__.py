@@ -1,24 +1,16 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-from msccl.topologies import dgx1, dgx_a100, nvlink_only
-from msccl.isomorphisms import find_isomorphisms
-from msccl.autosynth.registry import synthesis_plans
-from lxml import etree as ET
+from msccl.autosynth.registry import synthesis_plans, load_builtin_plans
 import re
-import subprocess
 import fcntl
 import os
 import math
 import tempfile
-import humanfriendly
-from tabulate import tabulate
 from enum import Enum
 
-from msccl.autosynth.ndv2_plans import register_ndv2_plans
-from msccl.autosynth.ndv4_plans import register_ndv4_plans
-register_ndv2_plans()
-register_ndv4_plans()
+# This module is imported by "import msccl", so the MSCCLang compiler, the synthesizer and other heavy dependencies are
+# only imported by the functions that use them and the built-in plans are registered when they are first needed.
 
 
 class Collective(Enum):
@@ -33,11 +25,22 @@ class Collective(Enum):
         return self.value
 
 
-def init(machine_type, num_machines, *collectives):
+def init(machine_type, num_machines, *collectives, precompiled=None):
+    # Plans compiled ahead of time by "msccl plans compile" into the precompiled directory, or the directory named by
+    # MSCCL_PRECOMPILED_PLANS, are used instead of compiling the registered plans for the configurations they cover
+    if precompiled == None:
+        precompiled = os.environ.get('MSCCL_PRECOMPILED_PLANS')
+    precompiled_plans = {}
+    if precompiled != None:
+        from msccl.autosynth.precompiled import load_precompiled_plans
+        precompiled_plans = load_precompiled_plans(precompiled)
+
     # first detect the machine type in case auto was passed in
     if machine_type == "auto":
+        from msccl.topologies import dgx1, dgx_a100, nvlink_only
+        from msccl.isomorphisms import find_isomorphisms, default_isomorphism_cache
         nvlink_matrix = nvlink_only()
-        isomorphisms = find_isomorphisms(dgx1(), nvlink_matrix)
+        isomorphisms = find_isomorphisms(dgx1(), nvlink_matrix, cache=default_isomorphism_cache())
         if len(isomorphisms) == 4:
             machine_type = "ndv2"
         elif nvlink_matrix.links == dgx_a100().links:
@@ -48,6 +51,8 @@ def init(machine_type, num_machines, *collectives):
         print(f"The auto-detected SKU is a {machine_type}.")
 
     # Collect and sort all plans that match the collectives and sizes given by the user.
+    import humanfriendly
+    plans_by_key = load_builtin_plans(machine_type)
     selected_plans = {}
     for collective in collectives:
         name, sizes = collective
@@ -66,32 +71,25 @@ def init(machine_type, num_machines, *collectives):
             if isinstance(sizes, str):
                 sizes = humanfriendly.parse_size(sizes)
             sizes = (sizes, sizes+1)
-        candidates = synthesis_plans[(name, machine_type)]
+        candidates = plans_by_key[(name, machine_type)]
+        compiled = [c for c in precompiled_plans.get((name, machine_type), []) if c[2](num_machines)]
+        if len(compiled) > 0:
+            candidates = compiled
         plans = _select_plans(name, candidates, num_machines, sizes)
         if len(plans) > 0:
             selected_plans[name] = plans
 
     # Execute the plans to find or synthesize the algorithms and format them in the XML format expected by MSCCL-RT.
-    algos_elem = ET.Element('msccl_algos')
-    any_selected = False
+    loads = []
     for collective_name, plans in selected_plans.items():
         for plan, params in plans:
-            path = plan(num_machines)
-            load_elem = ET.SubElement(algos_elem, 'load')
-            load_elem.set('path', path)
             minsize, maxsize, proto = params
-            if minsize != 0:
-                load_elem.set('minbytes', str(minsize))
-            if maxsize != math.inf:
-                load_elem.set('maxbytes', str(maxsize))
-            load_elem.set('proto', proto)
-            any_selected = True
-    ET.indent(algos_elem, space='  ')
-        
-    if any_selected:
+            loads.append((plan(num_machines), minsize, maxsize, proto))
+
+    if len(loads) > 0:
         fd, path = tempfile.mkstemp()
         with os.fdopen(fd, 'w') as f:
-            f.write(ET.tostring(algos_elem, encoding='unicode'))
+            f.write(algos_config(loads))
 
         # Set environment variables
         env = {
@@ -116,7 +114,26 @@ def init(machine_type, num_machines, *collectives):
         print(f'MSCCL: No algorithms were selected.')
 
 
+def algos_config(loads):
+    '''
+    Returns an MSCCL-RT configuration file loading the algorithms given as (path, minbytes, maxbytes, protocol) tuples.
+    '''
+    from lxml import etree as ET
+    algos_elem = ET.Element('msccl_algos')
+    for path, minsize, maxsize, proto in loads:
+        load_elem = ET.SubElement(algos_elem, 'load')
+        load_elem.set('path', path)
+        if minsize != 0:
+            load_elem.set('minbytes', str(minsize))
+        if maxsize != math.inf:
+            load_elem.set('maxbytes', str(maxsize))
+        load_elem.set('proto', proto)
+    ET.indent(algos_elem, space='  ')
+    return ET.tostring(algos_elem, encoding='unicode')
+
+
 def _format_size(size):
+    import humanfriendly
     if size != math.inf:
         return humanfriendly.format_size(size)
     else:
@@ -187,7 +204,9 @@ def ndv2_perm(): # pragma: no cover
     # which is read by the script after calling this function, so the return
     # value does't currently get used. If you make changes, please fix or update
     # msccl_ndv2_launcher.sh accordingly.
-    isomorphisms = find_isomorphisms(dgx1(), nvlink_only())
+    from msccl.topologies import dgx1, nvlink_only
+    from msccl.isomorphisms import find_isomorphisms, default_isomorphism_cache
+    isomorphisms = find_isomorphisms(dgx1(), nvlink_only(), cache=default_isomorphism_cache())
     if len(isomorphisms) != 4:
         raise RuntimeError(
             f'Expected to find 4 isomorphisms to DGX1 topology, but found {len(isomorphisms)}.')
@@ -195,6 +214,7 @@ def ndv2_perm(): # pragma: no cover
 
 
 def _select_isomorphism(isomorphisms, verbose=True): # pragma: no cover
+    import subprocess
     with open('/var/lock/msccl_autosynth_inspector_topo.lock', "a+") as f:
         fcntl.lockf(f, fcntl.LOCK_EX)
         try:
@@ -265,7 +285,7 @@ def _describe_machines(machines):
 def _list_plan_parameters():
     headers = ['Machine', 'Collective', '# machines', 'From', 'To', 'Protocol', 'Priority', 'Plan name']
     rows = []
-    for key, plans in synthesis_plans.items():
+    for key, plans in load_builtin_plans().items():
         collective, machine_type = key
         for name, function, machines, (low, high), protocol, priority in plans:
             # First tuple is the key to sort by, second is the actual columns
@@ -276,6 +296,7 @@ def _list_plan_parameters():
 
 
 def tabulate_plans():
+    from tabulate import tabulate
     headers, rows = _list_plan_parameters()
     return tabulate(rows, headers=headers, tablefmt='github')
 
@@ -0,0 +1,104 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from msccl.cache_dir import default_cache_directory
+from msccl.version import __version__
+
+from pathlib import Path
+import fcntl
+import hashlib
+import json
+import os
+import tempfile
+
+_package_source_hash_value = None
+
+def _package_source_hash():
+    # Plans call into the compiler, the synthesizer and the programs of the package, so edits to any of its sources
+    # must invalidate the cached files. Computed once per process.
+    global _package_source_hash_value
+    if _package_source_hash_value == None:
+        package = Path(__file__).absolute().parent.parent
+        digest = hashlib.sha256()
+        for path in sorted(package.rglob('*.py')):
+            digest.update(str(path.relative_to(package)).encode('utf-8'))
+            digest.update(path.read_bytes())
+        _package_source_hash_value = digest.hexdigest()
+    return _package_source_hash_value
+
+def plan_fingerprint(fun, parameters, machines):
+    '''
+    Returns a hash of everything that determines the output of a plan: the source of the module defining its function,
+    the sources of the MSCCL package, the parameters it was registered with, the number of machines and the MSCCL
+    version. Returns None for functions whose source is not available, which can not be cached.
+    '''
+    import inspect
+    try:
+        module_source = Path(inspect.getsourcefile(fun)).read_bytes()
+        package_source = _package_source_hash()
+    except (OSError, TypeError):
+        return None
+    plan = {
+        'version': __version__,
+        'name': fun.__qualname__,
+        'module': hashlib.sha256(module_source).hexdigest(),
+        'package': package_source,
+        'parameters': parameters,
+        'machines': machines,
+    }
+    canonical = json.dumps(plan, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class PlanCache(object):
+    '''
+    A persistent content-addressed cache of the files produced by plans, which may be shared by all processes of a job.
+    The first process to need a file writes it while holding a lock on the entry and the others wait for it and reuse
+    the result. With bypass set entries are always rewritten.
+    '''
+    def __init__(self, directory=None, bypass=False):
+        self.directory = Path(directory) if directory != None else default_cache_directory('plans')
+        self.bypass = bypass
+
+    def _entry_path(self, fingerprint):
+        return self.directory / f'{fingerprint}.xml'
+
+    def path(self, fingerprint, write):
+        '''
+        Returns the path of the entry for the fingerprint, calling write with an open file to create it if missing.
+        Returns None without calling write if the cache directory can not be written to.
+        '''
+        path = self._entry_path(fingerprint)
+        if not self.bypass and path.exists():
+            return str(path)
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            lock = open(self.directory / f'{fingerprint}.lock', 'a')
+        except OSError:
+            return None
+        with lock:
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            try:
+                # Another process may have written the entry while this one waited for the lock
+                if self.bypass or not path.exists():
+                    # Write atomically so that readers that do not take the lock never see partial entries
+                    fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                    try:
+                        with os.fdopen(fd, 'w') as f:
+                            write(f)
+                        os.replace(tmp_path, path)
+                    except BaseException:
+                        # Do not leave partial entries behind in the shared directory
+                        try:
+                            os.unlink(tmp_path)
+                        except OSError:
+                            pass
+                        raise
+                # The lock is only needed while the entry is missing. Processes that take a lock on a new lock file
+                # after this one is removed see the entry as soon as they hold it.
+                try:
+                    os.unlink(self.directory / f'{fingerprint}.lock')
+                except OSError:
+                    pass
+            finally:
+                fcntl.lockf(lock, fcntl.LOCK_UN)
+        return str(path)
@@ -0,0 +1,58 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from msccl.version import __version__
+
+from pathlib import Path
+import json
+import math
+
+# Plans compiled ahead of time by "msccl plans compile" are stored in a directory together with a manifest listing, for
+# each collective and number of machines, the files selected for each range of sizes.
+MANIFEST_NAME = 'manifest.json'
+
+def write_manifest(directory, machine_type, entries):
+    '''
+    Writes the manifest of a directory of precompiled plans. Each entry is a dictionary with the collective, machines,
+    plan, file (relative to the directory), minbytes, maxbytes and proto of a selected plan.
+    '''
+    manifest = {
+        'version': __version__,
+        'machine_type': machine_type,
+        # JSON has no infinity, so unbounded size ranges are stored as null
+        'plans': [dict(entry, maxbytes=entry['maxbytes'] if entry['maxbytes'] != math.inf else None) for entry in entries],
+    }
+    with open(Path(directory) / MANIFEST_NAME, 'w') as f:
+        json.dump(manifest, f, indent=2)
+
+def load_precompiled_plans(directory):
+    '''
+    Reads the manifest of a directory of precompiled plans and returns a dictionary from (collective, machine_type) to
+    entries in the format of the synthesis plans of the registry. Plans compiled by a different version of MSCCL are
+    ignored.
+    '''
+    directory = Path(directory).absolute()
+    # A missing or broken directory must not keep processes from starting, the plans are then compiled as usual
+    try:
+        with open(directory / MANIFEST_NAME) as f:
+            manifest = json.load(f)
+        version = manifest['version']
+        if version != __version__:
+            print(f'MSCCL: Ignoring plans in {directory} precompiled by MSCCL {version} (this is {__version__})')
+            return {}
+        machine_type = manifest['machine_type']
+        plans = {}
+        for entry in manifest['plans']:
+            path = str(directory / entry['file'])
+            maxbytes = entry['maxbytes'] if entry['maxbytes'] != None else math.inf
+            plans.setdefault((entry['collective'], machine_type), []).append((
+                f'precompiled {entry["plan"]}',
+                lambda machines, path=path: path,
+                lambda machines, num_machines=entry['machines']: machines == num_machines,
+                (entry['minbytes'], maxbytes),
+                entry['proto'],
+                0))
+        return plans
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        print(f'MSCCL: Ignoring plans in {directory} as its manifest can not be read ({type(e).__name__}: {e})')
+        return {}
@@ -2,23 +2,45 @@
 # Licensed under the MIT License.
 
 from collections import defaultdict
+import importlib
 import math
 import tempfile
 import os
 import atexit
-import humanfriendly
-
-from msccl.language import MSCCLProgram, ir_to_xml
-from msccl.language.ir import ThreadblockPolicy
-import msccl.language.collectives as lang_collectives
-from msccl.topologies import distributed_fully_connected
+import json
 
 # The plans are keyed by (collective, machine_type) and each entry is a tuple
 # (name, function, machines, size_range, protocol, priority).
 synthesis_plans = defaultdict(list)
 
+# Modules registering the built-in plans of each machine type, which are imported when the plans are first needed
+_builtin_plan_modules = {
+    'ndv2': 'msccl.autosynth.ndv2_plans',
+    'ndv4': 'msccl.autosynth.ndv4_plans',
+}
+_loaded_machine_types = set()
+
+
+def load_builtin_plans(machine_type=None):
+    '''
+    Registers the built-in plans for the machine type, or for all machine types if it is None, and returns
+    synthesis_plans. The built-in plans are placed before plans registered by other packages, which thus take
+    precedence among plans of the same priority.
+    '''
+    for mtype, module_name in _builtin_plan_modules.items():
+        if (machine_type == None or machine_type == mtype) and mtype not in _loaded_machine_types:
+            _loaded_machine_types.add(mtype)
+            module = importlib.import_module(module_name)
+            other_plans = {key: plans.copy() for key, plans in synthesis_plans.items()}
+            synthesis_plans.clear()
+            getattr(module, f'register_{mtype}_plans')()
+            for key, plans in other_plans.items():
+                synthesis_plans[key].extend(plans)
+    return synthesis_plans
+
 
 def _register_ef_provider(desc, fun, collective, machine_type, machines, sizes, protocol, priority):
+    import humanfriendly
     if sizes == None:
         sizes = (0, math.inf)
     else:
@@ -46,15 +68,32 @@ def register_ef_file(path, collective, machine_type, num_machines, sizes=None, p
                          machine_type, lambda x: x == num_machines, sizes, protocol, priority)
 
 
+def _temporary_file(write):
+    fd, path = tempfile.mkstemp()
+    with os.fdopen(fd, 'w') as f:
+        write(f)
+    atexit.register(os.remove, path)
+    return path
+
+
+def _cached_file(fun, parameters, machines, write):
+    # Plans are written once into the shared plan cache and reused by every later call in any process, unless
+    # MSCCL_BYPASS_PLAN_CACHE is set or the cache is unusable
+    from msccl.autosynth.plan_cache import PlanCache, plan_fingerprint
+    fingerprint = plan_fingerprint(fun, parameters, machines)
+    if fingerprint != None:
+        path = PlanCache(bypass='MSCCL_BYPASS_PLAN_CACHE' in os.environ).path(fingerprint, write)
+        if path != None:
+            return path
+    return _temporary_file(write)
+
+
 def register_synthesis_plan(collective, machine_type, machines=lambda x: True, sizes=None, protocol='Simple', priority=0):
     def decorator(fun):
         def wrapped(machines):
-            ef = fun(machines)
-            fd, path = tempfile.mkstemp()
-            with os.fdopen(fd, 'w') as f:
-                f.write(ef)
-            atexit.register(os.remove, path)
-            return path
+            def write(f):
+                f.write(fun(machines))
+            return _cached_file(fun, {}, machines, write)
         _register_ef_provider(f'call {fun.__name__}', wrapped, collective,
                              machine_type, machines, sizes, protocol, priority)
         # Return the original function to not break other usage
@@ -62,12 +101,42 @@ def register_synthesis_plan(collective, machine_type, machines=lambda x: True, s
     return decorator
 
 
+def _report_lowering_profile(profile, machines):
+    # MSCCL_PROFILE_LOWERING turns on profiling, if it names a file the profile is appended to it as a JSON line
+    print(f'MSCCL: Lowering profile of {profile.program} for {machines} machines:')
+    print(profile.table())
+    path = os.environ['MSCCL_PROFILE_LOWERING']
+    if path != '':
+        with open(path, 'a') as f:
+            f.write(json.dumps(dict(profile.to_dict(), machines=machines)) + '\n')
+
+
 def register_msccl_program(local_topology, collective, machine_type, machines=lambda x: True, sizes=None, protocol='Simple', 
-    chunk_factor=1, priority=0, collective_obj=None, instances=1, inplace=False, threadblock_policy=ThreadblockPolicy.auto,
+    chunk_factor=1, priority=0, collective_obj=None, instances=1, inplace=False, threadblock_policy=None,
     interleaved_replication=True, dependence_nop=False):
+    # The MSCCLang compiler is imported once a program is registered. The default threadblock_policy is auto.
+    from msccl.language.ir import ThreadblockPolicy
+    if threadblock_policy == None:
+        threadblock_policy = ThreadblockPolicy.auto
     def decorator(fun):
         name = fun.__name__
-        def wrapped(machines):
+        # Everything besides the function and the number of machines that determines the compiled program. Programs
+        # for a custom collective_obj are not cached as it can not be fingerprinted.
+        parameters = {
+            'local_topology': local_topology.links,
+            'collective': collective,
+            'protocol': protocol,
+            'chunk_factor': chunk_factor,
+            'instances': instances,
+            'inplace': inplace,
+            'threadblock_policy': threadblock_policy,
+            'interleaved_replication': interleaved_replication,
+            'dependence_nop': dependence_nop,
+        }
+        def compile_program(machines, f):
+            from msccl.language import MSCCLProgram
+            import msccl.language.collectives as lang_collectives
+            from msccl.topologies import distributed_fully_connected
             topology = distributed_fully_connected(local_topology, machines, 1)
             co = collective_obj
             if co == None:
@@ -82,16 +151,21 @@ def register_msccl_program(local_topology, collective, machine_type, machines=la
                 else:
                     raise RuntimeError(f'No collective_obj in msccl.language.collectives known for "{collective}"')
             prog = MSCCLProgram(name, topology, co, instances, protocol, threadblock_policy=threadblock_policy, 
-                interleaved_replication=interleaved_replication, dependence_nop=dependence_nop)
+                interleaved_replication=interleaved_replication, dependence_nop=dependence_nop,
+                profile='MSCCL_PROFILE_LOWERING' in os.environ)
             with prog:
-                fun(prog, machines)
-            prog.check()
-            ef = prog.generate_xml()
-            fd, path = tempfile.mkstemp()
-            with os.fdopen(fd, 'w') as f:
-                f.write(ef)
-            atexit.register(os.remove, path)
-            return path
+                prog.run_pass('program', fun, prog, machines)
+            prog.run_pass('check', prog.check)
+            prog.generate_xml(file=f)
+            if prog.profile != None:
+                _report_lowering_profile(prog.profile, machines)
+        def wrapped(machines):
+            def write(f):
+                compile_program(machines, f)
+            # Profiling needs the program to actually be compiled
+            if collective_obj != None or 'MSCCL_PROFILE_LOWERING' in os.environ:
+                return _temporary_file(write)
+            return _cached_file(fun, parameters, machines, write)
         _register_ef_provider(f'run {name}', wrapped, collective,
                              machine_type, machines, sizes, protocol, priority)
         # Return the original function to not break other usage
@@ -0,0 +1,14 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from pathlib import Path
+import os
+
+def default_cache_directory(kind):
+    '''
+    Returns the directory for persistent caches of the given kind, under MSCCL_CACHE_DIR if it is set and under
+    ~/.cache/msccl otherwise.
+    '''
+    if 'MSCCL_CACHE_DIR' in os.environ:
+        return Path(os.environ['MSCCL_CACHE_DIR']) / kind
+    return Path.home() / '.cache' / 'msccl' / kind
@@ -5,7 +5,7 @@ from .known_topologies import KnownTopologies
 from .known_collectives import KnownCollectives
 from .common import *
 from msccl.rounds_bound import lower_bound_rounds
-from msccl.isomorphisms import find_isomorphisms
+from msccl.isomorphisms import find_isomorphisms, default_isomorphism_cache
 
 def make_analyses(cmd_parsers):
     handler_funcs = []
@@ -18,6 +18,7 @@ def make_handle_bound_rounds(cmd_parsers):
     cmd = cmd_parsers.add_parser('rounds')
     topologies = KnownTopologies(cmd)
     collectives = KnownCollectives(cmd)
+    cmd.add_argument('--backend', type=str, choices=['native', 'z3'], default='native', help='solve the linear program with an exact simplex method or with Z3')
 
     def handle(args, command):
         if command != 'rounds':
@@ -25,7 +26,7 @@ def make_handle_bound_rounds(cmd_parsers):
 
         topology = topologies.create(args)
         collective = collectives.create(args, topology.num_nodes())
-        lower_bound_rounds(topology, collective, logging=True)
+        lower_bound_rounds(topology, collective, logging=True, backend=args.backend)
         return True
     
     return handle
@@ -34,6 +35,8 @@ def make_handle_find_isomorphisms(cmd_parsers):
     cmd = cmd_parsers.add_parser('isomorphisms')
     topologies1 = KnownTopologies(cmd, tag='1')
     topologies2 = KnownTopologies(cmd, tag='2')
+    cmd.add_argument('--backend', type=str, choices=['native', 'z3'], default='native', help='search isomorphisms by backtracking or with Z3')
+    cmd.add_argument('--no-cache', action='store_true', help='do not look up or store the isomorphisms in the cache')
 
     def handle(args, command):
         if command != 'isomorphisms':
@@ -41,7 +44,8 @@ def make_handle_find_isomorphisms(cmd_parsers):
 
         topology1 = topologies1.create(args)
         topology2 = topologies2.create(args)
-        isomorphisms = find_isomorphisms(topology1, topology2, logging=True)
+        cache = default_isomorphism_cache() if not args.no_cache else None
+        isomorphisms = find_isomorphisms(topology1, topology2, logging=True, backend=args.backend, cache=cache)
         return True
     
     return handle
@@ -3,7 +3,9 @@
 
 from msccl.serialization import *
 from msccl.instance import *
+from msccl.solution_cache import SolutionCache
 from pathlib import Path
+import humanfriendly
 import sys
 import re
 from fractions import Fraction
@@ -26,7 +28,7 @@ def _validate_output_directory(directory):
         print('error: output path is not a directory', file=sys.stderr)
         exit(1)
 
-def _handle_write_to_directory(directory, force, get_contents, preferred_file_name):
+def _handle_write_to_directory(directory, force, get_contents, preferred_file_name, write_contents=None):
     output_file = directory / preferred_file_name
     if output_file.exists():
         if output_file.is_dir():
@@ -38,7 +40,10 @@ def _handle_write_to_directory(directory, force, get_contents, preferred_file_na
             print(f'file already exists, use -f/--force to overwrite {output_file}', file=sys.stderr)
             return False
     with output_file.open('w') as f:
-        f.write(get_contents())
+        if write_contents != None:
+            write_contents(f)
+        else:
+            f.write(get_contents())
     print(f'Wrote to {output_file}')
     return True
 
@@ -57,7 +62,8 @@ def add_output_file(parser):
         if args.directory != None:
             _validate_output_directory(args.directory)
 
-    def handle(args, get_contents, preferred_file_name):
+    def handle(args, get_contents, preferred_file_name, write_contents=None):
+        # write_contents can be given to write the contents to the file handle directly instead of through a string
         if args.no_save:
             return False
         if args.output != None:
@@ -65,10 +71,13 @@ def add_output_file(parser):
                 print(f'file already exists, use -f/--force to overwrite {args.output}', file=sys.stderr)
                 return False
             with args.output.open('w') as f:
-                f.write(get_contents())
+                if write_contents != None:
+                    write_contents(f)
+                else:
+                    f.write(get_contents())
             print(f'Wrote to {args.output}')
         else:
-            return _handle_write_to_directory(args.directory, args.force, get_contents, preferred_file_name)
+            return _handle_write_to_directory(args.directory, args.force, get_contents, preferred_file_name, write_contents)
         return True
 
     return validate_args, handle
@@ -157,6 +166,28 @@ def add_instance(parser, take_steps=True, take_rounds=True, take_chunks=True):
 
     return handle
 
+def add_solution_cache(parser):
+    parser.add_argument('--cache', action='store_true', help='reuse previously solved instances from the solution cache')
+    parser.add_argument('--cache-dir', type=Path, default=None, help='directory of the solution cache (implies --cache)', metavar='DIR')
+    parser.add_argument('--cache-max-size', type=str, default='256MiB', help='size limit of the solution cache', metavar='SIZE')
+    parser.add_argument('--bypass-cache', action='store_true', help='solve all instances again but store the results in the solution cache')
+    parser.add_argument('--clear-cache', action='store_true', help='remove all entries from the solution cache before solving')
+
+    def handle(args):
+        if not (args.cache or args.cache_dir != None or args.bypass_cache or args.clear_cache):
+            return None
+        try:
+            max_size = humanfriendly.parse_size(args.cache_max_size)
+        except humanfriendly.InvalidSize:
+            parser.error(f'could not parse --cache-max-size {args.cache_max_size}')
+        cache = SolutionCache(args.cache_dir, max_size, bypass=args.bypass_cache)
+        if args.clear_cache:
+            cache.clear()
+            print(f'Cleared the solution cache in {cache.directory}')
+        return cache
+
+    return handle
+
 def parse_fraction(value):
     try:
         return int(value)
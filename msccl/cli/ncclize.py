@@ -11,12 +11,15 @@ def make_handle_ncclize(cmd_parsers):
     remap_scratch_grp = cmd.add_mutually_exclusive_group()
     remap_scratch_grp.add_argument('--remap-scratch', action='store_true', default=None, help='remap scratch buffer indices into free input/output indices')
     remap_scratch_grp.add_argument('--no-remap-scratch', action='store_false', dest='remap_scratch', help='don\'t remap scratch buffer indices into free input/output indices')
+    cmd.add_argument('--optimize-scratch-remap', action='store_true', help='try to improve the scratch remapping with Z3 for up to a second per GPU')
     cmd.add_argument('--no-merge-contiguous', action='store_true', help='don\'t merge sends/receives from/to contiguous memory')
     cmd.add_argument('--no-pretty-print', action='store_true', help='don\'t pretty print the generated XML')
     cmd.add_argument('--greedy-scratch-sorting', action='store_true', help='sort scratch buffer indices greedily to increase contiguous operations')
     cmd.add_argument('--no-scratch', action='store_true', help='use extra space at the end of output buffer instead of the scratch buffer')
     cmd.add_argument('--channel-policy', type=ChannelPolicy, choices=list(ChannelPolicy), default=ChannelPolicy.MatchTopology, help='channel allocation policy')
+    cmd.add_argument('--threadblock-policy', type=ThreadblockPolicy, choices=list(ThreadblockPolicy), default=ThreadblockPolicy.FirstFit, help='threadblock packing policy')
     cmd.add_argument('--instances', type=int, default=1, help='number of interleaved instances of the algorithm to make')
+    cmd.add_argument('-j', '--workers', type=int, default=None, help='generate the XML of GPUs in this many worker processes, which helps only for algorithms with many thousands of sends', metavar='N')
 
     def handle(args, command):
         if command != 'ncclize':
@@ -25,8 +28,8 @@ def make_handle_ncclize(cmd_parsers):
         input_algorithms = read_algorithm(args)
         validate_output_args(args)
 
-        for algo in input_algorithms:
-            ncclized = ncclize(algo,
+        def run_ncclize(algo, file=None):
+            return ncclize(algo,
                 remap_scratch=args.remap_scratch,
                 channel_policy=args.channel_policy,
                 pretty_print=not args.no_pretty_print,
@@ -34,9 +37,16 @@ def make_handle_ncclize(cmd_parsers):
                 merge_contiguous=not args.no_merge_contiguous,
                 greedy_scratch_sorting=args.greedy_scratch_sorting,
                 instances=args.instances,
+                optimize_scratch_remap=args.optimize_scratch_remap,
+                workers=args.workers,
+                threadblock_policy=args.threadblock_policy,
+                file=file,
                 logging=True)
 
-            handled = output_handler(args, lambda: ncclized, name_msccl_object(algo.name, ending='msccl.xml'))
+        for algo in input_algorithms:
+            # The XML is streamed into the output file as it is generated
+            handled = output_handler(args, lambda: run_ncclize(algo), name_msccl_object(algo.name, ending='msccl.xml'),
+                write_contents=lambda f: run_ncclize(algo, f))
 
         return True
     
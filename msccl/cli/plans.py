@@ -3,10 +3,19 @@
 
 from .common import *
 from msccl.autosynth import *
+from msccl.autosynth import _select_plans
+from msccl.autosynth.precompiled import write_manifest
+import argparse
+import math
+import multiprocessing
+import os
+import shutil
 
 def make_plans(cmd_parsers):
     handler_funcs = []
     handler_funcs.append(make_handle_list)
+    handler_funcs.append(make_handle_profile)
+    handler_funcs.append(make_handle_compile)
 
     return make_cmd_category(cmd_parsers, 'plans', 'subcommand', handler_funcs)
 
@@ -21,3 +30,114 @@ def make_handle_list(cmd_parsers):
         return True
     
     return handle
+
+def make_handle_profile(cmd_parsers):
+    cmd = cmd_parsers.add_parser('profile')
+    cmd.add_argument('machine_type', type=str, help='machine type the plans are registered for')
+    cmd.add_argument('collective', type=str, help='collective the plans implement')
+    cmd.add_argument('machines', type=int, help='number of machines')
+    cmd.add_argument('--json', type=Path, help='append the profiles as JSON lines to FILE', metavar='FILE')
+
+    def handle(args, command):
+        if command != 'profile':
+            return False
+
+        # Profiling is turned on in the registry, which prints the table of each lowered program
+        os.environ['MSCCL_PROFILE_LOWERING'] = str(args.json) if args.json != None else ''
+        any_run = False
+        for desc, plan, machines, _, _, _ in load_builtin_plans(args.machine_type)[(args.collective, args.machine_type)]:
+            # Only plans running MSCCLang programs are lowered
+            if desc.startswith('run ') and machines(args.machines):
+                plan(args.machines)
+                any_run = True
+        if not any_run:
+            print(f'error: no MSCCLang plans for {args.collective} on {args.machines} {args.machine_type} machines', file=sys.stderr)
+            exit(1)
+        return True
+
+    return handle
+
+def _parse_machine_counts(spec):
+    # Comma separated numbers of machines and inclusive ranges of them, e.g. "1,8-64"
+    counts = set()
+    try:
+        for part in spec.split(','):
+            if '-' in part:
+                lower, upper = part.split('-')
+                counts.update(range(int(lower), int(upper) + 1))
+            else:
+                counts.add(int(part))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f'invalid machine counts "{spec}", expected e.g. "1,8-64"')
+    if any(count < 1 for count in counts):
+        raise argparse.ArgumentTypeError('machine counts must be strictly positive')
+    return sorted(counts)
+
+def _compile_plan(job):
+    # Runs in a worker process, which registers the same built-in plans as the parent
+    collective, machine_type, index, machines, path = job
+    _, plan, _, _, _, _ = load_builtin_plans(machine_type)[(collective, machine_type)][index]
+    shutil.copyfile(plan(machines), path)
+
+def make_handle_compile(cmd_parsers):
+    cmd = cmd_parsers.add_parser('compile')
+    cmd.add_argument('machine_type', type=str, help='machine type the plans are registered for')
+    cmd.add_argument('machines', type=_parse_machine_counts, help='numbers of machines, e.g. "1,8-64"')
+    cmd.add_argument('collectives', type=str, nargs='*', help='collectives to compile plans for (default: all)')
+    cmd.add_argument('-d', '--directory', type=Path, required=True, help='directory to write the plans and their manifest to', metavar='DIR')
+    cmd.add_argument('-j', '--workers', type=int, default=None, help='compile plans in this many worker processes (default: one per CPU)', metavar='N')
+
+    def handle(args, command):
+        if command != 'compile':
+            return False
+
+        if args.workers != None and args.workers < 1:
+            cmd.error('--workers must be strictly positive')
+        plans = load_builtin_plans(args.machine_type)
+        collectives = args.collectives
+        if len(collectives) == 0:
+            collectives = sorted(set(collective for collective, machine_type in plans if machine_type == args.machine_type))
+        # Select plans exactly like msccl.init would for every size, and compile each selected plan once
+        entries = []
+        jobs = {}
+        for collective in collectives:
+            candidates = plans[(collective, args.machine_type)]
+            for machines in args.machines:
+                if not any(candidate[2](machines) for candidate in candidates):
+                    continue
+                for plan, (minsize, maxsize, proto) in _select_plans(collective, candidates, machines, (0, math.inf)):
+                    index = next(i for i, candidate in enumerate(candidates) if candidate[1] is plan)
+                    desc = candidates[index][0]
+                    # Descriptions are "run name", "call name" or "load path"
+                    plan_name = Path(desc.split(' ', 1)[1]).stem
+                    file_name = f'{collective}.{machines}.{plan_name}.xml'
+                    jobs[(collective, index, machines)] = file_name
+                    entries.append({
+                        'collective': collective,
+                        'machines': machines,
+                        'plan': desc,
+                        'file': file_name,
+                        'minbytes': minsize,
+                        'maxbytes': maxsize,
+                        'proto': proto,
+                    })
+        if len(entries) == 0:
+            print(f'error: no plans for {", ".join(collectives)} on {args.machine_type} machines', file=sys.stderr)
+            exit(1)
+
+        args.directory.mkdir(parents=True, exist_ok=True)
+        with multiprocessing.Pool(args.workers) as pool:
+            pool.map(_compile_plan, [(collective, args.machine_type, index, machines, args.directory / file_name)
+                for (collective, index, machines), file_name in jobs.items()])
+        write_manifest(args.directory, args.machine_type, entries)
+        # Configuration files for MSCCL_CONFIG, one per number of machines
+        directory = args.directory.absolute()
+        for machines in sorted(set(entry['machines'] for entry in entries)):
+            loads = [(str(directory / entry['file']), entry['minbytes'], entry['maxbytes'], entry['proto'])
+                for entry in entries if entry['machines'] == machines]
+            with open(directory / f'msccl_algos.{machines}.xml', 'w') as f:
+                f.write(algos_config(loads))
+        print(f'Wrote {len(jobs)} plans for {len(entries)} size ranges to {args.directory}')
+        return True
+
+    return handle
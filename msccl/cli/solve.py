@@ -17,6 +17,8 @@ def make_solvers(cmd_parsers):
 def _make_handle_strategy(cmd_parsers, name, invoke, take_steps = True):
     cmd = cmd_parsers.add_parser(name)
     instance_handler = add_instance(cmd, take_steps=take_steps)
+    cache_handler = add_solution_cache(cmd)
+    cmd.add_argument('--symmetry-breaking', action='store_true', help='prune solutions that are equivalent under automorphisms of the topology')
     topologies = KnownTopologies(cmd)
     collectives = KnownCollectives(cmd)
     validate_output_args, output_handler = add_output_algorithm(cmd)
@@ -29,25 +31,27 @@ def _make_handle_strategy(cmd_parsers, name, invoke, take_steps = True):
         topology = topologies.create(args)
         collective = collectives.create(args, topology.num_nodes())
         instance = instance_handler(args)
-        algo = invoke(args, topology, collective, instance)
+        cache = cache_handler(args)
+        algo = invoke(args, topology, collective, instance, cache)
         output_handler(args, algo)
         return True
     
     return cmd, handle
 
 def make_handle_solve_instance(cmd_parsers):
-    def invoke(args, topology, collective, instance):
-        return strategies.solve_instance(topology, collective, instance, logging=True)
+    def invoke(args, topology, collective, instance, cache):
+        return strategies.solve_instance(topology, collective, instance, cache=cache, symmetry_breaking=args.symmetry_breaking, logging=True)
 
     cmd, handle = _make_handle_strategy(cmd_parsers, 'instance', invoke)
     return handle
 
 def make_handle_solve_least_steps(cmd_parsers):
-    def invoke(args, topology, collective, instance):
-        return strategies.solve_least_steps(topology, collective, args.initial_steps, instance, logging=True)
+    def invoke(args, topology, collective, instance, cache):
+        return strategies.solve_least_steps(topology, collective, args.initial_steps, instance, incremental=args.incremental, cache=cache, symmetry_breaking=args.symmetry_breaking, logging=True)
 
     cmd, handle = _make_handle_strategy(cmd_parsers, 'least-steps', invoke, take_steps=False)
     cmd.add_argument('--initial-steps', type=int, default=1, metavar='N')
+    cmd.add_argument('--incremental', action='store_true', help='reuse the step independent part of the encoding between the step counts tried')
     return handle
 
 def make_handle_solve_pareto_optimal(cmd_parsers):
@@ -61,7 +65,11 @@ def make_handle_solve_pareto_optimal(cmd_parsers):
     cmd.add_argument('--assume-rpc-bound', default=None, help='assume bandwidth optimality requires at least this many rounds per chunk', metavar='N/N')
     cmd.add_argument('--no-monotonic-feasibility', action='store_true', help='turn off an unproven assumption about monotonic feasibility of instances')
     cmd.add_argument('--save-eagerly', action='store_true', help='save algorithms as soon as they are found, without pruning non-Pareto optimal algorithms at the end')
+    cmd.add_argument('--incremental', action='store_true', help='reuse the step independent part of the encoding between instances with the same number of chunks (not supported with --workers)')
+    cmd.add_argument('-j', '--workers', type=int, default=None, help='solve instances speculatively in this many worker processes', metavar='N')
     instance_handler = add_instance(cmd, take_steps=False, take_rounds=False)
+    cache_handler = add_solution_cache(cmd)
+    cmd.add_argument('--symmetry-breaking', action='store_true', help='prune solutions that are equivalent under automorphisms of the topology')
 
     def handle(args, command):
         if command != name:
@@ -71,6 +79,9 @@ def make_handle_solve_pareto_optimal(cmd_parsers):
         topology = topologies.create(args)
         instance = instance_handler(args)
         collective = collectives.create(args, topology.num_nodes())
+        if args.incremental and args.workers != None:
+            cmd.error('--incremental cannot be combined with --workers')
+        cache = cache_handler(args)
         assume_rpc_bound = None
         if args.assume_rpc_bound:
             try:
@@ -78,7 +89,7 @@ def make_handle_solve_pareto_optimal(cmd_parsers):
             except ValueError:
                 cmd.error('could not parse --assume-rpc-bound as a fraction')
         algorithms = []
-        for algorithm in strategies.solve_all_latency_bandwidth_tradeoffs(topology, collective, args.min_chunks, args.max_chunks, assume_rpc_bound, not args.no_monotonic_feasibility, base_instance=instance, logging=True):
+        for algorithm in strategies.solve_all_latency_bandwidth_tradeoffs(topology, collective, args.min_chunks, args.max_chunks, assume_rpc_bound, not args.no_monotonic_feasibility, base_instance=instance, incremental=args.incremental, workers=args.workers, cache=cache, symmetry_breaking=args.symmetry_breaking, logging=True):
             algorithms.append(algorithm)
             if args.save_eagerly:
                 output_handler(args, algorithm, algorithm.name)
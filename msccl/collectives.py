@@ -10,37 +10,102 @@ class Chunk:
     postcondition: set
     address: int
 
+def _ranks_mask(ranks):
+    mask = 0
+    for rank in ranks:
+        mask |= 1 << rank
+    return mask
+
+def _mask_ranks(mask):
+    ranks = []
+    while mask:
+        low = mask & -mask
+        ranks.append(low.bit_length() - 1)
+        mask ^= low
+    return ranks
+
 class Collective:
     def __init__(self, name, num_nodes, chunks, triggers = {}, runtime_name= 'custom'):
+        self._init(name, num_nodes, [_ranks_mask(chunk.precondition) for chunk in chunks],
+            [_ranks_mask(chunk.postcondition) for chunk in chunks], [chunk.address for chunk in chunks], triggers,
+            runtime_name, 1)
+
+    @classmethod
+    def from_masks(cls, name, num_nodes, preconditions, postconditions, addresses, triggers = {}, runtime_name = 'custom', div = 1):
+        '''
+        Creates a collective from the bitmasks of ranks that have each base chunk in the pre- and postcondition and the
+        addresses of the base chunks. Chunk i of the collective is part i % div of base chunk i // div.
+        '''
+        collective = cls.__new__(cls)
+        collective._init(name, num_nodes, preconditions, postconditions, addresses, triggers, runtime_name, div)
+        return collective
+
+    def _init(self, name, num_nodes, preconditions, postconditions, addresses, triggers, runtime_name, div):
         self.name = name
         self.num_nodes = num_nodes
-        self.num_chunks = len(chunks)
-        self._chunks = chunks
         self._triggers = triggers
         self.runtime_name = runtime_name
 
-        self.is_combining = False
-        addresses_seen = set()
-        for chunk in self._chunks:
-            if chunk.address in addresses_seen:
-                self.is_combining = True
-            addresses_seen.add(chunk.address)
-        self.num_addresses = len(addresses_seen)
+        # Pre- and postconditions are stored as bitmasks of ranks per chunk. Chunked up collectives share these lists
+        # with the collective they were created from and map each of their chunks to a base chunk on the fly.
+        self._preconditions = preconditions
+        self._postconditions = postconditions
+        self._addresses = addresses
+        self._div = div
+        self.num_chunks = len(self._addresses) * self._div
+        # Chunking up maps distinct addresses to disjoint ranges of addresses, so combining is decided by the base chunks
+        base_addresses = set(self._addresses)
+        self.is_combining = len(base_addresses) < len(self._addresses)
+        self.num_addresses = len(base_addresses) * self._div
+        self._chunks_by_rank = None
 
     def ranks(self):
         return range(self.num_nodes)
 
     def chunks(self):
-        return range(len(self._chunks))
+        return range(self.num_chunks)
 
     def precondition(self, rank, chunk):
-        return rank in self._chunks[chunk].precondition
+        return (self._preconditions[chunk // self._div] >> rank) & 1 == 1
 
     def postcondition(self, rank, chunk):
-        return rank in self._chunks[chunk].postcondition
+        return (self._postconditions[chunk // self._div] >> rank) & 1 == 1
+
+    def precondition_mask(self, chunk):
+        ''' Returns a bitmask of the ranks that have the chunk in the precondition. '''
+        return self._preconditions[chunk // self._div]
+
+    def postcondition_mask(self, chunk):
+        ''' Returns a bitmask of the ranks that have the chunk in the postcondition. '''
+        return self._postconditions[chunk // self._div]
+
+    def precondition_ranks(self, chunk):
+        return _mask_ranks(self.precondition_mask(chunk))
+
+    def postcondition_ranks(self, chunk):
+        return _mask_ranks(self.postcondition_mask(chunk))
+
+    def _rank_chunks(self, rank, conditions):
+        if self._chunks_by_rank == None:
+            # Transpose the bitmasks once to answer queries by rank
+            self._chunks_by_rank = ([[] for _ in self.ranks()], [[] for _ in self.ranks()])
+            for lists, masks in zip(self._chunks_by_rank, (self._preconditions, self._postconditions)):
+                for base_chunk, mask in enumerate(masks):
+                    for r in _mask_ranks(mask):
+                        lists[r].append(base_chunk)
+        base_chunks = self._chunks_by_rank[conditions][rank]
+        return [base_chunk * self._div + i for base_chunk in base_chunks for i in range(self._div)]
+
+    def precondition_chunks(self, rank):
+        ''' Returns the chunks that the rank has in the precondition in increasing order. '''
+        return self._rank_chunks(rank, 0)
+
+    def postcondition_chunks(self, rank):
+        ''' Returns the chunks that the rank has in the postcondition in increasing order. '''
+        return self._rank_chunks(rank, 1)
 
     def address(self, chunk):
-        return self._chunks[chunk].address
+        return self._addresses[chunk // self._div] * self._div + chunk % self._div
 
     def trigger(self, rank, chunk):
         if (rank, chunk) in self._triggers:
@@ -51,42 +116,58 @@ class Collective:
     def has_triggers(self):
         return len(self._triggers) > 0
 
+    def triggers(self):
+        ''' Returns the triggers of the collective as a dict from (rank, chunk) to trigger. '''
+        return dict(self._triggers)
+
+    @property
+    def _chunks(self):
+        return [Chunk(set(self.precondition_ranks(chunk)), set(self.postcondition_ranks(chunk)), self.address(chunk))
+            for chunk in self.chunks()]
+
     def chunk_up(self, div):
         if div < 1:
             raise ValueError('Divisor must be greater or equal to one (and one is a no-op).')
         if div == 1:
             return self
 
-        def remap(addr, i):
-            return addr * div + i
-
-        new_chunks = []
-        for chunk in self._chunks:
-            for i in range(div):
-                new_chunks.append(Chunk(chunk.precondition, chunk.postcondition, remap(chunk.address, i)))
-
+        # Chunk i of the result is part i % div of chunk i // div, which is at address addr * div + i % div. Chunking up
+        # an already chunked up collective composes into a single divisor, so the result is a view of the base chunks.
         name = f'{self.name},chunks={div}'
-        return Collective(name, self.num_nodes, new_chunks)
-
-def build_collective(name, num_nodes, num_chunks, precondition, postcondition, address = lambda c: c, trigger = lambda r, c: None, runtime_name = 'custom'):
-    chunks = []
-    for chunk in range(num_chunks):
-        chunk_precondition = set(rank for rank in range(num_nodes) if precondition(rank, chunk))
-        chunk_postcondition = set(rank for rank in range(num_nodes) if postcondition(rank, chunk))
-        chunk_address = address(chunk)
-        chunks.append(Chunk(chunk_precondition, chunk_postcondition, chunk_address))
-    triggers = {(rank, chunk): trigger(rank, chunk) for rank in range(num_nodes) for chunk in range(num_chunks) if trigger(rank, chunk) != None}
-    return Collective(name, num_nodes, chunks, triggers, runtime_name)
+        return Collective.from_masks(name, self.num_nodes, self._preconditions, self._postconditions, self._addresses,
+            div=self._div * div)
+
+def _no_trigger(rank, chunk):
+    return None
+
+def build_collective(name, num_nodes, num_chunks, precondition, postcondition, address = lambda c: c, trigger = _no_trigger, runtime_name = 'custom'):
+    def masks(condition):
+        # Conditions may provide the bitmask of ranks for a chunk directly, which avoids calling them for every rank
+        if hasattr(condition, 'mask'):
+            ranks = (1 << num_nodes) - 1
+            return [condition.mask(chunk) & ranks for chunk in range(num_chunks)]
+        return [_ranks_mask(rank for rank in range(num_nodes) if condition(rank, chunk)) for chunk in range(num_chunks)]
+    triggers = {}
+    if trigger != _no_trigger:
+        for rank in range(num_nodes):
+            for chunk in range(num_chunks):
+                value = trigger(rank, chunk)
+                if value != None:
+                    triggers[(rank, chunk)] = value
+    return Collective.from_masks(name, num_nodes, masks(precondition), masks(postcondition),
+        [address(chunk) for chunk in range(num_chunks)], triggers, runtime_name)
 
 # Common pre- and postconditions
 def _scattered(num_nodes, chunks = 1):
     def cond(rank, chunk):
         return rank == (chunk // chunks) % num_nodes
+    cond.mask = lambda chunk: 1 << (chunk // chunks) % num_nodes
     return cond
 
 def _transpose(num_nodes):
     def cond(rank, chunk):
         return rank == chunk // num_nodes
+    cond.mask = lambda chunk: 1 << chunk // num_nodes if chunk // num_nodes < num_nodes else 0
     return cond
 
 def _all(rank, chunk):
@@ -95,6 +176,7 @@ def _all(rank, chunk):
 def _root(root):
     def cond(rank, chunk):
         return rank == root
+    cond.mask = lambda chunk: 1 << root if root >= 0 else 0
     return cond
 
 # Non-combining collectives
@@ -143,6 +225,7 @@ def scan(num_nodes):
 def _roots(roots):
     def cond(rank, chunk):
         return rank == roots[chunk % len(roots)]
+    cond.mask = lambda chunk: 1 << roots[chunk % len(roots)] if roots[chunk % len(roots)] >= 0 else 0
     return cond
 
 def multiroot_broadcast(num_nodes, roots):
@@ -41,7 +41,9 @@ def synthesize_greedy_distributed_alltoall(topology, local_algorithm, logging=Fa
     # Also check that remote part is fully connected.
     # Also remember remote constraints.
     remote_constraints = []
-    for srcs, dsts, bw, _ in topology.bandwidth_constraints():
+    # Maps indices of remote constraints in the topology to their position in remote_constraints
+    remote_constraint_indices = {}
+    for idx, (srcs, dsts, bw, _) in enumerate(topology.bandwidth_constraints()):
         has_local_pairs = False
         has_remote_pairs = False
         for src in srcs:
@@ -56,8 +58,13 @@ def synthesize_greedy_distributed_alltoall(topology, local_algorithm, logging=Fa
             # This is required because it's what makes Alltoall routing trivial
             raise ValueError('All remote pairs must have direct connectivity.')
         if has_remote_pairs:
+            remote_constraint_indices[idx] = len(remote_constraints)
             remote_constraints.append((srcs, dsts, bw))
 
+    def relevant_limits(bw_limits, src, dst):
+        return [bw_limits[remote_constraint_indices[idx]] for idx in topology.constraints_of(src, dst)
+            if idx in remote_constraint_indices]
+
     collective = alltoall(topology.num_nodes())
 
     def nth_chunk_for_pair(src, dst, idx):
@@ -90,15 +97,13 @@ def synthesize_greedy_distributed_alltoall(topology, local_algorithm, logging=Fa
             sends = remote_sends[pair]
             # Yield as many sends as allowed by the bw limits
             max_sends = len(sends)
-            relevant_limits = []
-            for limit in bw_limits:
-                if src in limit.srcs and dst in limit.dsts:
-                    max_sends = min(max_sends, limit.bw - limit.util)
-                    relevant_limits.append(limit)
+            pair_limits = relevant_limits(bw_limits, src, dst)
+            for limit in pair_limits:
+                max_sends = min(max_sends, limit.bw - limit.util)
             for i in range(max_sends):
                 packed_sends.append(sends.pop())
             # Remove used bandwidth from limits
-            for limit in relevant_limits:
+            for limit in pair_limits:
                 limit.util += max_sends
             if len(sends) == 0:
                 empty_pairs.append(pair)
@@ -157,9 +162,8 @@ def synthesize_greedy_distributed_alltoall(topology, local_algorithm, logging=Fa
             src, dst = pair
             sends = remote_sends[pair]
             # Add utilization against all relevant limits
-            for limit in bw_limits:
-                if src in limit.srcs and dst in limit.dsts:
-                    limit.util += len(sends)
+            for limit in relevant_limits(bw_limits, src, dst):
+                limit.util += len(sends)
             # Add the sends to the last step
             last_step.sends.extend(sends)
 
@@ -1,8 +1,15 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+from msccl.cache_dir import default_cache_directory
 from z3 import *
 from dataclasses import dataclass
+from collections import Counter, defaultdict
+from pathlib import Path
+import hashlib
+import json
+import os
+import tempfile
 
 @dataclass
 class Permutation:
@@ -43,20 +50,97 @@ def _decode_permutation(model, topology):
     node_permutation = [model.eval(_pn(node)).as_long() for node in topology.nodes()]
     return Permutation(node_permutation)
 
-def find_isomorphisms(topology, target_topology, limit=None, logging=False):
-    '''
-    Finds all isomorphisms from one topology to a target topology. Returns a list of permutations.
-    '''
-    if len(topology.switches) > 0:
-        print('MSCCL Warning: Topologies with switches are not supported. import msccl will be ignored.')
-        return []
+def _switches_preserved(topology, target_topology, permutation):
+    # Check that the permutation maps the switches of the topology exactly onto the switches of the target topology
+    def switch_key(srcs, dsts, bw):
+        return (frozenset(srcs), frozenset(dsts), bw)
+    mapped = Counter(switch_key([permutation[src] for src in srcs], [permutation[dst] for dst in dsts], bw)
+        for srcs, dsts, bw, _ in topology.switches)
+    target = Counter(switch_key(srcs, dsts, bw) for srcs, dsts, bw, _ in target_topology.switches)
+    return mapped == target
 
-    if limit != None and limit <= 0:
-        raise ValueError('MSCCL error: limit was set improperly.')
-    
-    if topology.num_nodes() != target_topology.num_nodes():
-        raise ValueError('MSCCL error: target topology does not match with the given topology.')
+def _link_signature(links, node):
+    # The multisets of bandwidths on outgoing and incoming links are preserved by isomorphisms
+    return (tuple(sorted(links[dst][node] for dst in range(len(links)))), tuple(sorted(links[node])), links[node][node])
+
+def _switch_signature(topology, node):
+    # The shapes of the switches a node participates in are preserved by isomorphisms that preserve switches
+    return tuple(sorted((node in srcs, node in dsts, len(srcs), len(dsts), bw)
+        for srcs, dsts, bw, _ in topology.switches if node in srcs or node in dsts))
+
+def _match_isomorphisms(topology, target_topology, limit, logging, is_valid=lambda nodes: True, match_switches=False):
+    # Backtracking search in the style of VF2. Nodes are matched in an order where each node has as many links to
+    # already matched nodes as possible, and candidates are pruned by their link signatures and the links to all
+    # previously matched nodes.
+    if logging:
+        print(f'Matching {topology.name} - {target_topology.name} isomorphisms by backtracking search')
+
+    links = topology.links
+    target_links = target_topology.links
+    num_nodes = topology.num_nodes()
+
+    def signature(topology, node):
+        if match_switches:
+            return (_link_signature(topology.links, node), _switch_signature(topology, node))
+        return _link_signature(topology.links, node)
+
+    target_by_signature = defaultdict(list)
+    for node in target_topology.nodes():
+        target_by_signature[signature(target_topology, node)].append(node)
+    candidates = [target_by_signature[signature(topology, node)] for node in topology.nodes()]
 
+    # Choose the matching order
+    order = []
+    connectivity = [0] * num_nodes
+    unordered = set(topology.nodes())
+    while len(unordered) > 0:
+        node = min(unordered, key=lambda n: (-connectivity[n], len(candidates[n]), n))
+        unordered.remove(node)
+        order.append(node)
+        for other in unordered:
+            if links[other][node] > 0 or links[node][other] > 0:
+                connectivity[other] += 1
+
+    isomorphisms = []
+    permutation = [None] * num_nodes
+    used = [False] * num_nodes
+
+    def extend(depth):
+        # Returns True once the limit has been reached
+        if depth == num_nodes:
+            if is_valid(permutation):
+                isomorphism = Permutation(list(permutation))
+                isomorphisms.append(isomorphism)
+                if logging:
+                    print(isomorphism)
+                return limit != None and len(isomorphisms) >= limit
+            return False
+        node = order[depth]
+        for candidate in candidates[node]:
+            if used[candidate]:
+                continue
+            # Links to and from all previously matched nodes must match
+            consistent = True
+            for prev in order[:depth]:
+                mapped = permutation[prev]
+                if links[node][prev] != target_links[candidate][mapped] or links[prev][node] != target_links[mapped][candidate]:
+                    consistent = False
+                    break
+            if consistent:
+                permutation[node] = candidate
+                used[candidate] = True
+                if extend(depth + 1):
+                    return True
+                used[candidate] = False
+                permutation[node] = None
+        return False
+
+    extend(0)
+    if logging:
+        print(f'{len(isomorphisms)} isomorphisms found.')
+    return isomorphisms
+
+def _solve_isomorphisms(topology, target_topology, limit, logging, is_valid=lambda nodes: True):
     if logging:
         print(f'Encoding {topology.name} - {target_topology.name} isomorphisms to Z3')
 
@@ -71,13 +155,14 @@ def find_isomorphisms(topology, target_topology, limit=None, logging=False):
     isomorphisms = []
     while s.check() == sat:
         isomorphism = _decode_permutation(s.model(), topology)
-        isomorphisms.append(isomorphism)
+        if is_valid(isomorphism.nodes):
+            isomorphisms.append(isomorphism)
 
-        if logging:
-            print(isomorphism)
+            if logging:
+                print(isomorphism)
 
-        if limit != None and len(isomorphisms) >= limit:
-            break
+            if limit != None and len(isomorphisms) >= limit:
+                break
 
         # Block this permutation
         assignment = [_pn(node) == perm for node, perm in enumerate(isomorphism.nodes)]
@@ -86,3 +171,177 @@ def find_isomorphisms(topology, target_topology, limit=None, logging=False):
     if logging:
         print(f'{len(isomorphisms)} isomorphisms found.')
     return isomorphisms
+
+def _find_isomorphisms(topology, target_topology, limit, logging, backend, is_valid=lambda nodes: True, match_switches=False):
+    if limit != None and limit <= 0:
+        raise ValueError('MSCCL error: limit was set improperly.')
+
+    if backend == 'native':
+        return _match_isomorphisms(topology, target_topology, limit, logging, is_valid, match_switches)
+    elif backend == 'z3':
+        return _solve_isomorphisms(topology, target_topology, limit, logging, is_valid)
+    else:
+        raise ValueError(f'MSCCL error: unknown isomorphism backend {backend}.')
+
+def _refine_colors(topology):
+    # Weighted color refinement: starting from the link and switch signatures, repeatedly recolor each node by its
+    # color together with the multisets of (bandwidth, color) pairs of its outgoing and incoming links. Colors are
+    # numbered by sorting their signatures, so the result does not depend on how the nodes are labeled.
+    links = topology.links
+    nodes = topology.nodes()
+    def relabel(signatures):
+        palette = {signature: color for color, signature in enumerate(sorted(set(signatures)))}
+        return [palette[signature] for signature in signatures]
+
+    colors = relabel([(_link_signature(links, node), _switch_signature(topology, node)) for node in nodes])
+    while True:
+        signatures = [(colors[node],
+            tuple(sorted((links[dst][node], colors[dst]) for dst in nodes if links[dst][node] > 0)),
+            tuple(sorted((links[node][src], colors[src]) for src in nodes if links[node][src] > 0)))
+            for node in nodes]
+        refined = relabel(signatures)
+        if len(set(refined)) == len(set(colors)):
+            return colors, signatures
+        colors = refined
+
+def topology_certificate(topology):
+    '''
+    Returns a hash of the topology that is invariant under relabeling its nodes. Isomorphic topologies always have the
+    same certificate, while non-isomorphic topologies only rarely share one.
+    '''
+    colors, signatures = _refine_colors(topology)
+    switches = sorted([sorted(colors[src] for src in srcs), sorted(colors[dst] for dst in dsts), bw]
+        for srcs, dsts, bw, _ in topology.switches)
+    certificate = json.dumps([sorted(signatures), switches], separators=(',', ':'), default=str)
+    return hashlib.sha256(certificate.encode('utf-8')).hexdigest()
+
+def _is_isomorphism(topology, target_topology, nodes):
+    # Checks that the permutation maps every link of the topology onto the same link of the target topology
+    if len(nodes) != topology.num_nodes() or sorted(nodes) != list(target_topology.nodes()):
+        return False
+    links = topology.links
+    target_links = target_topology.links
+    return all(links[dst][src] == target_links[nodes[dst]][nodes[src]]
+        for src in topology.nodes() for dst in topology.nodes())
+
+class IsomorphismCache(object):
+    '''
+    Caches the results of find_isomorphisms in memory and, if a directory is given, on disk. Entries are keyed by the
+    certificates of both topologies and store only the certificates and the isomorphisms. The cached isomorphisms are
+    checked against the queried topologies once on lookup, so a relabeling of a previously seen pair is a miss that
+    replaces the entry.
+    '''
+    def __init__(self, directory=None):
+        self.directory = Path(directory) if directory != None else None
+        self._entries = {}
+
+    def _key(self, topology, target_topology, limit):
+        return f'{topology_certificate(topology)}-{topology_certificate(target_topology)}-{limit}'
+
+    def _entry_path(self, key):
+        return self.directory / f'{hashlib.sha256(key.encode("utf-8")).hexdigest()}.json'
+
+    def _load(self, key):
+        if key in self._entries:
+            return self._entries[key]
+        if self.directory == None:
+            return None
+        try:
+            with self._entry_path(key).open() as f:
+                entry = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self._entries[key] = entry
+        return entry
+
+    def lookup(self, topology, target_topology, limit=None):
+        '''
+        Returns the cached isomorphisms or None if there is no applicable entry.
+        '''
+        key = self._key(topology, target_topology, limit)
+        entry = self._load(key)
+        if entry == None:
+            return None
+        if entry.get('certificate') != key:
+            return None
+        # The certificate does not fix the labeling, so the cached isomorphisms only apply if they map the queried
+        # topologies onto each other
+        isomorphisms = [Permutation(nodes) for nodes in entry['isomorphisms']]
+        if not all(_is_isomorphism(topology, target_topology, isomorphism.nodes) for isomorphism in isomorphisms):
+            return None
+        return isomorphisms
+
+    def store(self, topology, target_topology, limit, isomorphisms):
+        key = self._key(topology, target_topology, limit)
+        entry = {
+            'certificate': key,
+            'isomorphisms': [isomorphism.nodes for isomorphism in isomorphisms],
+        }
+        self._entries[key] = entry
+        if self.directory == None:
+            return
+        # Failing to persist the entry is not an error, it will just be recomputed next time
+        try:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        except OSError:
+            return
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._entry_path(key))
+        except (OSError, TypeError, ValueError):
+            # Do not leave partial entries behind in the shared directory
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+
+_default_isomorphism_cache = None
+
+def default_isomorphism_cache():
+    '''
+    Returns the shared isomorphism cache persisted in the MSCCL cache directory.
+    '''
+    global _default_isomorphism_cache
+    if _default_isomorphism_cache == None:
+        _default_isomorphism_cache = IsomorphismCache(default_cache_directory('isomorphisms'))
+    return _default_isomorphism_cache
+
+def find_isomorphisms(topology, target_topology, limit=None, logging=False, backend='native', cache=None):
+    '''
+    Finds all isomorphisms from one topology to a target topology. Returns a list of permutations. The native backend
+    uses a backtracking search and the z3 backend enumerates the solutions of a Z3 encoding. Results are looked up in
+    and stored to the given IsomorphismCache.
+    '''
+    if len(topology.switches) > 0:
+        print('MSCCL Warning: Topologies with switches are not supported. import msccl will be ignored.')
+        return []
+
+    if limit != None and limit <= 0:
+        raise ValueError('MSCCL error: limit was set improperly.')
+    
+    if topology.num_nodes() != target_topology.num_nodes():
+        raise ValueError('MSCCL error: target topology does not match with the given topology.')
+
+    if cache != None and len(target_topology.switches) == 0:
+        isomorphisms = cache.lookup(topology, target_topology, limit)
+        if isomorphisms != None:
+            if logging:
+                for isomorphism in isomorphisms:
+                    print(isomorphism)
+                print(f'{len(isomorphisms)} isomorphisms found in the cache.')
+            return isomorphisms
+
+    isomorphisms = _find_isomorphisms(topology, target_topology, limit, logging, backend)
+    if cache != None and len(target_topology.switches) == 0:
+        cache.store(topology, target_topology, limit, isomorphisms)
+    return isomorphisms
+
+def find_automorphisms(topology, limit=None, logging=False, backend='native'):
+    '''
+    Finds automorphisms of a topology, i.e. permutations of its nodes that preserve all links and switches. Unlike
+    find_isomorphisms this supports topologies with switches. Returns a list of permutations.
+    '''
+    return _find_isomorphisms(topology, topology, limit, logging, backend,
+        lambda nodes: _switches_preserved(topology, topology, nodes), match_switches=True)
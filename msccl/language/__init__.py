@@ -10,6 +10,7 @@ from msccl.language.tb_assignment import *
 from msccl.language.chunk import *
 from msccl.language.buffer import *
 from msccl.language.rank_dag import *
+from msccl.language.instrumentation import LoweringProfile
 import msccl.collectives as collectives
 # from msccl.language.visualize import *
 
@@ -23,7 +24,7 @@ def _curr():
 class MSCCLProgram:
     def __init__(self, name, topo, collective, instances, protocol='Simple', \
             threadblock_policy=ThreadblockPolicy.auto, interleaved_replication=True,
-            instr_fusion=True, check_xml=True, dependence_nop=False):
+            instr_fusion=True, check_xml=True, dependence_nop=False, profile=False):
         self.name = name
         self.topo = topo
         self.collective = collective       
@@ -35,6 +36,8 @@ class MSCCLProgram:
         self.instr_fusion = instr_fusion
         self.check_xml = check_xml
         self.dependence_nop = dependence_nop
+        # Records per pass statistics of lowering when profile is set
+        self.profile = LoweringProfile(name) if profile else None
         assert protocol == 'Simple' or protocol == 'LL' or protocol == 'LL128', \
             f'Given protocol: {protocol}. Must be either Simple, LL, LL128'
         self.run_opt = True # Runs optimization passes
@@ -103,30 +106,36 @@ class MSCCLProgram:
     def check(self):
         return self.collective.check(self)
 
+    # Runs fun as the named pass, recording its statistics in self.profile if profiling
+    def run_pass(self, name, fun, *args, **kwargs):
+        if self.profile == None:
+            return fun(*args, **kwargs)
+        return self.profile.run(name, self.instr_dag, fun, *args, **kwargs)
+
     # Lower program to XML
     def lower(self):
         # self.chunk_dag._complete_metadata()
         # self.chunk_dag.channel_assignment()
         # self.chunk_dag.lower_instr_dag(self.instr_dag)
-        self.instr_dag.convert_set_list() # Pre-emptively convert sets to lists
+        self.run_pass('convert_set_list', self.instr_dag.convert_set_list) # Pre-emptively convert sets to lists
         if self.instr_fusion:
-            self.instr_dag.optimize()
-        self.instr_dag._complete_metadata()
+            self.run_pass('optimize', self.instr_dag.optimize)
+        self.run_pass('complete_metadata', self.instr_dag._complete_metadata)
         if self.threadblock_policy == ThreadblockPolicy.manual:
-            manual_assign_tbs(self.instr_dag)
+            self.run_pass('manual_assign_tbs', manual_assign_tbs, self.instr_dag)
         else:
-            auto_assign_tbs(self.instr_dag)
-        self.instr_dag.lower_pt1(self.instances)
-        gpu_prgms = self.instr_dag.lower_pt2(self.instances, self.interleaved_replication)
+            self.run_pass('auto_assign_tbs', auto_assign_tbs, self.instr_dag)
+        self.run_pass('lower_pt1', self.instr_dag.lower_pt1, self.instances)
+        gpu_prgms = self.run_pass('lower_pt2', self.instr_dag.lower_pt2, self.instances, self.interleaved_replication)
         if self.check_xml:
             # Check generated MSCCL-IR for correctness - no circular dependencies, sends and receives are ordered
-            # For very large programs, turn off check_xml when shipping 
-            check_dependency_cycles(self.instr_dag.tbs)
-            check_threadblock_ordering(self.instr_dag)
-        return Program(self.name, self.collective.name, self.collective.inplace, self.protocol, gpu_prgms)  
+            self.run_pass('check_threadblocks', check_threadblocks, self.instr_dag)
+        return Program(self.name, self.collective.name, self.collective.inplace, self.protocol, gpu_prgms,
+                       replication=self.instr_dag.replication)  
 
-    def generate_xml(self):
-        return ir_to_xml(self.lower(), dependence_nop=self.dependence_nop)
+    def generate_xml(self, file=None):
+        program = self.lower()
+        return self.run_pass('ir_to_xml', ir_to_xml, program, dependence_nop=self.dependence_nop, file=file)
     
     def print_chunk_dag(self):
         visualize_chunk_dag(self.chunk_dag.chunk_paths)
@@ -0,0 +1,82 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from msccl.language.ir import Instruction
+from msccl.language.rank_dag import visit_once
+from dataclasses import dataclass, field, asdict
+import json
+import sys
+import time
+
+try:
+    import resource
+except ImportError: # pragma: no cover
+    resource = None
+
+def _peak_rss():
+    # Peak resident set size of the process in bytes, or None where it can not be queried
+    if resource == None: # pragma: no cover
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux reports kilobytes and macOS bytes
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+def _dag_sizes(instr_dag):
+    # Counts the ops and threadblocks of all instances once threadblocks are assigned, and the ops of the DAG before
+    tbs = instr_dag.tbs
+    instances = instr_dag.replication.instances if instr_dag.replication != None else 1
+    num_tbs = sum(len(rank_tbs) for rank_tbs in tbs) * instances
+    if num_tbs > 0:
+        num_ops = sum(len(tb.ops) for rank_tbs in tbs for tb in rank_tbs.values()) * instances
+    else:
+        num_ops = sum(1 for op in visit_once(instr_dag.operations.values()) if op.inst != Instruction.start)
+    return num_ops, num_tbs
+
+@dataclass
+class PassStats:
+    name: str
+    seconds: float
+    # Growth of the peak resident set size of the process during the pass in bytes
+    peak_rss_delta: int
+    # Ops and threadblocks after the pass
+    ops: int
+    threadblocks: int
+
+@dataclass
+class LoweringProfile:
+    '''
+    Wall time, peak RSS growth and op and threadblock counts of each pass run while lowering an MSCCLProgram.
+    '''
+    program: str
+    passes: list = field(default_factory=list)
+
+    def run(self, name, instr_dag, fun, *args, **kwargs):
+        peak_before = _peak_rss()
+        start = time.perf_counter()
+        result = fun(*args, **kwargs)
+        seconds = time.perf_counter() - start
+        peak_after = _peak_rss()
+        peak_rss_delta = peak_after - peak_before if peak_before != None else None
+        ops, threadblocks = _dag_sizes(instr_dag)
+        self.passes.append(PassStats(name, seconds, peak_rss_delta, ops, threadblocks))
+        return result
+
+    def total_seconds(self):
+        return sum(p.seconds for p in self.passes)
+
+    def to_dict(self):
+        return {
+            'program': self.program,
+            'total_seconds': self.total_seconds(),
+            'passes': [asdict(p) for p in self.passes],
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict())
+
+    def table(self):
+        from tabulate import tabulate
+        rows = [(p.name, f'{p.seconds:.3f}', p.peak_rss_delta // 1024 if p.peak_rss_delta != None else '-', p.ops,
+            p.threadblocks) for p in self.passes]
+        rows.append(('total', f'{self.total_seconds():.3f}', '', '', ''))
+        return tabulate(rows, headers=['Pass', 'Time (s)', 'Peak RSS delta (KiB)', 'Ops', 'Threadblocks'])
@@ -1,10 +1,24 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+from msccl.xml_stream import write_xml_stream
 from lxml import etree as ET
 from dataclasses import dataclass, field
 from enum import Enum
 from collections import defaultdict
+import io
+
+
+@dataclass
+class Replication:
+    '''
+    How the threadblocks of a program are replicated into instances when it is lowered to XML. Instance i of a
+    threadblock uses channel i * channel_stride + its channel and instance i of an op operates on the chunks given by
+    instance_ref(ref, i) for its src and dst, so the replicated threadblocks and ops are never materialized.
+    '''
+    instances: int
+    channel_stride: int
+    instance_ref: object
 
 
 @dataclass
@@ -14,6 +28,7 @@ class Program:
     inplace: bool
     protocol: str
     gpus: list = field(default_factory=list)
+    replication: Replication = None
 
 
 @dataclass
@@ -101,6 +116,8 @@ class Buffer(Enum):
 
 @dataclass
 class ChunkRef:
+    # Slots avoid a __dict__ for each of the many references in large programs
+    __slots__ = ('rank', 'buffer', 'index', 'size')
     rank: int
     buffer: Buffer
     index: int
@@ -110,23 +127,28 @@ class ChunkRef:
         return hash((self.rank, self.buffer, self.index, self.size))
 
 
-@dataclass
 class Op:
-    inst: Instruction
-    rank: int
-    src: ChunkRef
-    dst: ChunkRef
-    depends: list = field(default_factory=list)
-    step: int = -1 # Step in the TB
-    tb: int = -1 # TB this op is assigned to
-    prev: list = field(default_factory=list) # List of instructions that happen before
-    next: list = field(default_factory=list) # List of instructions that happen after
-    num: int = -1
-    chunk_step: int = -1
-    priority: int = -1
-    recv_match =  None
-    send_match =  None
-    channel: int = -1
+    # Programs have many operations, so they are kept compact with slots instead of a dataclass with a __dict__
+    __slots__ = ('inst', 'rank', 'src', 'dst', 'depends', 'step', 'tb', 'prev', 'next', 'num', 'chunk_step',
+        'priority', 'recv_match', 'send_match', 'channel')
+
+    def __init__(self, inst, rank, src, dst, depends=None, step=-1, tb=-1, prev=None, next=None, num=-1,
+        chunk_step=-1, priority=-1, channel=-1):
+        self.inst = inst
+        self.rank = rank
+        self.src = src
+        self.dst = dst
+        self.depends = depends if depends != None else []
+        self.step = step # Step in the TB
+        self.tb = tb # TB this op is assigned to
+        self.prev = prev if prev != None else [] # List of instructions that happen before
+        self.next = next if next != None else [] # List of instructions that happen after
+        self.num = num
+        self.chunk_step = chunk_step
+        self.priority = priority
+        self.recv_match = None
+        self.send_match = None
+        self.channel = channel
 
     def cnt(self):
         if self.src:
@@ -208,41 +230,55 @@ _local_dst_insts = {Instruction.recv, Instruction.recv_copy_send, Instruction.re
                     Instruction.recv_reduce_copy_send}
 
 
-def ir_to_xml(program: Program, old_format=True, use_scratch=True, pretty_print=True, dependence_nop=False):
+def ir_to_xml(program: Program, old_format=True, use_scratch=True, pretty_print=True, dependence_nop=False, file=None):
+    replication = program.replication
+    if replication == None:
+        replication = Replication(1, 0, lambda ref, i: ref)
+    instances = replication.instances
+    def instance_ref(ref, i):
+        return replication.instance_ref(ref, i) if ref is not None else None
+
     # Figure out sizes of buffers based on usage
     buffer_sizes = defaultdict(lambda: 0)
     for gpu in program.gpus:
         for tb in gpu.threadblocks:
             for op in tb.ops:
-                if op.inst in _local_src_insts:
-                    key = (gpu.rank, op.src.buffer)
-                    buffer_sizes[key] = max(
-                        buffer_sizes[key], op.src.index + op.src.size)
-                if op.inst in _local_dst_insts:
-                    key = (gpu.rank, op.dst.buffer)
-                    buffer_sizes[key] = max(
-                        buffer_sizes[key], op.dst.index + op.dst.size)
-
+                for i in range(instances):
+                    if op.inst in _local_src_insts:
+                        src = instance_ref(op.src, i)
+                        key = (gpu.rank, src.buffer)
+                        buffer_sizes[key] = max(
+                            buffer_sizes[key], src.index + src.size)
+                    if op.inst in _local_dst_insts:
+                        dst = instance_ref(op.dst, i)
+                        key = (gpu.rank, dst.buffer)
+                        buffer_sizes[key] = max(
+                            buffer_sizes[key], dst.index + dst.size)
+
+    # Instances of threadblocks are identified by (threadblock, instance) pairs
     tb_id = {}
+    gpu_instanced_tbs = []
     # Sort threadblocks in each GPU by peers and then the channel
     # This is important as in NCCL threadblocks using the same NVLink concurrently should be close together
     for gpu in program.gpus:
-        gpu.threadblocks = sorted(gpu.threadblocks,
-                                  key=lambda tb: (tb.send, tb.recv, tb.channel))
-        for i, tb in enumerate(gpu.threadblocks):
-            tb_id[tb] = i
+        instanced_tbs = sorted([(tb, i) for i in range(instances) for tb in gpu.threadblocks],
+                               key=lambda itb: (itb[0].send, itb[0].recv, itb[1] * replication.channel_stride + itb[0].channel))
+        for idx, itb in enumerate(instanced_tbs):
+            tb_id[itb] = idx
+        gpu_instanced_tbs.append(instanced_tbs)
 
     # Filter out dependencies within the same threadblock
-    op_tb_id = {}
+    # Every instance of an op depends on the same instance of its dependencies, so this is done once for all instances
+    op_tb = {}
     for gpu in program.gpus:
         for tb in gpu.threadblocks:
             for op in tb.ops:
-                op_tb_id[op] = tb_id[tb]
+                op_tb[op] = tb
     for gpu in program.gpus:
         for tb in gpu.threadblocks:
             for op in tb.ops:
                 op.depends = list(
-                    filter(lambda dep: op_tb_id[dep] != tb_id[tb], op.depends))
+                    filter(lambda dep: op_tb[dep] is not tb, op.depends))
     # Filter out redundant dependencies
     # e.g. if op1 and op2 depend on op, and op1 happends before op2 
     # then op2 does not need to explicitly depend on op
@@ -314,7 +350,7 @@ def ir_to_xml(program: Program, old_format=True, use_scratch=True, pretty_print=
     for gpu in program.gpus:
         max_tb_channels = 0
         if len(gpu.threadblocks) > 0:
-            max_tb_channels = max(tb.channel+1 for tb in gpu.threadblocks)
+            max_tb_channels = max(tb.channel+1 for tb in gpu.threadblocks) + (instances-1) * replication.channel_stride
         nchannels = max(nchannels, max_tb_channels)
     # Generate the XML structure
     algo_elem = ET.Element('algo')
@@ -327,69 +363,75 @@ def ir_to_xml(program: Program, old_format=True, use_scratch=True, pretty_print=
     algo_elem.set('ngpus', str(len(program.gpus)))
     algo_elem.set('coll', program.collective)
     algo_elem.set('inplace', str(1 if program.inplace else 0))
-    for gpu in program.gpus:
-        gpu_elem = ET.SubElement(algo_elem, 'gpu')
-        gpu_elem.set('id', str(gpu.rank))
-        gpu_elem.set('i_chunks', str(max(buffer_sizes[(gpu.rank, Buffer.input)], gpu.input_chunks)))
-        gpu_elem.set('o_chunks', str(max(buffer_sizes[(gpu.rank, Buffer.output)], gpu.output_chunks)))
-        gpu_elem.set('s_chunks', str(max(buffer_sizes[(gpu.rank, Buffer.scratch)], gpu.scratch_size())))
-        for tb in gpu.threadblocks:
-            tb_elem = ET.SubElement(gpu_elem, 'tb')
-            tb_elem.set('id', str(tb_id[tb]))
-            tb_elem.set('send', str(tb.send))
-            tb_elem.set('recv', str(tb.recv))
-            tb_elem.set('chan', str(tb.channel))
-            for op in tb.ops:
-                op_elem = ET.SubElement(
-                    tb_elem, 'op' if not old_format else 'step')
-                op_elem.set('step' if not old_format else 's', str(op_idx[op]))
-                op_elem.set('type', str(op.inst))
-
-                # The NCCL backend currently wants scratch at the end of output
-                if not use_scratch:
-                    if op.src.buffer == Buffer.scratch:
-                        op.src.buffer = Buffer.output
-                        op.src.index += buffer_sizes[(gpu.rank, Buffer.output)]
-                    if op.dst_buffer == Buffer.scratch:
-                        op.dst.buffer = Buffer.output
-                        op.dst.index += buffer_sizes[(gpu.rank, Buffer.output)]
-
-                if old_format:
-                    if op.src is not None:
-                        op_elem.set('srcbuf', str(op.src.buffer))
-                        op_elem.set('srcoff', str(op.src.index))
-                    else:
-                        op_elem.set('srcbuf', 'i')
-                        op_elem.set('srcoff', '-1')
-                    if op.dst is not None:
-                        op_elem.set('dstbuf', str(op.dst.buffer))
-                        op_elem.set('dstoff', str(op.dst.index))
-                    else:
-                        op_elem.set('dstbuf', 'o')
-                        op_elem.set('dstoff', '-1')
-                else:
-                    if op.is_send():
-                        if op.src is not None:
-                            op_elem.set('buf', str(op.src.buffer))
-                            op_elem.set('off', str(op.src.index))
+    # The <gpu/> elements are generated and written out one at a time
+    def gpu_elems():
+        for gpu, instanced_tbs in zip(program.gpus, gpu_instanced_tbs):
+            gpu_elem = ET.Element('gpu')
+            gpu_elem.set('id', str(gpu.rank))
+            gpu_elem.set('i_chunks', str(max(buffer_sizes[(gpu.rank, Buffer.input)], gpu.input_chunks)))
+            gpu_elem.set('o_chunks', str(max(buffer_sizes[(gpu.rank, Buffer.output)], gpu.output_chunks)))
+            gpu_elem.set('s_chunks', str(max(buffer_sizes[(gpu.rank, Buffer.scratch)], gpu.scratch_size())))
+            for tb, i in instanced_tbs:
+                tb_elem = ET.SubElement(gpu_elem, 'tb')
+                tb_elem.set('id', str(tb_id[(tb, i)]))
+                tb_elem.set('send', str(tb.send))
+                tb_elem.set('recv', str(tb.recv))
+                tb_elem.set('chan', str(i * replication.channel_stride + tb.channel))
+                for op in tb.ops:
+                    op_elem = ET.SubElement(
+                        tb_elem, 'op' if not old_format else 'step')
+                    op_elem.set('step' if not old_format else 's', str(op_idx[op]))
+                    op_elem.set('type', str(op.inst))
+                    src = instance_ref(op.src, i)
+                    dst = instance_ref(op.dst, i)
+
+                    # The NCCL backend currently wants scratch at the end of output
+                    if not use_scratch:
+                        if src is not None and src.buffer == Buffer.scratch:
+                            src = ChunkRef(src.rank, Buffer.output, src.index + buffer_sizes[(gpu.rank, Buffer.output)], src.size)
+                        if dst is not None and dst.buffer == Buffer.scratch:
+                            dst = ChunkRef(dst.rank, Buffer.output, dst.index + buffer_sizes[(gpu.rank, Buffer.output)], dst.size)
+
+                    if old_format:
+                        if src is not None:
+                            op_elem.set('srcbuf', str(src.buffer))
+                            op_elem.set('srcoff', str(src.index))
+                        else:
+                            op_elem.set('srcbuf', 'i')
+                            op_elem.set('srcoff', '-1')
+                        if dst is not None:
+                            op_elem.set('dstbuf', str(dst.buffer))
+                            op_elem.set('dstoff', str(dst.index))
+                        else:
+                            op_elem.set('dstbuf', 'o')
+                            op_elem.set('dstoff', '-1')
                     else:
-                        if op.dst is not None:
-                            op_elem.set('buf', str(op.dst.buffer))
-                            op_elem.set('off', str(op.dst.index))
-                if op.cnt() > 1 or old_format:
-                    op_elem.set('cnt', str(op.cnt()))
-                assert len(op.depends) <= 1
-                if len(op.depends) == 1:
-                    op_elem.set('depid', str(op_tb_id[op.depends[0]]))
-                    op_elem.set('deps', str(op_idx[op.depends[0]]))
-                elif old_format:
-                    op_elem.set('depid', '-1')
-                    op_elem.set('deps', '-1')
-                if op in has_dependence:
-                    op_elem.set('hasdep', '1')
-                elif old_format:
-                    op_elem.set('hasdep', '0')
-
-    if pretty_print:
-        ET.indent(algo_elem, space='  ')
-    return ET.tostring(algo_elem, encoding='unicode')
+                        if op.is_send():
+                            if src is not None:
+                                op_elem.set('buf', str(src.buffer))
+                                op_elem.set('off', str(src.index))
+                        else:
+                            if dst is not None:
+                                op_elem.set('buf', str(dst.buffer))
+                                op_elem.set('off', str(dst.index))
+                    if op.cnt() > 1 or old_format:
+                        op_elem.set('cnt', str(op.cnt()))
+                    assert len(op.depends) <= 1
+                    if len(op.depends) == 1:
+                        op_elem.set('depid', str(tb_id[(op_tb[op.depends[0]], i)]))
+                        op_elem.set('deps', str(op_idx[op.depends[0]]))
+                    elif old_format:
+                        op_elem.set('depid', '-1')
+                        op_elem.set('deps', '-1')
+                    if op in has_dependence:
+                        op_elem.set('hasdep', '1')
+                    elif old_format:
+                        op_elem.set('hasdep', '0')
+            yield gpu_elem
+
+    if file != None:
+        write_xml_stream(file, algo_elem, gpu_elems(), pretty_print)
+        return None
+    out = io.StringIO()
+    write_xml_stream(out, algo_elem, gpu_elems(), pretty_print)
+    return out.getvalue()
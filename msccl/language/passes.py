@@ -4,52 +4,110 @@
 import sys
 from msccl.language.ir import *
 
-# Check that there are no cyclic dependencies within a Rank
-def check_dependency_cycles(tbs):
+# Finds every way in which the threadblocks of a program fail to run to completion, in time linear in the number of ops:
+# - the order of ops within threadblocks, their cross threadblock dependencies and sends happening before their
+#   matching receives form a cycle, which is found by Kahn's algorithm,
+# - a threadblock sends to another threadblock in a different order than that one receives, or
+# - an op depends on or is received by an op that is in no threadblock.
+# Without strict only cycles of cross threadblock dependencies are considered, as checked before lowering verified
+# whole threadblocks. Strict checking can reject programs whose threadblocks deadlock through their program order or
+# their sends and receives, which used to lower.
+# Returns a list of (kind, message) pairs describing the violations, where kind is one of 'dangling', 'match', 'order',
+# 'blocked' and 'cycle'.
+def _find_violations(tbs, strict):
+    violations = []
+    # Number the ops, keyed by id as hashing ops goes through Op.__hash__
+    ops = [op for rank_tbs in tbs for tb in rank_tbs.values() for op in tb.ops]
+    index = {id(op): i for i, op in enumerate(ops)}
+    successors = [[] for _ in ops]
+    in_degree = [0] * len(ops)
+    def add_edge(src, dst):
+        successors[index[id(src)]].append(index[id(dst)])
+        in_degree[index[id(dst)]] += 1
+
     for rank, rank_tbs in enumerate(tbs):
         for tbid, tb in rank_tbs.items():
-            for op in tb.ops:
-                deps = op.depends
-                chain = [op]
-                # DFS to check for cycles
-                while len(deps) > 0:
-                    dep = deps[0]
-                    if dep in chain:
-                        print(f"Cyclic dependency in rank {rank} threadblock {tbid} at {op}")
-                        for op in chain:
-                            print("  ", op)
-                        sys.exit(1)
-                    next_depends = dep.depends
-                    if len(next_depends) > 0:
-                        chain.append(dep)
-                    else:
-                        chain = [op]
-                    deps = next_depends + deps[1:]
+            prev_sends = {} # (rank, tbid) -> last send to that threadblock
+            for step, op in enumerate(tb.ops):
+                if step > 0 and strict:
+                    add_edge(tb.ops[step-1], op)
+                for dep in op.depends:
+                    if id(dep) not in index:
+                        violations.append(('dangling', f'Rank {rank} threadblock {tbid} has {op} depending on {dep}, which is in no threadblock'))
+                        continue
+                    add_edge(dep, op)
+                if op.is_send():
+                    match = op.recv_match
+                    if id(match) not in index:
+                        violations.append(('dangling', f'Rank {rank} threadblock {tbid} sends {op} to {match}, which is in no threadblock'))
+                        continue
+                    if match.is_recv() and op.dst.rank != match.rank:
+                        violations.append(('match', f'Rank {rank} threadblock {tbid} sends {op} to rank {op.dst.rank} but it is received by {match}'))
+                    if strict:
+                        add_edge(op, match)
+                    # Sends and their corresponding receives between two threadblocks must happen in the same order
+                    other_tb = (match.rank, match.tb)
+                    if other_tb in prev_sends and match.step <= prev_sends[other_tb].recv_match.step:
+                        violations.append(('order', f'Rank {rank} threadblock {tbid} sends {prev_sends[other_tb]} then {op} but '
+                            f'rank {match.rank} threadblock {match.tb} receives them in the opposite order'))
+                    prev_sends[other_tb] = op
+
+    frontier = [i for i, degree in enumerate(in_degree) if degree == 0]
+    num_done = 0
+    while len(frontier) > 0:
+        i = frontier.pop()
+        num_done += 1
+        for j in successors[i]:
+            in_degree[j] -= 1
+            if in_degree[j] == 0:
+                frontier.append(j)
+
+    if num_done < len(ops):
+        # Ops that were never done still have dependencies left
+        for rank, rank_tbs in enumerate(tbs):
+            for tbid, tb in rank_tbs.items():
+                blocked = next((op for op in tb.ops if in_degree[index[id(op)]] > 0), None)
+                if blocked != None:
+                    violations.append(('blocked', f'Rank {rank} threadblock {tbid} can not run past step {blocked.step}: {blocked}'))
+        # Every op that was not done waits on another one that was not done, so walking back through these must
+        # eventually repeat an op, which closes a cycle
+        predecessors = [[] for _ in ops]
+        for i, succs in enumerate(successors):
+            if in_degree[i] > 0:
+                for j in succs:
+                    predecessors[j].append(i)
+        i = next(i for i, degree in enumerate(in_degree) if degree > 0)
+        path = []
+        path_index = {}
+        while i not in path_index:
+            path_index[i] = len(path)
+            path.append(i)
+            i = predecessors[i][0]
+        cycle = path[path_index[i]:]
+        cycle.reverse()
+        violations.append(('cycle', 'Cyclic dependency:\n' + '\n'.join(f'    {ops[i]}' for i in cycle)))
+    return violations
 
+# Returns a list of messages describing every violation
+def find_threadblock_violations(tbs, strict=True):
+    return [message for _, message in _find_violations(tbs, strict)]
+
+# Checks that the threadblocks of every rank run to completion and raises an error listing every violation otherwise
+def check_threadblocks(rank_dag, strict=True):
+    violations = find_threadblock_violations(rank_dag.tbs, strict)
+    if len(violations) > 0:
+        raise RuntimeError(f'MSCCLang program has {len(violations)} ordering violations:\n' + '\n'.join(f'  {v}' for v in violations))
+
+# Check that there are no cyclic dependencies within a Rank
+# Kept for compatibility, check_threadblocks checks this and more
+def check_dependency_cycles(tbs):
+    for kind, message in _find_violations(tbs, strict=False):
+        if kind == 'cycle':
+            print(message)
+            sys.exit(1)
 
 # Check there are no ordering violations between threadblocks across ranks
+# Kept for compatibility, check_threadblocks checks this and more
 def check_threadblock_ordering(rank_dag):
-    for rank in range(rank_dag.num_ranks):
-        for tb in rank_dag.tbs[rank].values():
-            prev_steps = {} # tbid -> step of last recv from tbid
-            # Check that sends and their corresponding receives between two threadblocks
-            # happen in the same order.
-            for op_step, op in enumerate(tb.ops):
-                if op.is_send():
-                    match = op.recv_match
-                    if match.is_recv():
-                        assert op.dst.rank == match.rank, f"Bug in MSCCLang: Sends don't match receives"
-
-                    other_tbid = match.tb
-                    if other_tbid in prev_steps:
-                        if match.step <= prev_steps[other_tbid].step:
-                            print("Offending Steps", match.step, prev_steps[other_tbid].step)
-                            print("Sending tb")
-                            for op in tb.ops:
-                                print(f'{op.step}: Recv step: {op.recv_match.step if op.is_send() else -1} {op} priority:{(op.chunk_step, op.priority, op.dst.index)}')
-                            print("Receiving tb")
-                            for op in rank_dag.tbs[match.rank][other_tbid].ops:
-                                print(f'{op.step}: {op} priority:{(op.chunk_step, op.priority, op.dst.index)}')
-                            assert match.step >  prev_steps[other_tbid].step, f"Rank {op.rank} sends op1 then op2 but {match.rank} receives op2 then op1"
-                        
-                    prev_steps[other_tbid] = match
+    violations = [message for kind, message in _find_violations(rank_dag.tbs, strict=False) if kind in ('match', 'order')]
+    assert len(violations) == 0, f'Bug in MSCCLang: ' + '\n'.join(violations)
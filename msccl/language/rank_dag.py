@@ -3,6 +3,8 @@
 
 from dataclasses import dataclass
 from enum import Enum
+from collections import deque
+import bisect
 import heapq
 import functools
 
@@ -18,6 +20,85 @@ def remove_op(op):
         n.prev.remove(op)
         n.prev =  op.prev.union(n.prev)
 
+# Visits every operation reachable from the roots exactly once, in breadth first order from each root in turn. The
+# successors of an operation are read after it has been visited, so passes may rewrite op.next while visiting op.
+def visit_once(roots):
+    visited = set()
+    for root in roots:
+        frontier = deque([root])
+        while len(frontier) > 0:
+            op = frontier.popleft()
+            if op not in visited:
+                visited.add(op)
+                yield op
+                frontier.extend(op.next)
+
+# Tracks the last writer and the readers since that write for the slots of one buffer. Slots with the same history
+# share a [start, end, writer, readers] interval, kept sorted and disjoint, so an op over a contiguous range touches
+# the intervals it overlaps instead of every slot in it.
+class SlotIntervals:
+    def __init__(self):
+        self.starts = [] # Start of every interval, for bisecting
+        self.intervals = []
+
+    # Splits the interval containing index so that an interval starts at it. Returns the position of the first interval
+    # starting at or after index.
+    def _split(self, index):
+        pos = bisect.bisect_right(self.starts, index) - 1
+        if pos < 0:
+            return 0
+        start, end, writer, readers = self.intervals[pos]
+        if start == index:
+            return pos
+        if index < end:
+            self.intervals[pos][1] = index
+            self.starts.insert(pos+1, index)
+            self.intervals.insert(pos+1, [index, end, writer, list(readers)])
+        return pos+1
+
+    # Returns the positions of the intervals covering [index, index+size) and the slots in it never written before
+    def _cover(self, index, size):
+        first = self._split(index)
+        last = self._split(index+size)
+        unwritten = []
+        i = index
+        for start, end, _, _ in self.intervals[first:last]:
+            unwritten.extend(range(i, start))
+            i = end
+        unwritten.extend(range(i, index+size))
+        return first, last, unwritten
+
+    # Records a write of op, returns the ops it depends on and the slots it writes for the first time
+    def write(self, index, size, op):
+        if len(self.intervals) == 0 or index >= self.intervals[-1][1]:
+            # Past every interval, as for the start ops of a buffer
+            self.starts.append(index)
+            self.intervals.append([index, index+size, op, []])
+            return set(), list(range(index, index+size))
+        first, last, unwritten = self._cover(index, size)
+        prev_ops = set()
+        for _, _, writer, readers in self.intervals[first:last]:
+            # If there are active readers - these are the previous operations
+            # Else the previous operation is the last write
+            if len(readers) > 0:
+                prev_ops.update(readers)
+            else:
+                prev_ops.add(writer)
+        # Set the last writer to this op, and clear all readers
+        self.starts[first:last] = [index]
+        self.intervals[first:last] = [[index, index+size, op, []]]
+        return prev_ops, unwritten
+
+    # Records a read of op, returns the ops it depends on and the slots it reads that were never written
+    def read(self, index, size, op):
+        first, last, unwritten = self._cover(index, size)
+        prev_ops = set()
+        for _, _, writer, readers in self.intervals[first:last]:
+            # The previous operation for a reader is the last write to the slot
+            prev_ops.add(writer)
+            readers.append(op)
+        return prev_ops, unwritten
+
 def same_tb(op1, op2):
     return op1.tb == op2.tb and op1.channel == op2.channel
 
@@ -33,39 +114,25 @@ class InstructionDAG:
         self.buffers = buffers
         # State for the actual instruction DAG
         self.operations = {} # slot -> operations
-        self.last_writer = {} # slot -> last writing op
-        self.last_readers = defaultdict(list) # slot -> list of last reading ops
+        self.slots = defaultdict(SlotIntervals) # (rank, buffer) -> last writers and readers of its slots
         # State for the MSCCL-IR
         self.tbs = [] 
         for _ in range(num_ranks):
             self.tbs.append({}) 
         self.tb_mapping = {}
         self.num_channels = [1] * num_ranks
+        self.replication = None
 
 
     # InstructionDAG helper - identifies the dependencies for a write-type operation (recv, copy, rrc, reduce)
     def _write(self, rank, buffer, index, size, op, read=False):
-        prev_ops = set()
-        for i in range(index, index+size):
-            slot = (rank, buffer, i)
-            if read:
-                assert slot in self.last_writer, f"Destination slot has never been written before a reduce {op}"
+        prev_ops, unwritten = self.slots[(rank, buffer)].write(index, size, op)
+        if read:
+            assert len(unwritten) == 0, f"Destination slot has never been written before a reduce {op}"
 
-            # First write to this slot
-            if slot not in self.operations:
-                self.operations[slot] = op
-
-            # If there are active readers - these are the previous operations
-            # Else the previous operation is the last write (if there is one)
-            readers = self.last_readers[slot]
-            if len(readers) > 0:
-                prev_ops.update(readers)
-            elif slot in self.last_writer:
-                prev_ops.add(self.last_writer[slot])
-  
-            # Set the last_writer to this op, and clear all readers
-            self.last_writer[slot] = op
-            self.last_readers[slot] = []
+        # First write to these slots
+        for i in unwritten:
+            self.operations[(rank, buffer, i)] = op
 
         # Update the next pointer of the previous ops
         for prev_op in prev_ops:
@@ -74,15 +141,9 @@ class InstructionDAG:
 
     # InstructionDAG helper - identifies the dependencies for read-type operations (send, copy, reduce)
     def _read(self, rank, buffer, index, size, op):
-        prev_ops = set()
-        for i in range(index, index+size):
-            slot = (rank, buffer, i)
-            assert slot in self.last_writer, f"Slot has never been written before a read-type {op}"
-            # The previous operation for a reader is the last write to the slot
-            writer = self.last_writer[slot]
-            prev_ops.add(writer)
-            self.last_readers[slot].append(op)
-            
+        prev_ops, unwritten = self.slots[(rank, buffer)].read(index, size, op)
+        assert len(unwritten) == 0, f"Slot has never been written before a read-type {op}"
+
         # Update the next pointer of the previous ops
         for prev_op in prev_ops:
             prev_op.next.add(op)
@@ -93,7 +154,7 @@ class InstructionDAG:
         slot = (rank, buffer, index)
         op = Op(Instruction.start, rank, ref, ref, next=set(), prev=set(), chunk_step=-1)
         self.operations[slot] = op
-        self.last_writer[slot] = op
+        self.slots[(rank, buffer)].write(index, 1, op)
 
     # InstructionDAG - adds a copy node
     def add_copy(self, rank, send_ref, recv_ref, tb, ch):
@@ -154,52 +215,67 @@ class InstructionDAG:
         return op
 
     def convert_set_list(self):
-        ops = []
+        roots = []
         for slot, op in self.operations.items():
             if op.inst == Instruction.start:
                 op.next = list(op.next)
-                for o in op.next:
-                    ops.append(o)
+                roots.extend(op.next)
             elif op.inst != Instruction.copy:
-                ops.append(op)
-
-            visited = set()
-            while len(ops) > 0:
-                op = ops[0]
-                if op not in visited:
-                    visited.add(op)
-                    op.next = list(op.next)
-                    ops = ops[1:] + op.next
-                else:
-                    ops = ops[1:]
-                    
+                roots.append(op)
+
+        for op in visit_once(roots):
+            op.next = list(op.next)
+
     def optimize(self):
         self._optimize_rrcs_rrs()
         self._optimize_rcs()
 
     # Completes metadata for chunk_steps (number of steps from a start op) and priority (number of steps to the last op)
     def _complete_metadata(self):
-        def dfs(op, cs):
-            op.chunk_step = max(op.chunk_step, cs+1)
-
+        def successors(op):
+            if op.is_send():
+                return op.next + [op.recv_match]
+            return op.next
+
+        starts = [op for op in self.operations.values() if op.inst == Instruction.start]
+        # Order the operations reachable from a start op topologically so each is finalized once
+        in_degree = defaultdict(int)
+        visited = set(starts)
+        frontier = deque(starts)
+        while len(frontier) > 0:
+            op = frontier.popleft()
+            for o in successors(op):
+                in_degree[o] += 1
+                if o not in visited:
+                    visited.add(o)
+                    frontier.append(o)
+        order = []
+        frontier = deque(starts)
+        while len(frontier) > 0:
+            op = frontier.popleft()
+            order.append(op)
+            for o in successors(op):
+                in_degree[o] -= 1
+                if in_degree[o] == 0:
+                    frontier.append(o)
+
+        for op in starts:
+            op.chunk_step = max(op.chunk_step, -1) # Start instructions should start at -1
+        for op in order:
+            for o in successors(op):
+                o.chunk_step = max(o.chunk_step, op.chunk_step+1)
+
+        for op in reversed(order):
             if len(op.next) == 0 and op.recv_match is None:
                 op.priority = 0
             else:
-                for o in op.next:
-                    dfs(o, op.chunk_step)
                 # Priority = +1 of the highest priority child
                 if len(op.next) > 0:
                     highest_next_priority = max([x.priority+1 for x in op.next])
                     op.priority = max(highest_next_priority, op.priority)
                 if op.is_send():
-                    dfs(op.recv_match, op.chunk_step)
                     op.priority = max(op.priority, op.recv_match.priority+1)
 
-        for chunk, op in self.operations.items():
-            if op.inst == Instruction.start:
-                dfs(op,-2) # Start instructions should start at -1
-            
-        
     # Given the set of operations that operate over a particular slot (rank, buffer, idx) fixed
     # Try and replace operations with pipelined ops like receive copy send (rcs)
     # or receive reduce send (rrs) and receive reduce copy send (rrcs)
@@ -207,48 +283,40 @@ class InstructionDAG:
     # recv-copy-send 
     # recv(src, sbuf, si, _, _, _ ) send(_, _, _, dst, dbuf, di) -> recv_copy_send(src, sbuf, si, dst, dbuf, di)
     def _optimize_rcs(self):
-        for slot, ops in self.operations.items():
-            frontier = [ops]
-            while len(frontier) > 0:
-                op = frontier[0]
-                for next_op in op.next:
-                    if op.inst == Instruction.recv and next_op.inst == Instruction.send and same_tb(op, next_op) and same_count(op, next_op) and same_buf_dst(op, next_op):
-                        # recv -> rcs, remove send
-                        op.inst = Instruction.recv_copy_send
-                        op.dst = next_op.dst
-                        next_op.recv_match.send_match = op
-                        op.recv_match = next_op.recv_match
-                        remove_op(next_op)
-                        break
-                frontier = frontier[1:] + op.next
+        for op in visit_once(self.operations.values()):
+            for next_op in op.next:
+                if op.inst == Instruction.recv and next_op.inst == Instruction.send and same_tb(op, next_op) and same_count(op, next_op) and same_buf_dst(op, next_op):
+                    # recv -> rcs, remove send
+                    op.inst = Instruction.recv_copy_send
+                    op.dst = next_op.dst
+                    next_op.recv_match.send_match = op
+                    op.recv_match = next_op.recv_match
+                    remove_op(next_op)
+                    break
     # recv-reduce-send - A rrc followed by a send that gets overwritten
     # rrc(src, sbuf, si, ...) send(_, _, _, dst, dbuf, di) recv(_, _, _, dst, dbuf, di) 
     # recv-reduce-copy-send - A rrc followed by a send that does not get overwritten
     # rrc(src, sbuf, si, ...) send(_, _, _, dst, dbuf, di)
     def _optimize_rrcs_rrs(self):
         # RRC/S -> RRS
-        for slot, ops in self.operations.items():
-            frontier = [ops]
-            while len(frontier) > 0:
-                op = frontier[0]
-                if len(op.next) == 1:
-                    next_op = op.next[0]
-                    if len(next_op.next) == 1:
-                        nnext_op = next_op.next[0]
-                        if op.inst == Instruction.recv_reduce_copy and next_op.inst == Instruction.send and nnext_op.inst is Instruction.recv and same_tb(op, next_op) and same_count(op, next_op) and same_buf_dst(op, next_op):
-                            op.inst = Instruction.recv_reduce_send
-                            op.dst = next_op.dst
-                            next_op.recv_match.send_match = op
-                            op.recv_match = next_op.recv_match
-                            remove_op(next_op)
-                    
-                    if op.inst == Instruction.recv_reduce_copy and next_op.inst == Instruction.send and same_tb(op, next_op) and same_count(op, next_op) and same_buf_dst(op, next_op):
-                        op.inst = Instruction.recv_reduce_copy_send
+        for op in visit_once(self.operations.values()):
+            if len(op.next) == 1:
+                next_op = op.next[0]
+                if len(next_op.next) == 1:
+                    nnext_op = next_op.next[0]
+                    if op.inst == Instruction.recv_reduce_copy and next_op.inst == Instruction.send and nnext_op.inst is Instruction.recv and same_tb(op, next_op) and same_count(op, next_op) and same_buf_dst(op, next_op):
+                        op.inst = Instruction.recv_reduce_send
                         op.dst = next_op.dst
                         next_op.recv_match.send_match = op
                         op.recv_match = next_op.recv_match
                         remove_op(next_op)
-                frontier = frontier[1:] + op.next
+                    
+                if op.inst == Instruction.recv_reduce_copy and next_op.inst == Instruction.send and same_tb(op, next_op) and same_count(op, next_op) and same_buf_dst(op, next_op):
+                    op.inst = Instruction.recv_reduce_copy_send
+                    op.dst = next_op.dst
+                    next_op.recv_match.send_match = op
+                    op.recv_match = next_op.recv_match
+                    remove_op(next_op)
 
     def lower_pt1(self, instances):
         self.infer_dependencies()
@@ -260,21 +328,18 @@ class InstructionDAG:
 
 
     def infer_dependencies(self):
-        for slot, ops in self.operations.items():
-            frontier = [ops]
-            while len(frontier) > 0:
-                op = frontier[0]
-                # Dependencies for every op is the same as the ops that are stored in prev
-                # Filter out dependencies that are satisified by tbs executing ops sequentially
-                # If multiple dependent ops from the same tb keep the one that happens last
-                depends = {}
-                for dep_op in list(op.prev):
-                    if dep_op.inst != Instruction.start:
-                        tb = dep_op.tb
-                        if tb not in depends or dep_op.step > depends[tb].step:
-                            depends[tb] = dep_op
-                op.depends = list(depends.values())
-                frontier = frontier[1:] + op.next
+        for op in visit_once(self.operations.values()):
+            # Dependencies for every op is the same as the ops that are stored in prev
+            # Filter out dependencies that are satisified by tbs executing ops sequentially
+            # If multiple dependent ops from the same tb keep the one that happens last
+            depends = {}
+            for dep_op in list(op.prev):
+                if dep_op.inst != Instruction.start:
+                    tb = dep_op.tb
+                    if tb not in depends or dep_op.step > depends[tb].step:
+                        depends[tb] = dep_op
+            # Order by threadblock, as the extra dependencies are emitted as nops in this order and prev is a set
+            op.depends = [depends[tb] for tb in sorted(depends)]
 
     # Convert local scratch buffers to index into one global scratch buffer
     def lower_chunk(self, chunk):
@@ -294,16 +359,16 @@ class InstructionDAG:
                     offset += buf.instance_size() * instances
 
     # Preprocess the threadblocks for lowering into xml
+    # Replicated programs lower their chunks per instance when they are written out
     def lower_tbs(self):
         gpus = []
-        for rank, rank_tbs in enumerate(self.instanced_tbs):
-            lowered_tbs = {}
-            for tbid, tb in rank_tbs.items():
-                for op in tb.ops:
-                    op.src = self.lower_chunk(op.src)
-                    op.dst = self.lower_chunk(op.dst)
-                lowered_tbs[tbid] = tb
-            gpus.append(Gpu(rank, list(lowered_tbs.values())))
+        for rank, rank_tbs in enumerate(self.tbs):
+            if self.replication == None:
+                for tb in rank_tbs.values():
+                    for op in tb.ops:
+                        op.src = self.lower_chunk(op.src)
+                        op.dst = self.lower_chunk(op.dst)
+            gpus.append(Gpu(rank, list(rank_tbs.values())))
         return gpus
 
 
@@ -315,14 +380,12 @@ class InstructionDAG:
     # only interleaved replication will be correct
     # Interleaved policy only supports single count sends/receives from the input/output buffer
     # (multicount ops are fine between scratch)
+    # The instances are not materialized here: the returned Replication maps the threadblocks and ops of the program to
+    # those of each instance as the program is written out, which keeps memory proportional to a single instance.
     def replicate(self, instances, interleaved):
         if instances == 1:
-            self.instanced_tbs = self.tbs
-            return 
-
-        self.instanced_tbs = []
-        for _ in range(self.num_ranks):
-            self.instanced_tbs.append({})
+            self.replication = None
+            return
 
         def is_scratch(buffer):
             return buffer != Buffer.input and buffer != Buffer.output
@@ -339,41 +402,9 @@ class InstructionDAG:
             else:
                 return  len(self.buffers[rank][buffer]) * i + index
 
-        def get_instance_ref(ref):
+        def get_instance_ref(ref, i):
             iindex = get_new_index(ref.rank, ref.buffer, ref.index, ref.size, i)
             iref = ChunkRef(ref.rank, ref.buffer, iindex, ref.size)
-            return iref
-
-        max_channels = max(self.num_channels)
-        for i in range(instances):
-            # Generate all the threadblocks and ops
-            for rank, rank_tbs in enumerate(self.tbs):
-                # rank_channels = self.num_channels[rank]
-                for tbid, tb in rank_tbs.items():
-                    instance_channel = max_channels * i + tb.channel
-                    itb = Threadblock(instance_channel, tb.send, tb.recv)
-                    itbid = tbid * instances + i
-                    itb.ops = [None] * len(tb.ops)
-                    for s, op in enumerate(tb.ops):
-                        isrc = get_instance_ref(op.src)
-                        idst = get_instance_ref(op.dst)
-                        idepends = [] 
-                        # Note: We don't need the fill out the rest of the metadata since replication is the last optimization
-                        iop = Op(op.inst, op.rank, isrc, idst, idepends, op.step, itbid) 
-                        itb.ops[s] = iop
-                    self.instanced_tbs[op.rank][itbid] = itb
-        
-        # Redo dependency analysis
-        for rank, rank_tbs in enumerate(self.tbs):
-            for tbid, tb in rank_tbs.items():
-                for i in range(instances):
-                    itbid = tbid * instances + i
-                    itb = self.instanced_tbs[rank][itbid]
-                    for op, iop in zip(tb.ops, itb.ops):
-                        iop.depends = [None] * len(op.depends)
-                        for s, dep in enumerate(op.depends):
-                            dep_tbid = dep.tb
-                            dep_itbid = dep_tbid * instances + i
-                            dep_step = dep.step
-                            iop.depends[s] = self.instanced_tbs[op.rank][dep_itbid].ops[dep_step] 
+            return self.lower_chunk(iref)
 
+        self.replication = Replication(instances, max(self.num_channels), get_instance_ref)
@@ -1,13 +1,19 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+from msccl.xml_stream import write_xml_stream
 from lxml import etree as ET
-from collections import defaultdict
+from collections import defaultdict, deque
 from dataclasses import dataclass, field, replace
 import math
-import threading, queue, itertools, bisect
+import threading, queue, itertools, bisect, heapq
+import multiprocessing
+import io
 from enum import Enum
-from z3 import *
+
+# Below this many send and receive operations starting the worker processes and pickling the GPUs for them takes longer
+# than lowering the GPUs serially
+_MIN_PARALLEL_OPS = 16384
 
 @dataclass
 class _Gpu:
@@ -30,6 +36,8 @@ class _Threadblock:
     send: int = -1
     recv: int = -1
     steps: list = field(default_factory=list)
+    # Bitmask of the steps that the operations in steps execute in
+    occupied: int = 0
     # The steps may expand into multiple operations here
     ops: list = field(default_factory=list)
 
@@ -93,111 +101,159 @@ def _analyze_liveness(gpus, algorithm):
     
     return (input_livenesses, output_livenesses, scratch_livenesses)
 
-def _remap_scratch_into_input_output(liveness, gpus, logging):
+def _conflict(b1, b2):
+    # Check if any of the intervals in lists b1 and b2 overlap
+    return any(s1 <= e2 and s2 <= e1 for s1, e1 in b1 for s2, e2 in b2)
+
+def _allocate_scratch_intervals(rank, gpu, liveness):
     '''
-    This function solves and applies a static mapping for scratch buffer indices to input/output buffers that minimizes
-    scratch buffer usage for each GPU. The solving is done per GPU using the Z3 SMT solver.
+    Assigns each scratch index of a GPU a new index in a space with the input buffer from 0 to input_chunks-1, the
+    output buffer from input_chunks to input_chunks+output_chunks-1 and the scratch buffer for any indices past that.
+    Scratch livenesses are single intervals, so this is interval graph coloring with some colors (the input and output
+    indices) blocked at the start or the end. Intervals are colored in order of their start, which is optimal when no
+    input or output indices can be reused, and each interval takes the free index that is needed again the soonest.
+    '''
+    input_livenesses, output_livenesses, scratch_livenesses = liveness
+
+    # Inputs are live from the start and outputs until the end, so each index is summarized by the last step it is
+    # used before becoming free and the first step it is needed again
+    def summarize(intervals):
+        free_after = max((end for start, end in intervals if end != math.inf), default=-math.inf)
+        free_until = min((start for start, end in intervals if end == math.inf), default=math.inf)
+        return free_after, free_until
+    summaries = [summarize(l) for l in input_livenesses[rank]] + [summarize(l) for l in output_livenesses[rank]]
+
+    # Indices waiting to become free ordered by when they do, and free indices ordered by when they are needed
+    waiting = [(free_after, (free_until, idx)) for idx, (free_after, free_until) in enumerate(summaries)]
+    heapq.heapify(waiting)
+    free = []
+    next_scratch_idx = len(summaries)
+    new_idxs = {}
+    for addr, old_idx in sorted(gpu.scratch.items(), key=lambda x: (scratch_livenesses[rank][x[1]][0], x[1])):
+        start, end = scratch_livenesses[rank][old_idx][0]
+        while len(waiting) > 0 and waiting[0][0] < start:
+            bisect.insort(free, heapq.heappop(waiting)[1])
+        # Take the first free index that is not needed again before the end of the interval
+        i = bisect.bisect_right(free, (end, math.inf))
+        if i < len(free):
+            free_until, new_idx = free.pop(i)
+        else:
+            free_until, new_idx = math.inf, next_scratch_idx
+            next_scratch_idx += 1
+        new_idxs[addr] = new_idx
+        heapq.heappush(waiting, (end, (free_until, new_idx)))
+    return new_idxs
+
+def _optimize_scratch_remapping(rank, gpu, liveness, new_idxs):
+    '''
+    Tries to improve on a remapping of scratch indices with the Z3 SMT solver, iterating the memory bound downward
+    from the given remapping. Returns the best remapping found within a second.
+    '''
+    from z3 import Context, Solver, Int, sat, Z3Exception
+
+    input_livenesses, output_livenesses, scratch_livenesses = liveness
+
+    ctx = Context()
+    s = Solver(ctx=ctx)
+
+    def remap(idx):
+        # Choose for each scratch index a new index in one of the buffers
+        return Int(f'{idx}_remap', ctx=ctx)
+
+    # This variable limits the maximum index, in effect the size of the scratch buffer
+    idx_end = Int(f'idx_end', ctx=ctx)
+
+    for scratch_idx, scratch_liveness in enumerate(scratch_livenesses[rank]):
+        # Block any input indices that conflict with the scratch index
+        for input_idx, liveness in enumerate(input_livenesses[rank]):
+            if _conflict(scratch_liveness, liveness):
+                s.add(remap(scratch_idx) != input_idx)
+        # Block any output indices that conflict with the scratch index
+        for output_idx, liveness in enumerate(output_livenesses[rank]):
+            if _conflict(scratch_liveness, liveness):
+                s.add(remap(scratch_idx) != output_idx + gpu.input_chunks)
+        # Block remapping conflicting scratch indices to the same input/output indices
+        for other_idx, liveness in enumerate(scratch_livenesses[rank]):
+            if other_idx != scratch_idx and _conflict(liveness, scratch_liveness):
+                s.add(remap(scratch_idx) != remap(other_idx))
+        # Require all indices to fit in the allowed buffer space
+        s.add(remap(scratch_idx) >= 0)
+        s.add(remap(scratch_idx) < idx_end)
+
+    no_memory = gpu.input_chunks + gpu.output_chunks
+    used_memory = max(max(new_idxs.values(), default=-1) + 1, no_memory)
+
+    q = queue.Queue()
+    def optimize(q):
+        # Iterate the memory limit down to find a mapping that uses less scratch than the given one
+        for memory in range(used_memory - 1, no_memory - 1, -1):
+            if s.check(idx_end == memory) == sat:
+                # Remember the model for the best solution
+                try:
+                    m = s.model()
+                    q.put({addr: m[remap(old_idx)].as_long() for addr, old_idx in gpu.scratch.items()})
+                except Z3Exception:
+                    # This can happen when the solver is interrupted
+                    return
+            else:
+                return
+    t = threading.Thread(target=optimize, args=(q,))
+    t.start()
+    t.join(1)
+    ctx.interrupt()
+
+    while not q.empty():
+        new_idxs = q.get()
+    return new_idxs
+
+def _remap_scratch_into_input_output(liveness, gpus, logging, optimize=False):
+    '''
+    This function computes and applies a static mapping for scratch buffer indices to input/output buffers that
+    minimizes scratch buffer usage for each GPU. The mapping is found by interval coloring and can optionally be
+    improved on with the Z3 SMT solver.
     '''
     input_livenesses, output_livenesses, scratch_livenesses = liveness
 
     if logging:
         print('Remapping scratch into input/output...')
 
-    def conflict(b1, b2):
-        # Check if any of the intervals in lists b1 and b2 overlap
-        return any(s1 <= e2 and s2 <= e1 for s1, e1 in b1 for s2, e2 in b2)
-
-    print('Optimizing scratch mapping on all GPUs: ', end='', flush=True)
+    if optimize:
+        print('Optimizing scratch mapping on all GPUs: ', end='', flush=True)
     # Handle each GPU separately
     for rank, gpu in gpus.items():
-        ctx = Context()
-        s = Solver(ctx=ctx)
-
-        def remap(idx):
-            # Choose for each scratch index a new index in one of the buffers
-            # The index space has the input buffer from 0 to input_chunks-1,
-            # the output buffer from input_chunks to output_chunks-1,
-            # and the scratch buffer for any indices past that.
-            return Int(f'{idx}_remap', ctx=ctx)
-
-        # This variable limits the maximum index, in effect the size of the scratch buffer
-        idx_end = Int(f'idx_end', ctx=ctx)
-
-        for scratch_idx, scratch_liveness in enumerate(scratch_livenesses[rank]):
-            # Block any input indices that conflict with the scratch index
-            for input_idx, liveness in enumerate(input_livenesses[rank]):
-                if conflict(scratch_liveness, liveness):
-                    s.add(remap(scratch_idx) != input_idx)
-            # Block any output indices that conflict with the scratch index
-            for output_idx, liveness in enumerate(output_livenesses[rank]):
-                if conflict(scratch_liveness, liveness):
-                    s.add(remap(scratch_idx) != output_idx + gpu.input_chunks)
-            # Block remapping conflicting scratch indices to the same input/output indices
-            for other_idx, liveness in enumerate(scratch_livenesses[rank]):
-                if other_idx != scratch_idx and conflict(liveness, scratch_liveness):
-                    s.add(remap(scratch_idx) != remap(other_idx))
-            # Require all indices to fit in the allowed buffer space
-            s.add(remap(scratch_idx) >= 0)
-            s.add(remap(scratch_idx) < idx_end)
-
-        no_memory = gpu.input_chunks + gpu.output_chunks
-
-        q = queue.Queue()
-        def optimize(q):
-            # Iterate the memory limit down to find a mapping that minimizes scratch usage
-            for memory in range(no_memory + gpu.scratch_size(), no_memory - 1, -1):
-                if s.check(idx_end == memory) == sat:
-                    # Remember the model for the best solution
-                    try:
-                        m = s.model()
-                        new_idxs = {addr: m[remap(old_idx)].as_long() for addr, old_idx in gpu.scratch.items()}
-                        q.put(new_idxs)
-                    except Z3Exception:
-                        # This can happen when the solver is interrupted
-                        return
-                else:
-                    return
-        t = threading.Thread(target=optimize, args=(q,))
-        t.start()
-        t.join(1)
-        ctx.interrupt()
-
-        new_idxs = None
-        while not q.empty():
-            new_idxs = q.get()
-        
-        if new_idxs != None:
+        new_idxs = _allocate_scratch_intervals(rank, gpu, liveness)
+        if optimize:
+            new_idxs = _optimize_scratch_remapping(rank, gpu, liveness, new_idxs)
             print('.', end='', flush=True)
-            # Apply the model to remap the scratch indices
-            new_scratch = {}
-            new_scratch_livenesses = [[] for addr, idx in gpu.scratch.items()]
-            for addr, old_idx in gpu.scratch.items():
-                new_idx = new_idxs[addr]
-                # Figure out which buffer the index is in
-                if new_idx < gpu.input_chunks:
-                    tgt_buffer = gpu.inputs
-                    tgt_idx = new_idx
-                    tgt_liveness = input_livenesses[rank][tgt_idx]
-                elif new_idx < gpu.input_chunks + gpu.output_chunks:
-                    tgt_buffer = gpu.outputs
-                    tgt_idx = new_idx - gpu.input_chunks
-                    tgt_liveness = output_livenesses[rank][tgt_idx]
-                else:
-                    tgt_buffer = new_scratch
-                    tgt_idx = new_idx - gpu.input_chunks - gpu.output_chunks
-                    tgt_liveness = new_scratch_livenesses[tgt_idx]
-
-                # Check that the remapping doesn't conflict with any existing mappings
-                liveness = scratch_livenesses[rank][old_idx]
-                assert not conflict(tgt_liveness, liveness)
-                tgt_liveness.extend(liveness)
-
-                # Remap the scratch index to the new index in the target buffer
-                tgt_buffer[addr] = tgt_idx
-            gpu.scratch = new_scratch
-        else:
-            print('x', end='', flush=True)
-    else:
+
+        # Apply the new indices to remap the scratch indices
+        new_scratch = {}
+        new_scratch_livenesses = [[] for addr, idx in gpu.scratch.items()]
+        for addr, old_idx in gpu.scratch.items():
+            new_idx = new_idxs[addr]
+            # Figure out which buffer the index is in
+            if new_idx < gpu.input_chunks:
+                tgt_buffer = gpu.inputs
+                tgt_idx = new_idx
+                tgt_liveness = input_livenesses[rank][tgt_idx]
+            elif new_idx < gpu.input_chunks + gpu.output_chunks:
+                tgt_buffer = gpu.outputs
+                tgt_idx = new_idx - gpu.input_chunks
+                tgt_liveness = output_livenesses[rank][tgt_idx]
+            else:
+                tgt_buffer = new_scratch
+                tgt_idx = new_idx - gpu.input_chunks - gpu.output_chunks
+                tgt_liveness = new_scratch_livenesses[tgt_idx]
+
+            # Check that the remapping doesn't conflict with any existing mappings
+            scratch_liveness = scratch_livenesses[rank][old_idx]
+            assert not _conflict(tgt_liveness, scratch_liveness)
+            tgt_liveness.extend(scratch_liveness)
+
+            # Remap the scratch index to the new index in the target buffer
+            tgt_buffer[addr] = tgt_idx
+        gpu.scratch = new_scratch
+    if optimize:
         print()
 
     if logging:
@@ -283,7 +339,215 @@ class ChannelPolicy(Enum):
     def __str__(self):
         return self.value
 
-def ncclize(algorithm, remap_scratch = None, channel_policy=ChannelPolicy.MatchTopology, pretty_print = True, use_scratch=True, merge_contiguous=True, greedy_scratch_sorting=False, instances=1, logging=False):
+class ThreadblockPolicy(Enum):
+    FirstFit = 'FirstFit'
+    MinThreadblocks = 'MinThreadblocks'
+
+    def __str__(self):
+        return self.value
+
+def _step_mask(ops):
+    mask = 0
+    for op in ops:
+        mask |= 1 << op.step
+    return mask
+
+def _match_groups(send_masks, recv_masks):
+    '''
+    Finds a maximum matching between send and receive groups whose steps, given as bitmasks, are disjoint. Returns the
+    index of the receive group matched to each send group or None for unmatched send groups.
+    '''
+    send_matches = [None] * len(send_masks)
+    recv_matches = [None] * len(recv_masks)
+    for root in range(len(send_masks)):
+        # Search breadth-first for an alternating path from the send group to an unmatched receive group
+        reached_from = {}
+        pending = deque([root])
+        end = None
+        while len(pending) > 0 and end == None:
+            send_idx = pending.popleft()
+            for recv_idx, recv_mask in enumerate(recv_masks):
+                if not recv_idx in reached_from and send_masks[send_idx] & recv_mask == 0:
+                    reached_from[recv_idx] = send_idx
+                    if recv_matches[recv_idx] == None:
+                        end = recv_idx
+                        break
+                    pending.append(recv_matches[recv_idx])
+        # Augment the matching along the path
+        recv_idx = end
+        while recv_idx != None:
+            send_idx = reached_from[recv_idx]
+            next_recv_idx = send_matches[send_idx]
+            send_matches[send_idx] = recv_idx
+            recv_matches[recv_idx] = send_idx
+            recv_idx = next_recv_idx
+    return send_matches
+
+def _lower_gpu(rank, gpu, tb_groups, use_scratch, threadblock_policy):
+    '''
+    Groups the operations of a GPU into threadblocks, resolves their dependencies and returns the <gpu> element.
+    '''
+    tbs_by_chan = defaultdict(list)
+    def add_group(tb, key, grp, steps):
+        _, is_send, peer, chan = key
+        # Ensure the peer is set correctly
+        if is_send:
+            assert tb.send == -1 or tb.send == peer
+            tb.send = peer
+        else:
+            assert tb.recv == -1 or tb.recv == peer
+            tb.recv = peer
+        tb.steps.extend(grp)
+        assert tb.occupied & steps == 0
+        tb.occupied |= steps
+
+    # Each group has a distinct peer, so a threadblock can take a group only if the slot for its direction is free
+    # and none of its steps is already occupied
+    if threadblock_policy == ThreadblockPolicy.FirstFit:
+        # Threadblocks with a free send or receive slot on each channel in order of creation
+        free_tbs = defaultdict(list)
+        # For each group find or create a threadblock to add them to
+        for key, grp in tb_groups:
+            _, is_send, peer, chan = key
+            steps = _step_mask(grp)
+            candidates = free_tbs[(chan, is_send)]
+            for i, tb in enumerate(candidates):
+                if tb.occupied & steps == 0:
+                    del candidates[i]
+                    break
+            else:
+                # No existing threadblock was suitble, so create a new one
+                tb = _Threadblock(chan)
+                tbs_by_chan[chan].append(tb)
+                free_tbs[(chan, not is_send)].append(tb)
+            add_group(tb, key, grp, steps)
+    elif threadblock_policy == ThreadblockPolicy.MinThreadblocks:
+        # Every threadblock holds at most one send and one receive group, so pairing up as many groups as possible
+        # minimizes the number of threadblocks
+        groups_by_chan = defaultdict(lambda: ([], []))
+        for key, grp in tb_groups:
+            _, is_send, peer, chan = key
+            groups_by_chan[chan][0 if is_send else 1].append((key, grp, _step_mask(grp)))
+        for chan, (send_groups, recv_groups) in groups_by_chan.items():
+            matches = _match_groups([steps for key, grp, steps in send_groups], [steps for key, grp, steps in recv_groups])
+            matched_recvs = set()
+            for send_group, recv_idx in zip(send_groups, matches):
+                tb = _Threadblock(chan)
+                tbs_by_chan[chan].append(tb)
+                add_group(tb, *send_group)
+                if recv_idx != None:
+                    add_group(tb, *recv_groups[recv_idx])
+                    matched_recvs.add(recv_idx)
+            for recv_idx, recv_group in enumerate(recv_groups):
+                if not recv_idx in matched_recvs:
+                    tb = _Threadblock(chan)
+                    tbs_by_chan[chan].append(tb)
+                    add_group(tb, *recv_group)
+    else:
+        assert False, 'Unhandled threadblock policy'
+
+    # Sort threadblocks by peers and then the channel
+    # This is important as in NCCL threadblocks using the same NVLink concurrently should be close together
+    gpu.threadblocks = sorted([tb for tbs in tbs_by_chan.values() for tb in tbs],
+        key=lambda tb: (tb.send, tb.recv, tb.channel))
+    for i, tb in enumerate(gpu.threadblocks):
+        tb.rbid = i
+
+    # Add all copies into an extra threadblock
+    cpy_tb = _Threadblock(0)
+    cpy_tb.rbid = len(gpu.threadblocks)
+    cpy_tb.steps = gpu.precopies + gpu.postcopies
+    gpu.threadblocks.append(cpy_tb)
+
+    # Filter out dependencies within the same threadblock and mark all ops that have a dependence on them
+    for tb in gpu.threadblocks:
+        for op in tb.steps:
+            op.block_rbid = tb.rbid
+    for tb in gpu.threadblocks:
+        for op in tb.steps:
+            op.depends = list(filter(lambda d: d.block_rbid != op.block_rbid, op.depends))
+            for dep in op.depends:
+                dep.has_dependence = True
+
+    # Do some additional postprocessing of operations:
+    # - Expand operations with extra dependencies with no-ops
+    # - Mark the index of each operation taking any extra no-ops into account
+    for tb in gpu.threadblocks:
+        tb.steps.sort(key=lambda op: op.step)
+        for op in tb.steps:
+            # Expand extra dependencies into nop operations
+            if len(op.depends) > 1:
+                extra_deps = op.depends[1:]
+                op.depends = op.depends[:1]
+                first_step = op.step
+                for i, dep in enumerate(extra_deps):
+                    tb.ops.append(_Op(op.gpu, None, op.step, False, 'nop', None, None, None, None, 0, [dep]))
+                    tb.ops[-1].idx = len(tb.ops) - 1
+            tb.ops.append(op)
+            tb.ops[-1].idx = len(tb.ops) - 1
+
+    gpu_elem = ET.Element('gpu')
+    gpu_elem.set('id', str(rank))
+    gpu_elem.set('i_chunks', str(gpu.input_chunks))
+    gpu_elem.set('o_chunks', str(gpu.output_chunks))
+    gpu_elem.set('s_chunks', str(gpu.scratch_size()))
+    for tb in gpu.threadblocks:
+        tb_elem = ET.SubElement(gpu_elem, 'tb')
+        tb_elem.set('id', str(tb.rbid))
+        tb_elem.set('send', str(tb.send))
+        tb_elem.set('recv', str(tb.recv))
+        tb_elem.set('chan', str(tb.channel))
+        for op in tb.ops:
+            op_elem = ET.SubElement(tb_elem, 'step')
+            op_elem.set('s', str(op.idx))
+            op_elem.set('type', op.op_type)
+
+            # The NCCL backend currently wants scratch at the end of output
+            if not use_scratch:
+                if op.src_buffer == 's':
+                    op.src_buffer = 'o'
+                    op.src_offset += gpu.output_chunks
+                if op.dst_buffer == 's':
+                    op.dst_buffer = 'o'
+                    op.dst_offset += gpu.output_chunks
+
+            if op.src_buffer is not None:
+                op_elem.set('srcbuf', op.src_buffer)
+                op_elem.set('srcoff', str(op.src_offset))
+            else:
+                op_elem.set('srcbuf', 'i')
+                op_elem.set('srcoff', '-1')
+            if op.dst_buffer is not None:
+                op_elem.set('dstbuf', op.dst_buffer)
+                op_elem.set('dstoff', str(op.dst_offset))
+            else:
+                op_elem.set('dstbuf', 'o')
+                op_elem.set('dstoff', '-1')
+            op_elem.set('cnt', str(op.cnt))
+            assert len(op.depends) <= 1
+            if len(op.depends) == 1:
+                op_elem.set('depid', str(op.depends[0].block_rbid))
+                op_elem.set('deps', str(op.depends[0].idx))
+            else:
+                op_elem.set('depid', '-1')
+                op_elem.set('deps', '-1')
+            if op.has_dependence:
+                op_elem.set('hasdep', '1')
+            else:
+                op_elem.set('hasdep', '0')
+    return gpu_elem
+
+def _lower_gpu_args(rank, gpu, tb_groups, use_scratch, threadblock_policy):
+    # Dependencies only point to earlier steps except for those of postcopies. Listing the operations in that order
+    # first lets pickle memoize dependencies before they are referenced, instead of recursing through long chains.
+    ops = sorted((op for key, grp in tb_groups for op in grp), key=lambda op: op.step)
+    return (gpu.precopies + ops + gpu.postcopies, rank, gpu, tb_groups, use_scratch, threadblock_policy)
+
+def _lower_gpu_to_xml(args):
+    ops, rank, gpu, tb_groups, use_scratch, threadblock_policy = args
+    return ET.tostring(_lower_gpu(rank, gpu, tb_groups, use_scratch, threadblock_policy), encoding='unicode')
+
+def ncclize(algorithm, remap_scratch = None, channel_policy=ChannelPolicy.MatchTopology, pretty_print = True, use_scratch=True, merge_contiguous=True, greedy_scratch_sorting=False, instances=1, optimize_scratch_remap=False, workers=None, threadblock_policy=ThreadblockPolicy.FirstFit, file=None, logging=False):
     '''
     Generate the XML format used by the NCCL MSCCL backend.
 
@@ -296,10 +560,24 @@ def ncclize(algorithm, remap_scratch = None, channel_policy=ChannelPolicy.MatchT
     named buffers, "input", "output" and "scratch", based on whether the address appears in a particular rank's
     precondition, postcondition or neither. For addresses that would be in both the input and output buffers <copy/>
     tags are created to mark an initial transfer to the output buffer and only the output buffer mapping is kept.
+
+    Threadblocks are packed according to threadblock_policy. FirstFit adds the operations for each peer to the first
+    threadblock they fit in, while MinThreadblocks pairs them up to use as few threadblocks as possible.
+
+    With workers set, threadblocks and <gpu/> elements are generated for each GPU in a pool of that many processes.
+    The output is the same as without workers. Only this last part of the lowering runs in parallel, while assigning
+    buffers and tracking dependencies stays serial, so workers help only for large algorithms, e.g. ones with
+    thousands of sends over dozens of GPUs. Algorithms with fewer than 16384 send and receive operations in total
+    are lowered serially even if workers is set.
+
+    The XML is returned as a string, unless file is set, in which case it is written to that text file handle one
+    <gpu/> element at a time instead.
     '''
 
     if algorithm.is_pipelined():
         raise ValueError('Pipelining is not supported.')
+    if workers != None and workers < 1:
+        raise ValueError('workers must be strictly positive.')
 
     if remap_scratch is None:
         if algorithm.instance.extra_memory != None:
@@ -333,7 +611,7 @@ def ncclize(algorithm, remap_scratch = None, channel_policy=ChannelPolicy.MatchT
     if remap_scratch:
         # Analyze liveness of indices in buffers and remap scratch into input/output as possible
         liveness = _analyze_liveness(gpus, algorithm)
-        _remap_scratch_into_input_output(liveness, gpus, logging)
+        _remap_scratch_into_input_output(liveness, gpus, logging, optimize=optimize_scratch_remap)
     elif greedy_scratch_sorting:
         _greedy_scratch_sort(algorithm, gpus)
     else:
@@ -552,139 +830,42 @@ def ncclize(algorithm, remap_scratch = None, channel_policy=ChannelPolicy.MatchT
         for op in chan_ops:
             tb_groups[(op.gpu, op.is_send, op.peer, chan)].append(op)
 
-    tbs_by_gpu_chan = defaultdict(lambda: defaultdict(list))
-    # For each group find or create a threadblock to add them to
+    # Dependencies never cross GPUs, so the rest of the lowering is done for each GPU separately
+    tb_groups_by_gpu = defaultdict(list)
     for key, grp in tb_groups.items():
-        rank, is_send, peer, chan = key
-        tbs = tbs_by_gpu_chan[rank][chan]
-        for tb in tbs:
-            tb_peer = tb.send if is_send else tb.recv
-            # An existing threadblock can be reused if:
-            # - Either the relevant peer is not set yet or the peer is the same
-            # - No operations already in the threadblock execute in the same step
-            if tb_peer == -1 or tb_peer == peer:
-                if all(not any(op1.step == op2.step for op2 in grp) for op1 in tb.steps):
-                    break
-        else:
-            # No existing threadblock was suitble, so create a new one
-            tb = _Threadblock(chan)
-            tbs.append(tb)
-        # Ensure the peer is set correctly
-        if is_send:
-            assert tb.send == -1 or tb.send == peer
-            tb.send = peer
-        else:
-            assert tb.recv == -1 or tb.recv == peer
-            tb.recv = peer
-        tb.steps.extend(grp)
-
-    # Sort threadblocks in each GPU by peers and then the channel
-    # This is important as in NCCL threadblocks using the same NVLink concurrently should be close together
-    for rank, gpu in gpus.items():
-        gpu.threadblocks = sorted([tb for tbs in tbs_by_gpu_chan[rank].values() for tb in tbs],
-            key=lambda tb: (tb.send, tb.recv, tb.channel))
-        for i, tb in enumerate(gpu.threadblocks):
-            tb.rbid = i
-
-    # Add all copies into extra threadblocks
-    for rank, gpu in gpus.items():
-        cpy_tb = _Threadblock(0)
-        cpy_tb.rbid = len(gpu.threadblocks)
-        cpy_tb.steps = gpu.precopies + gpu.postcopies
-        gpu.threadblocks.append(cpy_tb)
-
-    # Filter out dependencies within the same threadblock and mark all ops that have a dependence on them
-    for rank, gpu in gpus.items():
-        for tb in gpu.threadblocks:
-            for op in tb.steps:
-                op.block_rbid = tb.rbid
-    for rank, gpu in gpus.items():
-        for tb in gpu.threadblocks:
-            for op in tb.steps:
-                op.depends = list(filter(lambda d: d.block_rbid != op.block_rbid, op.depends))
-                for dep in op.depends:
-                    dep.has_dependence = True
-
-    # Do some additional postprocessing of operations:
-    # - Expand operations with extra dependencies with no-ops
-    # - Mark the index of each operation taking any extra no-ops into account
-    for rank, gpu in gpus.items():
-        for tb in gpu.threadblocks:
-            tb.steps.sort(key=lambda op: op.step)
-            for op in tb.steps:
-                # Expand extra dependencies into nop operations
-                if len(op.depends) > 1:
-                    extra_deps = op.depends[1:]
-                    op.depends = op.depends[:1]
-                    first_step = op.step
-                    for i, dep in enumerate(extra_deps):
-                        tb.ops.append(_Op(op.gpu, None, op.step, False, 'nop', None, None, None, None, 0, [dep]))
-                        tb.ops[-1].idx = len(tb.ops) - 1
-                tb.ops.append(op)
-                tb.ops[-1].idx = len(tb.ops) - 1
+        tb_groups_by_gpu[key[0]].append((key, grp))
 
     # Generate the XML structure
     algo_elem = ET.Element('algo')
     algo_elem.set('name', algorithm.name)
     algo_elem.set('proto', 'Simple')
-    nchannels = 1 + max(max(tb.channel for tb in gpu.threadblocks) for gpu in gpus.values())
+    nchannels = 1 + max((chan for rank, is_send, peer, chan in tb_groups), default=0)
     algorithm.nchannels = nchannels
     algo_elem.set('nchannels', str(nchannels))
     algo_elem.set('ngpus', str(len(gpus)))
     algo_elem.set('inplace', '0')
     algo_elem.set('coll', algorithm.collective.runtime_name)
     algo_elem.set('nchunksperloop', str(max(max(gpu.input_chunks, gpu.output_chunks) for gpu in gpus.values())))
-    for rank, gpu in gpus.items():
-        gpu_elem = ET.SubElement(algo_elem, 'gpu')
-        gpu_elem.set('id', str(rank))
-        gpu_elem.set('i_chunks', str(gpu.input_chunks))
-        gpu_elem.set('o_chunks', str(gpu.output_chunks))
-        gpu_elem.set('s_chunks', str(gpu.scratch_size()))
-        for tb in gpu.threadblocks:
-            tb_elem = ET.SubElement(gpu_elem, 'tb')
-            tb_elem.set('id', str(tb.rbid))
-            tb_elem.set('send', str(tb.send))
-            tb_elem.set('recv', str(tb.recv))
-            tb_elem.set('chan', str(tb.channel))
-            for op in tb.ops:
-                op_elem = ET.SubElement(tb_elem, 'step')
-                op_elem.set('s', str(op.idx))
-                op_elem.set('type', op.op_type)
-
-                # The NCCL backend currently wants scratch at the end of output
-                if not use_scratch:
-                    if op.src_buffer == 's':
-                        op.src_buffer = 'o'
-                        op.src_offset += gpu.output_chunks
-                    if op.dst_buffer == 's':
-                        op.dst_buffer = 'o'
-                        op.dst_offset += gpu.output_chunks
-
-                if op.src_buffer is not None:
-                    op_elem.set('srcbuf', op.src_buffer)
-                    op_elem.set('srcoff', str(op.src_offset))
-                else:
-                    op_elem.set('srcbuf', 'i')
-                    op_elem.set('srcoff', '-1')
-                if op.dst_buffer is not None:
-                    op_elem.set('dstbuf', op.dst_buffer)
-                    op_elem.set('dstoff', str(op.dst_offset))
-                else:
-                    op_elem.set('dstbuf', 'o')
-                    op_elem.set('dstoff', '-1')
-                op_elem.set('cnt', str(op.cnt))
-                assert len(op.depends) <= 1
-                if len(op.depends) == 1:
-                    op_elem.set('depid', str(op.depends[0].block_rbid))
-                    op_elem.set('deps', str(op.depends[0].idx))
-                else:
-                    op_elem.set('depid', '-1')
-                    op_elem.set('deps', '-1')
-                if op.has_dependence:
-                    op_elem.set('hasdep', '1')
-                else:
-                    op_elem.set('hasdep', '0')
-
-    if pretty_print:
-        ET.indent(algo_elem, space='  ')
-    return ET.tostring(algo_elem, encoding='unicode')
+    num_ops = sum(len(grp) for grp in tb_groups.values())
+    parallel = workers != None and workers > 1 and len(gpus) > 1 and num_ops >= _MIN_PARALLEL_OPS
+    if workers != None and num_ops < _MIN_PARALLEL_OPS and logging:
+        print(f'Lowering GPUs serially as {num_ops} operations are too few to benefit from worker processes')
+    def gpu_elems():
+        if parallel:
+            if logging:
+                print(f'Lowering GPUs in {workers} worker processes')
+            with multiprocessing.Pool(min(workers, len(gpus))) as pool:
+                args = (_lower_gpu_args(rank, gpu, tb_groups_by_gpu[rank], use_scratch, threadblock_policy) for rank, gpu in gpus.items())
+                for gpu_xml in pool.imap(_lower_gpu_to_xml, args):
+                    yield ET.fromstring(gpu_xml)
+        else:
+            for rank, gpu in gpus.items():
+                yield _lower_gpu(rank, gpu, tb_groups_by_gpu[rank], use_scratch, threadblock_policy)
+
+    # The <gpu/> elements are written out as they are generated
+    if file != None:
+        write_xml_stream(file, algo_elem, gpu_elems(), pretty_print)
+        return None
+    out = io.StringIO()
+    write_xml_stream(out, algo_elem, gpu_elems(), pretty_print)
+    return out.getvalue()
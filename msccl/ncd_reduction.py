@@ -23,11 +23,8 @@ def non_combining_dual(primal):
     for chunk in primal.chunks():
         addr = primal.address(chunk)
         addresses.add(addr)
-        for rank in primal.ranks():
-            if primal.postcondition(rank, chunk):
-                dual_precondition[addr].add(rank)
-            if primal.precondition(rank, chunk):
-                dual_postcondition[addr].add(rank)
+        dual_precondition[addr].update(primal.postcondition_ranks(chunk))
+        dual_postcondition[addr].update(primal.precondition_ranks(chunk))
     for addr in dual_precondition:
         if len(dual_precondition[addr]) > 1:
             raise ReductionNotApplicableError('The non-combining reduction is only applicable to collectives with a unique root per address.')
@@ -45,7 +42,7 @@ def recover_primal_algorithm(dual_algorithm, primal, original_topology, instance
 
 def wrap_try_ncd_reduction(solver_cls):
     class NonCombiningReductionWrapper(solver_cls):
-        def __init__(self, topology, collective):
+        def __init__(self, topology, collective, **kwargs):
             self.primal = collective
             try:
                 # Create the dual collective
@@ -57,7 +54,7 @@ def wrap_try_ncd_reduction(solver_cls):
                 topology = reverse_topology(topology)
             except ReductionNotApplicableError:
                 self.dual = None
-            super().__init__(topology, collective)
+            super().__init__(topology, collective, **kwargs)
 
         def solve(self, instance):
             algo = super().solve(instance)
@@ -3,6 +3,7 @@
 
 from msccl.algorithm import *
 from msccl.ncd_reduction import wrap_try_ncd_reduction
+from msccl.isomorphisms import find_automorphisms
 from z3 import *
 
 from collections import defaultdict
@@ -32,20 +33,66 @@ def _addr_start(addr, rank):
 def _addr_end(addr, rank):
     return Int(f'addr_end_{addr}_at_{rank}')
 
+# Number of variables compared by each lex-leader symmetry breaking constraint
+_LEX_LEADER_LENGTH = 64
+
+def _lex_eq(sym, i):
+    return Bool(f'lex_{sym}_eq_upto_{i}')
+
+def _collective_symmetries(collective, automorphisms):
+    # Lifts topology automorphisms to symmetries of the collective. Each symmetry is a pair of a rank permutation and a
+    # chunk permutation, such that the permuted chunks have the permuted pre- and postconditions and chunks at the same
+    # address are still at the same address.
+    chunks_by_conditions = defaultdict(list)
+    for chunk in collective.chunks():
+        pre = frozenset(collective.precondition_ranks(chunk))
+        post = frozenset(collective.postcondition_ranks(chunk))
+        chunks_by_conditions[(pre, post)].append(chunk)
+
+    symmetries = []
+    for automorphism in automorphisms:
+        ranks = automorphism.nodes
+        if all(rank == mapped for rank, mapped in enumerate(ranks)):
+            continue
+        chunk_perm = {}
+        for (pre, post), chunks in chunks_by_conditions.items():
+            mapped_key = (frozenset(ranks[rank] for rank in pre), frozenset(ranks[rank] for rank in post))
+            mapped_chunks = chunks_by_conditions.get(mapped_key, [])
+            if len(mapped_chunks) != len(chunks):
+                break
+            # Chunks with identical conditions (e.g. from chunking up) are mapped in order
+            chunk_perm.update(zip(chunks, mapped_chunks))
+        else:
+            # The induced mapping of addresses must be a bijection
+            addr_perm = {}
+            for chunk, mapped in chunk_perm.items():
+                addr_perm.setdefault(collective.address(chunk), set()).add(collective.address(mapped))
+            if all(len(mapped) == 1 for mapped in addr_perm.values()) and \
+                len(set(next(iter(mapped)) for mapped in addr_perm.values())) == len(addr_perm):
+                symmetries.append((ranks, chunk_perm))
+    return symmetries
+
 class PathEncodingBase(object):
-    def __init__(self, topology, collective):
+    def __init__(self, topology, collective, incremental=False, symmetry_breaking=False, max_symmetries=16):
         self.topology = topology
         self.collective = collective
+        # In incremental mode the step independent part of the encoding is kept in a solver per chunking and memory
+        # configuration, and only the step dependent part is pushed and popped for each instance solved
+        self.incremental = incremental
+        self._solvers = {}
+        # With symmetry breaking up to max_symmetries automorphisms of the topology are used to prune solutions that
+        # are equivalent up to a renaming of the ranks. This mostly speeds up proving unsatisfiability.
+        self.symmetry_breaking = symmetry_breaking
+        self.max_symmetries = max_symmetries
+        self._automorphisms = None
 
     def _encode(self, s, instance, collective):
-        # Calculate how much iterations of the algorithm overlap if pipelining is specified
-        if instance.pipeline != None:
-            # TODO: move this check into Instance
-            if instance.pipeline <= 0:
-                raise ValueError('instance.pipeline must be strictly positive.')
-            overlap = max(instance.steps - instance.pipeline, 0)
-        else:
-            overlap = 0
+        self._encode_static(s, instance, collective)
+        self._encode_steps(s, instance, collective)
+
+    def _encode_static(self, s, instance, collective):
+        # Encodes the constraints that do not depend on the number of steps, rounds or pipelining. These only depend on
+        # instance.chunks (through collective), whether extra_memory is set and allow_exchange.
 
         # Correctness
         for chunk in collective.chunks():
@@ -54,13 +101,6 @@ class PathEncodingBase(object):
                     # Have chunks start on their starting ranks before the first step
                     # This is not required for the encoding, but makes debugging the models produced more intuitive
                     s.add(_start(chunk, rank) == 0)
-                else:
-                    # Any rank that gets a chunk (and doesn't start with it) must have a unique source for it
-                    sent_once = PbEq([(_send(chunk, src, rank), 1) for src in self.topology.sources(rank)], 1)
-                    s.add(Implies(_start(chunk, rank) <= instance.steps, sent_once))
-                # If the postcondition requires the chunk on the rank then it must start being there before the end
-                if collective.postcondition(rank, chunk):
-                    s.add(_start(chunk, rank) <= instance.steps)
                 for src in self.topology.sources(rank):
                     # If a rank send a chunk then it needs to have it before sending it
                     s.add(Implies(_send(chunk, src, rank), _start(chunk, src) < _start(chunk, rank)))
@@ -87,6 +127,114 @@ class PathEncodingBase(object):
                         s.add(Implies(_send(chunk, src, rank),
                             And(_send(trigger, rank, src), _start(trigger, src) == _start(chunk, rank))))
 
+        # Memory
+        if instance.extra_memory != None:
+            # On ranks outside the postcondition the chunk can stop being on the rank any time after its start
+            for chunk in collective.chunks():
+                for rank in collective.ranks():
+                    if not collective.postcondition(rank, chunk):
+                        s.add(_end(chunk, rank) >= _start(chunk, rank))
+
+            for rank in collective.ranks():
+                addresses, input_addresses, output_addresses = self._addresses(collective, rank)
+                # Enforce the address start-end intervals to contain all the chunk start-end intervals
+                for chunk in collective.chunks():
+                    addr = collective.address(chunk)
+                    s.add(_addr_start(addr, rank) <= _start(chunk, rank))
+                    s.add(_addr_end(addr, rank) >= _end(chunk, rank))
+
+                # Statically allocate indices for addresses in the input and output buffers
+                next_idx = 0
+                for addr in sorted(input_addresses):
+                    # Allocate addresses that are both input and output in the output portion
+                    if addr not in output_addresses:
+                        s.add(_idx(addr, rank) == next_idx)
+                        next_idx += 1
+                for addr in sorted(output_addresses):
+                    s.add(_idx(addr, rank) == next_idx)
+                    next_idx += 1
+
+                def conflict(addr1, addr2):
+                    s1 = _addr_start(addr1, rank)
+                    s2 = _addr_start(addr2, rank)
+                    e1 = _addr_end(addr1, rank)
+                    e2 = _addr_end(addr2, rank)
+                    if not instance.allow_exchange:
+                        # Without exhanges the index has to be reserved for the states before and after the interval
+                        # (The correctness part of the encoding allows chunks to "hop" from one rank to the next
+                        # without overlap)
+                        s1 = s1 - 1
+                        s2 = s2 - 1
+                        e1 = e1 + 1
+                        e2 = e2 + 1
+                    # There is a conflict if the intervals overlap
+                    return And(s1 < e2, s2 < e1)
+
+                # Add constraints for allocating indices for all the addresses just passing through the rank
+                for addr in (addresses - input_addresses) - output_addresses:
+                    for other in addresses:
+                        if other != addr:
+                            # If two addresses have the same index they have to have non-conflicting liveness intervals
+                            s.add(Implies(_idx(addr, rank) == _idx(other, rank), Not(conflict(addr, other))))
+
+        # Symmetry breaking
+        if self.symmetry_breaking:
+            self._encode_symmetry_breaking(s, collective)
+
+    def _encode_symmetry_breaking(self, s, collective):
+        # Triggers relate specific chunks on specific ranks, which the symmetries below do not account for
+        if collective.has_triggers():
+            return
+        if self._automorphisms == None:
+            # Prefer automorphisms moving few ranks, as their lex-leader constraints are the most local
+            automorphisms = find_automorphisms(self.topology, limit=4 * self.max_symmetries)
+            automorphisms.sort(key=lambda perm: sum(1 for rank, mapped in enumerate(perm.nodes) if rank != mapped))
+            self._automorphisms = automorphisms[:self.max_symmetries + 1]
+
+        edges = [(src, dst) for dst in self.topology.nodes() for src in self.topology.sources(dst)]
+        for sym, (ranks, chunks) in enumerate(_collective_symmetries(collective, self._automorphisms)):
+            # Lex-leader constraint: the sends of a solution must be lexicographically less or equal to those of its
+            # image under the symmetry. Of all solutions equivalent under the symmetry at least the lexicographically
+            # least one remains. Variables mapped to themselves are always equal and are left out.
+            pairs = []
+            for chunk in collective.chunks():
+                for src, dst in edges:
+                    send = _send(chunk, src, dst)
+                    image = _send(chunks[chunk], ranks[src], ranks[dst])
+                    if not eq(send, image):
+                        pairs.append((send, image))
+            # Any prefix of the lex-leader constraint is sound, and the full one slows down the solver
+            pairs = pairs[:_LEX_LEADER_LENGTH]
+
+            prefix_eq = BoolVal(True)
+            for i, (send, image) in enumerate(pairs):
+                s.add(Implies(prefix_eq, Implies(send, image)))
+                s.add(_lex_eq(sym, i) == And(prefix_eq, send == image))
+                prefix_eq = _lex_eq(sym, i)
+
+    def _encode_steps(self, s, instance, collective):
+        # Encodes the constraints that depend on the number of steps, rounds, pipelining or the memory limit
+
+        # Calculate how much iterations of the algorithm overlap if pipelining is specified
+        if instance.pipeline != None:
+            # TODO: move this check into Instance
+            if instance.pipeline <= 0:
+                raise ValueError('instance.pipeline must be strictly positive.')
+            overlap = max(instance.steps - instance.pipeline, 0)
+        else:
+            overlap = 0
+
+        # Correctness
+        for chunk in collective.chunks():
+            for rank in collective.ranks():
+                if not collective.precondition(rank, chunk):
+                    # Any rank that gets a chunk (and doesn't start with it) must have a unique source for it
+                    sent_once = PbEq([(_send(chunk, src, rank), 1) for src in self.topology.sources(rank)], 1)
+                    s.add(Implies(_start(chunk, rank) <= instance.steps, sent_once))
+                # If the postcondition requires the chunk on the rank then it must start being there before the end
+                if collective.postcondition(rank, chunk):
+                    s.add(_start(chunk, rank) <= instance.steps)
+
         # Rounds
         # Each step must use at least one round of bandwidth
         s.add(*[_rounds(step) >= 1 for step in range(instance.steps)])
@@ -121,79 +269,64 @@ class PathEncodingBase(object):
 
         # Memory
         if instance.extra_memory != None:
-            # Choose the last step a chunk is present on a rank
+            # In the postcondition the chunk can not stop being on the rank before the end of the algorithm
             for chunk in collective.chunks():
                 for rank in collective.ranks():
                     if collective.postcondition(rank, chunk):
-                        # In the postcondition the chunk can not stop being on the rank before the end of the algorithm
                         s.add(_end(chunk, rank) > instance.steps)
-                    else:
-                        # On other ranks the chunk can stop being on the rank any time after its start
-                        s.add(_end(chunk, rank) >= _start(chunk, rank))
 
             for rank in collective.ranks():
-                # Figure out all addresses plus which ones weill be in the input and output buffers
-                addresses = set()
-                input_addresses = set()
-                output_addresses = set()
-                for chunk in collective.chunks():
-                    addr = collective.address(chunk)
-                    addresses.add(addr)
-                    if collective.precondition(rank, chunk):
-                        input_addresses.add(addr)
-                    if collective.postcondition(rank, chunk):
-                        output_addresses.add(addr)
-                    # Enforce the address start-end intervals to contain all the chunk start-end intervals
-                    s.add(_addr_start(addr, rank) <= _start(chunk, rank))
-                    s.add(_addr_end(addr, rank) >= _end(chunk, rank))
-
-                # Statically allocate indices for addresses in the input and output buffers
-                next_idx = 0
-                for addr in sorted(input_addresses):
-                    # Allocate addresses that are both input and output in the output portion
-                    if addr not in output_addresses:
-                        s.add(_idx(addr, rank) == next_idx)
-                        next_idx += 1
-                for addr in sorted(output_addresses):
-                    s.add(_idx(addr, rank) == next_idx)
-                    next_idx += 1
-
-                def conflict(addr1, addr2):
-                    s1 = _addr_start(addr1, rank)
-                    s2 = _addr_start(addr2, rank)
-                    e1 = _addr_end(addr1, rank)
-                    e2 = _addr_end(addr2, rank)
-                    if not instance.allow_exchange:
-                        # Without exhanges the index has to be reserved for the states before and after the interval
-                        # (The correctness part of the encoding allows chunks to "hop" from one rank to the next
-                        # without overlap)
-                        s1 = s1 - 1
-                        s2 = s2 - 1
-                        e1 = e1 + 1
-                        e2 = e2 + 1
-                    # There is a conflict if the intervals overlap
-                    return And(s1 < e2, s2 < e1)
-                
+                addresses, input_addresses, output_addresses = self._addresses(collective, rank)
                 # Count how many addresses will be in the input and output buffers
                 input_size = len(input_addresses)
                 output_size = len(output_addresses)
                 idx_end = input_size + output_size + instance.extra_memory
-                
-                # Add constraints for allocating indices for all the addresses just passing through the rank
+
                 for addr in (addresses - input_addresses) - output_addresses:
-                    for other in addresses:
-                        if other != addr:
-                            # If two addresses have the same index they have to have non-conflicting liveness intervals
-                            s.add(Implies(_idx(addr, rank) == _idx(other, rank), Not(conflict(addr, other))))
                     # If the address is ever live on this rank require it to be inside the memory limits
                     in_memory = And(0 <= _idx(addr, rank), _idx(addr, rank) < idx_end)
                     s.add(Implies(_addr_start(addr, rank) <= instance.steps, in_memory))
 
+    def _addresses(self, collective, rank):
+        # Figure out all addresses plus which ones will be in the input and output buffers
+        addresses = set()
+        input_addresses = set()
+        output_addresses = set()
+        for chunk in collective.chunks():
+            addr = collective.address(chunk)
+            addresses.add(addr)
+            if collective.precondition(rank, chunk):
+                input_addresses.add(addr)
+            if collective.postcondition(rank, chunk):
+                output_addresses.add(addr)
+        return addresses, input_addresses, output_addresses
+
+    def _incremental_solver(self, instance, collective):
+        # The static part of the encoding only depends on these instance parameters
+        key = (instance.chunks, instance.extra_memory != None, instance.allow_exchange)
+        if not key in self._solvers:
+            solver = Solver()
+            self._encode_static(solver, instance, collective)
+            self._solvers[key] = solver
+        return self._solvers[key]
+
     def solve(self, instance):
         chunked = self.collective.chunk_up(instance.chunks)
 
-        solver = Solver()
-        self._encode(solver, instance, chunked)
+        if self.incremental:
+            solver = self._incremental_solver(instance, chunked)
+            solver.push()
+            try:
+                self._encode_steps(solver, instance, chunked)
+                return self._check_and_decode(solver, instance, chunked)
+            finally:
+                solver.pop()
+        else:
+            solver = Solver()
+            self._encode(solver, instance, chunked)
+            return self._check_and_decode(solver, instance, chunked)
+
+    def _check_and_decode(self, solver, instance, chunked):
         if solver.check() == sat:
             model = solver.model()
 
@@ -5,25 +5,272 @@ from msccl.ncd_reduction import non_combining_dual
 from msccl.topologies import reverse_topology
 from z3 import *
 from fractions import Fraction
+from collections import defaultdict
+import functools
+import math
 
 def _flow(chunk, src, dst):
     return Real(f'flow_{chunk}_from_{src}_to_{dst}')
 
-def lower_bound_rounds(topology, collective, logging=False):
-    '''
-    Solve a lower bound rounds required by any algorithm. Uses a multi-commodity feasibility inspired encoding to Z3.
-    '''
+def _lcm(a, b):
+    # math.lcm and variadic math.gcd need Python 3.9
+    return a * b // math.gcd(a, b)
 
-    opt = Optimize()
+class _Simplex(object):
+    # An exact simplex method for minimizing a variable subject to A x <= b and A x == b with x >= 0. Since equations
+    # can be freely scaled by positive factors, rows are kept as sparse dicts of integer coefficients reduced by their
+    # gcd, which avoids the overhead of Fractions. A column index maps each column to the rows it appears in.
+    def __init__(self, num_vars):
+        self.num_cols = num_vars
+        self.rows = []
+        self.rhs = []
+        self.basis = []
+        self.cols = defaultdict(set)
+        self.artificials = set()
 
-    # Remember names before possible non-combining dual reduction
-    collective_name = collective.name
-    topology_name = topology.name
+    def _new_col(self):
+        self.num_cols += 1
+        return self.num_cols - 1
 
-    # Use non-combining dual if necessary
-    if collective.is_combining:
-        collective = non_combining_dual(collective)
-        topology = reverse_topology(topology)
+    def add(self, coeffs, rhs, equality=False):
+        coeffs = {col: Fraction(coeff) for col, coeff in coeffs.items() if coeff != 0}
+        rhs = Fraction(rhs)
+        # Scale to integers, making the right hand side non-negative
+        scale = functools.reduce(_lcm, (coeff.denominator for coeff in coeffs.values()), rhs.denominator)
+        if rhs < 0:
+            assert equality, 'Inequalities with negative right hand sides are not supported'
+            scale = -scale
+        row = {col: int(coeff * scale) for col, coeff in coeffs.items()}
+        # Add a slack variable for inequalities and an artificial variable for equalities
+        col = self._new_col()
+        row[col] = abs(scale)
+        self.basis.append(col)
+        if equality:
+            self.artificials.add(col)
+        r = len(self.rows)
+        for col in row:
+            self.cols[col].add(r)
+        self.rows.append(row)
+        self.rhs.append(int(rhs * scale))
+
+    @staticmethod
+    def _combine(target, target_scale, row, factor):
+        # Computes target * target_scale - row * factor in place and returns the columns that appeared or vanished
+        changed = []
+        if target_scale != 1:
+            for c in target:
+                target[c] *= target_scale
+        for c, coeff in row.items():
+            updated = target.get(c, 0) - factor * coeff
+            if updated != 0:
+                if c not in target:
+                    changed.append(c)
+                target[c] = updated
+            else:
+                del target[c]
+                changed.append(c)
+        return changed
+
+    @staticmethod
+    def _reduce(row, *extra):
+        divisor = functools.reduce(math.gcd, extra, functools.reduce(math.gcd, row.values(), 0))
+        if divisor > 1:
+            for c in row:
+                row[c] //= divisor
+        return divisor
+
+    def _pivot(self, r, col, objective):
+        row = self.rows[r]
+        pivot = row[col]
+        rhs = self.rhs[r]
+        for i in list(self.cols[col]):
+            if i == r:
+                continue
+            other = self.rows[i]
+            factor = other[col]
+            for c in self._combine(other, pivot, row, factor):
+                if c in other:
+                    self.cols[c].add(i)
+                else:
+                    self.cols[c].discard(i)
+            other_rhs = self.rhs[i] * pivot - factor * rhs
+            divisor = self._reduce(other, other_rhs)
+            self.rhs[i] = other_rhs // divisor
+        # The objective is kept as scale * z = value + coeffs . x for a positive scale
+        coeffs, value, scale = objective
+        factor = coeffs.get(col)
+        if factor != None:
+            self._combine(coeffs, pivot, row, factor)
+            value = value * pivot + factor * rhs
+            scale *= pivot
+            divisor = self._reduce(coeffs, value, scale)
+            objective[1:] = [value // divisor, scale // divisor]
+        self.basis[r] = col
+
+    def _optimize(self, objective, allowed):
+        # Dantzig's rule, falling back to Bland's rule on degenerate pivots to guarantee termination
+        bland = False
+        while True:
+            candidates = [(coeff, col) for col, coeff in objective[0].items() if coeff < 0 and col in allowed]
+            if len(candidates) == 0:
+                return True
+            col = min(candidates, key=lambda c: c[1])[1] if bland else min(candidates)[1]
+            best = None
+            for i in self.cols[col]:
+                coeff = self.rows[i][col]
+                if coeff > 0:
+                    if best == None:
+                        best = i
+                        continue
+                    # Compare the ratios rhs / coeff without dividing
+                    lhs = self.rhs[i] * self.rows[best][col]
+                    rhs = self.rhs[best] * coeff
+                    if lhs < rhs or (lhs == rhs and self.basis[i] < self.basis[best]):
+                        best = i
+            if best == None:
+                return False
+            bland = self.rhs[best] == 0
+            self._pivot(best, col, objective)
+
+    def minimize(self, var):
+        '''
+        Returns the minimum of the variable as a Fraction or None if the constraints are infeasible.
+        '''
+        # Phase 1: drive the artificial variables to zero
+        coeffs = defaultdict(int)
+        value = 0
+        for row, rhs, basic in zip(self.rows, self.rhs, self.basis):
+            if basic in self.artificials:
+                for col, coeff in row.items():
+                    if col != basic:
+                        coeffs[col] -= coeff
+                value += rhs
+        objective = [{col: coeff for col, coeff in coeffs.items() if coeff != 0}, value, 1]
+        allowed = set(range(self.num_cols)) - self.artificials
+        self._optimize(objective, allowed)
+        if objective[1] != 0:
+            return None
+        # Pivot any remaining (zero) artificial variables out of the basis and drop redundant rows
+        for r, basic in enumerate(self.basis):
+            if basic in self.artificials:
+                row = self.rows[r]
+                col = next((col for col in row if col in allowed), None)
+                if col != None:
+                    if row[col] < 0:
+                        for c in row:
+                            row[c] = -row[c]
+                    self._pivot(r, col, [{}, 0, 1])
+                else:
+                    for c in row:
+                        self.cols[c].discard(r)
+                    row.clear()
+        for artificial in self.artificials:
+            for r in self.cols.pop(artificial, ()):
+                del self.rows[r][artificial]
+        # Phase 2: minimize the variable
+        if var in self.basis and len(self.rows[self.basis.index(var)]) > 0:
+            r = self.basis.index(var)
+            row = self.rows[r]
+            objective = [{col: -coeff for col, coeff in row.items() if col != var}, self.rhs[r], row[var]]
+        else:
+            objective = [{var: 1}, 0, 1]
+        bounded = self._optimize(objective, allowed)
+        assert bounded, 'The variable to minimize must be bounded from below'
+        return Fraction(objective[1], objective[2])
+
+def _refine_linear_program(num_vars, constraints, objective):
+    # Reduces a linear program by color refinement (Grohe et al., Dimension Reduction via Colour Refinement). Variables
+    # and constraints are colored such that all constraints of a color have the same sum of coefficients over the
+    # variables of each color and vice versa. Averaging any solution over the colors then gives another solution with
+    # the same objective, so restricting variables to be equal within colors leaves the optimum unchanged. Returns the
+    # number of variable colors, the aggregated constraints and the color of the objective variable.
+    occurrences = [[] for _ in range(num_vars)]
+    for row, (coeffs, _, _) in enumerate(constraints):
+        for var, coeff in coeffs.items():
+            occurrences[var].append((row, coeff))
+
+    def relabel(signatures):
+        palette = {}
+        return [palette.setdefault(signature, len(palette)) for signature in signatures], len(palette)
+
+    var_colors, num_var_colors = relabel([var == objective for var in range(num_vars)])
+    row_colors, num_row_colors = relabel([(rhs, equality) for _, rhs, equality in constraints])
+    while True:
+        var_colors, new_num_var_colors = relabel([(var_colors[var],
+            tuple(sorted((row_colors[row], coeff) for row, coeff in occurrences[var]))) for var in range(num_vars)])
+        row_colors, new_num_row_colors = relabel([(row_colors[row],
+            tuple(sorted((var_colors[var], coeff) for var, coeff in coeffs.items())))
+            for row, (coeffs, _, _) in enumerate(constraints)])
+        if new_num_var_colors == num_var_colors and new_num_row_colors == num_row_colors:
+            break
+        num_var_colors, num_row_colors = new_num_var_colors, new_num_row_colors
+
+    # Aggregate one representative constraint of each color
+    reduced = {}
+    for row, (coeffs, rhs, equality) in enumerate(constraints):
+        if row_colors[row] not in reduced:
+            aggregated = defaultdict(int)
+            for var, coeff in coeffs.items():
+                aggregated[var_colors[var]] += coeff
+            reduced[row_colors[row]] = (aggregated, rhs, equality)
+    return num_var_colors, list(reduced.values()), var_colors[objective]
+
+def _lower_bound_rounds_native(topology, collective):
+    # Number the flow variables, leaving out the ones that cannot help: flows into ranks in the precondition never
+    # justify anything. The upper bounds of 1 on flows are also left out, as clipping any flow above 1 to 1 keeps all
+    # other constraints satisfied while only freeing up bandwidth.
+    chunks = collective.chunks()
+    ranks = collective.ranks()
+    flows = {}
+    for chunk in chunks:
+        for dst in ranks:
+            if collective.precondition(dst, chunk):
+                continue
+            for src in topology.sources(dst):
+                flows[(chunk, src, dst)] = len(flows)
+    # Ranks outside the pre- and postcondition get a variable for how much of the chunk they have received
+    relays = {}
+    for chunk in chunks:
+        for rank in ranks:
+            if not collective.precondition(rank, chunk) and not collective.postcondition(rank, chunk):
+                relays[(chunk, rank)] = len(flows) + len(relays)
+    rounds = len(flows) + len(relays)
+    constraints = []
+
+    for chunk in chunks:
+        for rank in ranks:
+            if collective.precondition(rank, chunk):
+                continue
+            total_in = { flows[(chunk,src,rank)]: 1 for src in topology.sources(rank) }
+            if collective.postcondition(rank, chunk):
+                # Ranks in the postcondition, but not in the precondition need the whole chunk. This also justifies
+                # any outflows, as flows can be clipped to 1 without violating any other constraints.
+                constraints.append((total_in, 1, True))
+            else:
+                # Other ranks need to justify outflows with what they have received
+                relay = relays[(chunk, rank)]
+                coeffs = { col: -1 for col in total_in }
+                coeffs[relay] = 1
+                constraints.append((coeffs, 0, False))
+                for dst in topology.destinations(rank):
+                    if (chunk,rank,dst) in flows:
+                        constraints.append(({ flows[(chunk,rank,dst)]: 1, relay: -1 }, 0, False))
+
+    for srcs, dsts, bw, _ in topology.bandwidth_constraints():
+        # Total flow must be less than the limit, taking rounds into consideration
+        coeffs = { flows[(chunk,src,dst)]: 1 for src in srcs for dst in dsts for chunk in chunks if (chunk,src,dst) in flows }
+        coeffs[rounds] = -bw
+        constraints.append((coeffs, 0, False))
+
+    # Symmetric topologies and collectives give highly redundant programs, which shrink a lot by color refinement
+    num_vars, constraints, rounds = _refine_linear_program(rounds + 1, constraints, rounds)
+    lp = _Simplex(num_vars)
+    for coeffs, rhs, equality in constraints:
+        lp.add(coeffs, rhs, equality)
+    return lp.minimize(rounds)
+
+def _lower_bound_rounds_z3(topology, collective):
+    opt = Optimize()
 
     chunks = collective.chunks()
     ranks = collective.ranks()
@@ -58,11 +305,37 @@ def lower_bound_rounds(topology, collective, logging=False):
     if result == sat:
         bound_ref = opt.lower(min_rounds)
         if isinstance(bound_ref, IntNumRef):
-            rounds_lb = Fraction(bound_ref.as_long(), 1)
+            return result, Fraction(bound_ref.as_long(), 1)
         elif isinstance(bound_ref, RatNumRef):
-            rounds_lb = bound_ref.as_fraction()
+            return result, bound_ref.as_fraction()
         else:
             raise RuntimeError(f'Unhandled Z3 numeral type: {type(bound_ref)}')
+    return result, None
+
+def lower_bound_rounds(topology, collective, logging=False, backend='native'):
+    '''
+    Solve a lower bound rounds required by any algorithm. Uses a multi-commodity feasibility inspired linear program,
+    which the native backend solves with an exact simplex method and the z3 backend with Z3's Optimize.
+    '''
+    if backend not in ('native', 'z3'):
+        raise ValueError(f'Unknown lower bound backend: {backend}')
+
+    # Remember names before possible non-combining dual reduction
+    collective_name = collective.name
+    topology_name = topology.name
+
+    # Use non-combining dual if necessary
+    if collective.is_combining:
+        collective = non_combining_dual(collective)
+        topology = reverse_topology(topology)
+
+    if backend == 'native':
+        rounds_lb = _lower_bound_rounds_native(topology, collective)
+        result = sat if rounds_lb != None else unsat
+    else:
+        result, rounds_lb = _lower_bound_rounds_z3(topology, collective)
+
+    if result == sat:
         if logging:
             print(f'{collective_name} algorithms need at least {rounds_lb} rounds in {topology_name} topology.')
         return rounds_lb
@@ -2,7 +2,7 @@
 # Licensed under the MIT License.
 
 from msccl.algorithm import Algorithm, Step
-from msccl.topologies import Topology
+from msccl.topologies import Topology, DistributedTopology
 from msccl.instance import Instance
 from msccl.collectives import Collective, Chunk
 
@@ -28,6 +28,8 @@ def _msccl_object_hook(o):
         return Chunk(pre, post, o['addr'])
     if o['msccl_type'] == 'topology':
         return Topology(o['name'], o['links'], o['switches'])
+    if o['msccl_type'] == 'distributed_topology':
+        return DistributedTopology(o['name'], o['local_topology'], o['copies'], o['remote_bw'], o['remote_switches'])
     if o['msccl_type'] == 'instance':
         return Instance(o['steps'], o['extra_rounds'], o['chunks'], o['pipeline'], o['extra_memory'], o['allow_exchange'])
     warnings.warn('Unhandled msccl_type in JSON')
@@ -61,7 +63,7 @@ class MSCCLEncoder(json.JSONEncoder):
             }
         if isinstance(o, Collective):
             triggers = {}
-            for (r, c), v in o._triggers.items():
+            for (r, c), v in o.triggers().items():
                 if not r in triggers:
                     triggers[r] = {}
                 triggers[r][c] = v
@@ -80,6 +82,15 @@ class MSCCLEncoder(json.JSONEncoder):
                 'post': list(o.postcondition),
                 'addr': o.address,
             }
+        if isinstance(o, DistributedTopology):
+            return {
+                'msccl_type': 'distributed_topology',
+                'name': o.name,
+                'local_topology': o.local_topology,
+                'copies': o.num_copies,
+                'remote_bw': o.remote_bw,
+                'remote_switches': o.remote_switches,
+            }
         if isinstance(o, Topology):
             return {
                 'msccl_type': 'topology',
@@ -0,0 +1,169 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from msccl.algorithm import Algorithm
+from msccl.serialization import MSCCLEncoder, MSCCLDecoder
+from msccl.cache_dir import default_cache_directory
+
+from pathlib import Path
+import hashlib
+import json
+import os
+import tempfile
+
+# Bump this whenever the encoding changes in a way that invalidates previously cached results
+_CACHE_VERSION = 2
+
+def _strip_names(encoded):
+    # Names do not affect solving, so they are dropped and the switches are sorted
+    if isinstance(encoded, dict):
+        encoded.pop('name', None)
+        if 'switches' in encoded:
+            encoded['switches'] = sorted([sorted(srcs), sorted(dsts), bw] for srcs, dsts, bw, _ in encoded['switches'])
+        for value in encoded.values():
+            _strip_names(value)
+    return encoded
+
+def _topology_fingerprint(topology):
+    # Fingerprint the topology's own serialization, which keeps e.g. a DistributedTopology in its compact form of the
+    # local topology and the number of copies instead of materializing the links between all ranks
+    return _strip_names(json.loads(MSCCLEncoder().encode(topology)))
+
+def _collective_fingerprint(collective):
+    chunks = [[
+        collective.precondition_ranks(chunk),
+        collective.postcondition_ranks(chunk),
+        collective.address(chunk),
+    ] for chunk in collective.chunks()]
+    triggers = sorted([rank, chunk, trigger] for (rank, chunk), trigger in collective.triggers().items())
+    return {
+        'nodes': collective.num_nodes,
+        'chunks': chunks,
+        'triggers': triggers,
+    }
+
+def _instance_fingerprint(instance):
+    return {
+        'steps': instance.steps,
+        'extra_rounds': instance.extra_rounds,
+        'chunks': instance.chunks,
+        'pipeline': instance.pipeline,
+        'extra_memory': instance.extra_memory,
+        'allow_exchange': instance.allow_exchange,
+    }
+
+def problem_fingerprint(topology, collective, instance):
+    '''
+    Returns a canonical hash of the problem that solving the instance of the collective in the topology poses.
+    '''
+    problem = {
+        'version': _CACHE_VERSION,
+        'topology': _topology_fingerprint(topology),
+        'collective': _collective_fingerprint(collective),
+        'instance': _instance_fingerprint(instance),
+    }
+    canonical = json.dumps(problem, sort_keys=True, separators=(',', ':'), default=str)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class SolutionCache(object):
+    '''
+    A persistent content-addressed cache of solved instances. Both algorithms and unsatisfiability are remembered.
+    Entries are evicted in least recently used order once the total size of the cache exceeds max_size bytes. With
+    bypass set lookups always miss, but fresh results are still stored.
+    '''
+    def __init__(self, directory=None, max_size=256 * 1024 * 1024, bypass=False):
+        if max_size <= 0:
+            raise ValueError('max_size must be strictly positive.')
+        self.directory = Path(directory) if directory != None else default_cache_directory('solutions')
+        self.max_size = max_size
+        self.bypass = bypass
+
+    def _entry_path(self, fingerprint):
+        return self.directory / f'{fingerprint}.json'
+
+    def lookup(self, topology, collective, instance):
+        '''
+        Returns a pair (hit, algorithm), where algorithm is None for instances known to be unsatisfiable.
+        '''
+        if self.bypass:
+            return False, None
+        path = self._entry_path(problem_fingerprint(topology, collective, instance))
+        try:
+            with path.open() as f:
+                entry = MSCCLDecoder().decode(f.read())
+        except (OSError, ValueError):
+            return False, None
+        # Mark the entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        cached = entry['algorithm']
+        if cached == None:
+            return True, None
+        # Rebuild the algorithm around the given objects, which also checks that it implements the collective
+        try:
+            return True, Algorithm.make_implementation(collective, topology, instance, cached.steps)
+        except (RuntimeError, ValueError, AssertionError):
+            return False, None
+
+    def store(self, topology, collective, instance, algorithm):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        path = self._entry_path(problem_fingerprint(topology, collective, instance))
+        contents = MSCCLEncoder().encode({ 'algorithm': algorithm })
+        # Write atomically so that concurrent readers never see partial entries
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(contents)
+            os.replace(tmp_path, path)
+        except BaseException:
+            # Do not leave partial entries behind in the shared directory
+            try:
+                os.unlink(tmp_path)
+            except OSError:
+                pass
+            raise
+        self._evict()
+
+    def _evict(self):
+        entries = []
+        for path in self.directory.glob('*.json'):
+            try:
+                stat = path.stat()
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except OSError:
+                pass
+            total_size -= size
+
+    def clear(self):
+        if not self.directory.exists():
+            return
+        for path in self.directory.glob('*.json'):
+            path.unlink()
+
+class CachedEncoding(object):
+    '''
+    Wraps an encoding of a topology and collective to look up and store the results of solve in a SolutionCache.
+    '''
+    def __init__(self, encoding, topology, collective, cache):
+        self.encoding = encoding
+        self.topology = topology
+        self.collective = collective
+        self.cache = cache
+
+    def solve(self, instance):
+        hit, algo = self.cache.lookup(self.topology, self.collective, instance)
+        if hit:
+            return algo
+        algo = self.encoding.solve(instance)
+        self.cache.store(self.topology, self.collective, instance, algo)
+        return algo
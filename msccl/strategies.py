@@ -5,13 +5,22 @@ from msccl.instance import Instance
 from msccl.path_encoding import PathEncoding
 from msccl.rounds_bound import lower_bound_rounds
 from msccl.steps_bound import lower_bound_steps
+from msccl.solution_cache import CachedEncoding
 
 import time
 import math
 from fractions import Fraction
 import itertools
+import multiprocessing
+import multiprocessing.connection
 from collections import defaultdict
 
+def _log_result(result, duration):
+    if result != None:
+        print(f'synthesized! ({duration:.1f}s)')
+    else:
+        print(f'unsatisfiable. ({duration:.1f}s)')
+
 def _solve_and_log(encoding, instance, logging):
     if logging:
         print(f'Solving instance {instance}... ', end='', flush=True)
@@ -21,22 +30,91 @@ def _solve_and_log(encoding, instance, logging):
     duration = time.time() - start_time
     
     if logging:
-        if result != None:
-            print(f'synthesized! ({duration:.1f}s)')
-        else:
-            print(f'unsatisfiable. ({duration:.1f}s)')
+        _log_result(result, duration)
 
     return result
 
-def solve_instance(topology, collective, instance, logging = False):
-    encoding = PathEncoding(topology, collective)
+def _make_encoding(topology, collective, incremental = False, cache = None, symmetry_breaking = False):
+    encoding = PathEncoding(topology, collective, incremental=incremental, symmetry_breaking=symmetry_breaking)
+    if cache != None:
+        encoding = CachedEncoding(encoding, topology, collective, cache)
+    return encoding
+
+def _solve_in_process(conn, topology, collective, instance, cache, symmetry_breaking):
+    start_time = time.time()
+    result = _make_encoding(topology, collective, cache=cache, symmetry_breaking=symmetry_breaking).solve(instance)
+    conn.send((result, time.time() - start_time))
+    conn.close()
+
+class _SpeculativeSolver(object):
+    '''
+    Solves instances in separate worker processes ahead of the time their results are needed. Each instance gets its own
+    process so that speculatively started instances can be terminated once their results are no longer needed.
+    '''
+    def __init__(self, topology, collective, workers, cache = None, symmetry_breaking = False):
+        if workers < 1:
+            raise ValueError('workers must be strictly positive.')
+        self.topology = topology
+        self.collective = collective
+        self.workers = workers
+        self.cache = cache
+        self.symmetry_breaking = symmetry_breaking
+        self._running = {}
+        self._done = {}
+
+    def has_capacity(self):
+        return len(self._running) < self.workers
+
+    def submit(self, instance):
+        if instance in self._running or instance in self._done:
+            return
+        recv_conn, send_conn = multiprocessing.Pipe(duplex=False)
+        process = multiprocessing.Process(target=_solve_in_process, args=(send_conn, self.topology, self.collective, instance, self.cache, self.symmetry_breaking), daemon=True)
+        process.start()
+        send_conn.close()
+        self._running[instance] = (process, recv_conn)
+
+    def retain(self, is_needed):
+        # Terminate and forget all instances whose results are not needed anymore
+        for instance in [instance for instance in self._running if not is_needed(instance)]:
+            process, conn = self._running.pop(instance)
+            process.terminate()
+            process.join()
+            conn.close()
+        for instance in [instance for instance in self._done if not is_needed(instance)]:
+            del self._done[instance]
+
+    def result(self, instance):
+        self.submit(instance)
+        while not instance in self._done:
+            self._wait()
+        return self._done.pop(instance)
+
+    def _wait(self):
+        ready = multiprocessing.connection.wait([conn for _, conn in self._running.values()])
+        for instance, (process, conn) in list(self._running.items()):
+            if conn in ready:
+                try:
+                    self._done[instance] = conn.recv()
+                except EOFError:
+                    raise RuntimeError(f'Worker process solving instance {instance} exited unexpectedly.')
+                process.join()
+                conn.close()
+                del self._running[instance]
+
+    def close(self):
+        self.retain(lambda instance: False)
+
+def solve_instance(topology, collective, instance, cache = None, symmetry_breaking = False, logging = False):
+    encoding = _make_encoding(topology, collective, cache=cache, symmetry_breaking=symmetry_breaking)
     return _solve_and_log(encoding, instance, logging)
 
-def solve_least_steps(topology, collective, initial_steps = 1, base_instance = Instance(None), logging = False):
+def solve_least_steps(topology, collective, initial_steps = 1, base_instance = Instance(None), incremental = False, cache = None, symmetry_breaking = False, logging = False):
     if initial_steps < 1:
         raise ValueError('initial_steps must be strictly positive')
 
-    encoding = PathEncoding(topology, collective)
+    # In incremental mode the step independent part of the encoding is shared between all the step counts tried
+    encoding = _make_encoding(topology, collective, incremental, cache, symmetry_breaking)
 
     # Lower bound the number of steps required
     steps_lb = lower_bound_steps(topology, collective)
@@ -70,13 +148,32 @@ def solve_least_steps(topology, collective, initial_steps = 1, base_instance = I
         else:
             num_steps += 1
 
-def solve_all_latency_bandwidth_tradeoffs(topology, collective, min_chunks = 1, max_chunks = None, assume_rounds_per_chunk_lb = None, assume_monotonic_feasibility = False, base_instance = Instance(None), logging = False):
+def _rounds_and_steps(chunks, rounds_lb, steps_lb):
+    # Enumerates the (rounds, steps) pairs to try for a number of chunks in the order they are tried in
+    for rounds in itertools.count(rounds_lb):
+        # Skip this fraction if a lower number of chunks will have already considered it
+        if math.gcd(chunks, rounds) != 1:
+            continue
+        for steps in range(steps_lb, rounds+1):
+            yield rounds, steps
+
+def solve_all_latency_bandwidth_tradeoffs(topology, collective, min_chunks = 1, max_chunks = None, assume_rounds_per_chunk_lb = None, assume_monotonic_feasibility = False, base_instance = Instance(None), incremental = False, workers = None, cache = None, symmetry_breaking = False, logging = False):
+    '''
+    Yields an algorithm for each number of chunks with the least rounds per chunk found, trying fewer steps first.
+    With workers set, instances are solved speculatively in that many worker processes. Results are still consumed in
+    the same order as when solving sequentially, so the same algorithms are yielded in the same order. Incremental
+    encodings cannot be shared between worker processes, so incremental and workers are mutually exclusive.
+    '''
     if min_chunks < 1:
         raise ValueError('min_chunks must be strictly positive.')
     if max_chunks != None and max_chunks < min_chunks:
         raise ValueError('max_chunks must be greater or equal to min_chunks.')
     if assume_rounds_per_chunk_lb != None and assume_rounds_per_chunk_lb < 0:
         raise ValueError('assume_rounds_per_chunk_lb must be positive.')
+    if workers != None and workers < 1:
+        raise ValueError('workers must be strictly positive.')
+    if workers != None and incremental:
+        raise ValueError('incremental solving is not supported with workers.')
 
     # Lower bound the number of steps required
     steps_lb = lower_bound_steps(topology, collective)
@@ -96,30 +193,73 @@ def solve_all_latency_bandwidth_tradeoffs(topology, collective, min_chunks = 1,
     # Remember for which rounds per chunk fraction a given number of steps will be unsat
     step_rpc_lb = defaultdict(lambda: Fraction(0))
 
+    def is_pruned(chunks, rounds, steps):
+        # Skip this number of steps if a previous instance with stricter rounds per chunk already failed
+        return assume_monotonic_feasibility and Fraction(rounds, chunks) < step_rpc_lb[steps]
+
+    def make_instance(chunks, rounds, steps):
+        return base_instance.set(steps=steps, extra_rounds=rounds - steps, chunks=chunks)
+
+    def rounds_lb_for(chunks):
+        return math.ceil(rounds_per_chunk_lb * chunks)
+
+    def candidates(chunks, rounds, steps):
+        # Instances for this number of chunks from (rounds, steps) onwards in the order they would be tried in
+        for r, s in _rounds_and_steps(chunks, rounds_lb_for(chunks), steps_lb):
+            if (r, s) >= (rounds, steps):
+                yield chunks, r, s
+
+    def speculate(pool, chunks, rounds, steps):
+        # Keep the workers busy with the instances most likely to be needed next. The candidates of the current and
+        # the next few numbers of chunks are interleaved, as finding an algorithm ends the search for a number of chunks.
+        last_chunks = chunks + pool.workers - 1
+        if max_chunks != None:
+            last_chunks = min(last_chunks, max_chunks)
+        lookahead = [candidates(chunks, rounds, steps)]
+        lookahead.extend(candidates(c, 0, 0) for c in range(chunks + 1, last_chunks + 1))
+        for c, r, s in itertools.chain.from_iterable(zip(*lookahead)):
+            if not pool.has_capacity():
+                break
+            if not is_pruned(c, r, s):
+                pool.submit(make_instance(c, r, s))
+
+    def is_needed(chunks, rounds, steps, instance):
+        # Speculatively solved instances stay needed until they are passed or pruned
+        if instance.chunks < chunks or is_pruned(instance.chunks, instance.rounds(), instance.steps):
+            return False
+        return instance.chunks > chunks or (instance.rounds(), instance.steps) > (rounds, steps)
+
+    def solve_speculatively(pool, chunks, rounds, steps, instance):
+        if logging:
+            print(f'Solving instance {instance}... ', end='', flush=True)
+        speculate(pool, chunks, rounds, steps)
+        result, duration = pool.result(instance)
+        if logging:
+            _log_result(result, duration)
+        return result
+
     chunks_iter = range(min_chunks, max_chunks+1) if max_chunks != None else itertools.count(min_chunks)
 
-    algorithms = []
-    for chunks in chunks_iter:
-        encoding = PathEncoding(topology, collective)
-        rounds_lb = math.ceil(rounds_per_chunk_lb * chunks)
-
-        rounds = rounds_lb - 1
-        found = False
-        while not found:
-            rounds += 1
-            rpc = Fraction(rounds, chunks)
-            # Skip this fraction if a lower number of chunks will have already considered it
-            if math.gcd(chunks, rounds) != 1:
-                continue
-            for steps in range(steps_lb, rounds+1):
-                # Skip this number of steps if a previous instance with stricter rounds per chunk already failed
-                if assume_monotonic_feasibility and rpc < step_rpc_lb[steps]:
+    pool = _SpeculativeSolver(topology, collective, workers, cache, symmetry_breaking) if workers != None else None
+    try:
+        for chunks in chunks_iter:
+            if pool == None:
+                encoding = _make_encoding(topology, collective, incremental, cache, symmetry_breaking)
+            found = False
+            for rounds, steps in _rounds_and_steps(chunks, rounds_lb_for(chunks), steps_lb):
+                rpc = Fraction(rounds, chunks)
+                if is_pruned(chunks, rounds, steps):
                     continue
-                instance = base_instance.set(steps=steps, extra_rounds=rounds - steps, chunks=chunks)
-                result = _solve_and_log(encoding, instance, logging=logging)
+                instance = make_instance(chunks, rounds, steps)
+                if pool != None:
+                    result = solve_speculatively(pool, chunks, rounds, steps, instance)
+                else:
+                    result = _solve_and_log(encoding, instance, logging=logging)
                 if result != None:
                     assert rpc >= step_rpc_lb[steps], 'Monotonic feasibility assumption would have been violated.'
                     found = True
+                    if pool != None:
+                        pool.retain(lambda other: other.chunks > chunks and not is_pruned(other.chunks, other.rounds(), other.steps))
                     yield result
                     break
                 else:
@@ -127,15 +267,20 @@ def solve_all_latency_bandwidth_tradeoffs(topology, collective, min_chunks = 1,
                     step_rpc_lb[steps] = max(step_rpc_lb[steps], rpc)
                     if logging and assume_monotonic_feasibility:
                         print(f'Assuming {steps} step algorithms need at least {rpc} rounds per chunk.')
-        # Check if a bandwidth optimal algorithm has been found
-        if found and rpc <= rounds_per_chunk_lb:
-            assert rpc == rounds_per_chunk_lb, 'Rounds per chunk lower bound did not hold.'
+                    if pool != None:
+                        pool.retain(lambda other: is_needed(chunks, rounds, steps, other))
+            # Check if a bandwidth optimal algorithm has been found
+            if found and rpc <= rounds_per_chunk_lb:
+                assert rpc == rounds_per_chunk_lb, 'Rounds per chunk lower bound did not hold.'
+                if logging:
+                    print(f'Bandwidth optimal algorithm found!')
+                break
+        else:
             if logging:
-                print(f'Bandwidth optimal algorithm found!')
-            break
-    else:
-        if logging:
-            print(f'Reached the limit for chunks.')
+                print(f'Reached the limit for chunks.')
+    finally:
+        if pool != None:
+            pool.close()
 
 def _steps(algo):
     return len(algo.steps)
@@ -1,7 +1,7 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
-from .topology import Topology
+from .topology import Topology, _check_switches
 
 def _copy_links(remote_bw, num_local, num_dist, local_links):
     return [[remote_bw if src // num_local != dst // num_local else local_links[dst % num_local][src % num_local]
@@ -16,26 +16,73 @@ def _copy_switches(num_local, num_copies, local_switches):
             switches.append((dist_srcs, dist_dsts, bw, f'copy_{i}_{name}_local'))
     return switches
 
-def distributed_fully_connected(local_topology, num_copies, remote_bw):
-    num_local = local_topology.num_nodes()
-    num_dist = num_local * num_copies
-
-    links = _copy_links(remote_bw, num_local, num_dist, local_topology.links)
-    switches = _copy_switches(num_local, num_copies, local_topology.switches)
-
-    return Topology(f'DistributedFullyConnected(local={local_topology.name},copies={num_copies},bw={remote_bw})', links, switches)
-
-def distributed_hub_and_spoke(local_topology, num_copies, remote_bw):
-    num_local = local_topology.num_nodes()
+def _remote_switches(num_local, num_copies, remote_bw):
+    switches = []
     num_dist = num_local * num_copies
-
-    links = _copy_links(remote_bw, num_local, num_dist, local_topology.links)
-    switches = _copy_switches(num_local, num_copies, local_topology.switches)
-
     for i in range(num_copies):
         local_ranks = [j + i * num_local for j in range(num_local)]
         remote_ranks = [k for k in range(num_dist) if k // num_local != i]
         switches.append((local_ranks, remote_ranks, remote_bw, f'copy_{i}_out_remote'))
         switches.append((remote_ranks, local_ranks, remote_bw, f'copy_{i}_in_remote'))
-    
-    return Topology(f'DistributedHubAndSpoke(local={local_topology.name},copies={num_copies},bw={remote_bw})', links, switches)
+    return switches
+
+class DistributedTopology(Topology):
+    '''
+    Copies of a local topology where every pair of nodes in different copies is connected by a remote link. Links are
+    derived from the local topology on demand, so neighbors are iterated in time proportional to the degree of a node
+    and the topology serializes as the local topology plus the number of copies. The dense links matrix is only built
+    if it is accessed.
+    '''
+    def __init__(self, name, local_topology, num_copies, remote_bw, remote_switches=False):
+        self.name = name
+        self.local_topology = local_topology
+        self.num_copies = num_copies
+        self.remote_bw = remote_bw
+        self.remote_switches = remote_switches
+        self._num_local = local_topology.num_nodes()
+        self._links = None
+        self._distances = None
+        self._bandwidth_constraints = None
+        self._pair_constraints = None
+        self.switches = _copy_switches(self._num_local, num_copies, local_topology.switches)
+        if remote_switches:
+            self.switches.extend(_remote_switches(self._num_local, num_copies, remote_bw))
+        _check_switches(self.switches)
+
+    @property
+    def links(self):
+        if self._links == None:
+            self._links = _copy_links(self.remote_bw, self._num_local, self.num_nodes(), self.local_topology.links)
+        return self._links
+
+    def _neighbors(self, node, local_neighbors):
+        # Remote nodes before and after the copy of node surround its local neighbors, keeping them in increasing order
+        first = node - node % self._num_local
+        if self.remote_bw > 0:
+            yield from range(first)
+        for local_node in local_neighbors(node - first):
+            yield first + local_node
+        if self.remote_bw > 0:
+            yield from range(first + self._num_local, self.num_nodes())
+
+    def sources(self, dst):
+        return self._neighbors(dst, self.local_topology.sources)
+
+    def destinations(self, src):
+        return self._neighbors(src, self.local_topology.destinations)
+
+    def link(self, src, dst):
+        if src // self._num_local != dst // self._num_local:
+            return self.remote_bw
+        return self.local_topology.link(src % self._num_local, dst % self._num_local)
+
+    def num_nodes(self):
+        return self._num_local * self.num_copies
+
+def distributed_fully_connected(local_topology, num_copies, remote_bw):
+    return DistributedTopology(f'DistributedFullyConnected(local={local_topology.name},copies={num_copies},bw={remote_bw})',
+        local_topology, num_copies, remote_bw)
+
+def distributed_hub_and_spoke(local_topology, num_copies, remote_bw):
+    return DistributedTopology(f'DistributedHubAndSpoke(local={local_topology.name},copies={num_copies},bw={remote_bw})',
+        local_topology, num_copies, remote_bw, remote_switches=True)
@@ -1,16 +1,25 @@
 # Copyright (c) Microsoft Corporation.
 # Licensed under the MIT License.
 
+import math
+from collections import defaultdict
+
+def _check_switches(switches):
+    for srcs, dsts, bw, switch_name in switches:
+        if bw == 0:
+            raise ValueError(f'Switch {switch_name} has zero bandwidth, but switch bandwidths must be strictly positive. Please encode connectedness in links.')
+        if bw < 0:
+            raise ValueError(f'Switch {switch_name} has a negative bandwidth of {bw}. Bandwidth must be strictly positive.')
+
 class Topology(object):
     def __init__(self, name, links, switches=[]):
         self.name = name
         self.links = links
         self.switches = switches
-        for srcs, dsts, bw, switch_name in switches:
-            if bw == 0:
-                raise ValueError(f'Switch {switch_name} has zero bandwidth, but switch bandwidths must be strictly positive. Please encode connectedness in links.')
-            if bw < 0:
-                raise ValueError(f'Switch {switch_name} has a negative bandwidth of {bw}. Bandwidth must be strictly positive.')
+        self._distances = None
+        self._bandwidth_constraints = None
+        self._pair_constraints = None
+        _check_switches(switches)
 
     def sources(self, dst):
         for src, bw in enumerate(self.links[dst]):
@@ -33,9 +42,66 @@ class Topology(object):
         return range(self.num_nodes())
     
     def bandwidth_constraints(self):
-        for dst, dst_links in enumerate(self.links):
-            for src, bw in enumerate(dst_links):
-                if bw > 0:
-                    yield ([src], [dst], bw, f'{src}→{dst}')
-        for srcs, dsts, bw, switch_name in self.switches:
-            yield (srcs, dsts, bw, switch_name)
+        '''
+        Returns the list of (srcs, dsts, bw, name) constraints of the topology: one per link followed by the switches.
+        The list is computed once and cached, so links and switches must not be modified afterwards.
+        '''
+        if self._bandwidth_constraints == None:
+            constraints = []
+            for dst in self.nodes():
+                for src in self.sources(dst):
+                    constraints.append(([src], [dst], self.link(src, dst), f'{src}→{dst}'))
+            for srcs, dsts, bw, switch_name in self.switches:
+                constraints.append((srcs, dsts, bw, switch_name))
+            self._bandwidth_constraints = constraints
+        return self._bandwidth_constraints
+
+    def constraints_of(self, src, dst):
+        '''
+        Returns the indices into bandwidth_constraints() of the constraints limiting sends from src to dst, in
+        increasing order.
+        '''
+        if self._pair_constraints == None:
+            pair_constraints = defaultdict(list)
+            for idx, (srcs, dsts, bw, _) in enumerate(self.bandwidth_constraints()):
+                for constraint_src in srcs:
+                    for constraint_dst in dsts:
+                        pair_constraints[(constraint_src, constraint_dst)].append(idx)
+            self._pair_constraints = dict(pair_constraints)
+        return self._pair_constraints.get((src, dst), [])
+
+    def distances(self):
+        '''
+        Returns a matrix of the least number of hops between nodes, indexed by source and then destination, with
+        math.inf for unreachable pairs. The matrix is computed once by a breadth-first search from each node and then
+        cached, so links must not be modified afterwards.
+        '''
+        if self._distances == None:
+            # The searches expand whole frontiers at once using bitmasks of the destinations of each node
+            destinations = [0] * self.num_nodes()
+            for dst in self.nodes():
+                for src in self.sources(dst):
+                    destinations[src] |= 1 << dst
+            dist = []
+            for src in self.nodes():
+                row = [math.inf] * self.num_nodes()
+                row[src] = 0
+                reached = frontier = 1 << src
+                hops = 0
+                while frontier:
+                    hops += 1
+                    expanded = 0
+                    while frontier:
+                        low = frontier & -frontier
+                        expanded |= destinations[low.bit_length() - 1]
+                        frontier ^= low
+                    frontier = expanded & ~reached
+                    reached |= frontier
+                    new = frontier
+                    while new:
+                        low = new & -new
+                        row[low.bit_length() - 1] = hops
+                        new ^= low
+                dist.append(row)
+            self._distances = dist
+        return self._distances
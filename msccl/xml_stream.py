@@ -0,0 +1,30 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from lxml import etree as ET
+
+def write_xml_stream(f, root, children, pretty_print=True):
+    '''
+    Writes the root element followed by the elements from the children iterable to the text file handle f, one child
+    at a time, so that only a single child has to be kept in memory. The output is the same as serializing the
+    complete tree with ET.tostring(encoding='unicode') after indenting it with ET.indent(space='  ') if pretty_print
+    is set. The root element itself must not have children.
+    '''
+    # Serializing the childless root gives its start tag with the escaping of lxml, just self-closing
+    empty_root = ET.tostring(root, encoding='unicode')
+    assert empty_root.endswith('/>')
+    is_empty = True
+    for child in children:
+        if is_empty:
+            f.write(empty_root[:-2] + '>')
+            is_empty = False
+        if pretty_print:
+            ET.indent(child, space='  ', level=1)
+            f.write('\n  ')
+        f.write(ET.tostring(child, encoding='unicode'))
+    if is_empty:
+        f.write(empty_root)
+    else:
+        if pretty_print:
+            f.write('\n')
+        f.write(f'</{root.tag}>')
@@ -3,9 +3,14 @@
 
 from setuptools import setup, find_packages
 
+# The version is kept in the package so that caches of compiled plans can be keyed by it
+version = {}
+with open('msccl/version.py') as f:
+    exec(f.read(), version)
+
 setup(
     name='msccl',
-    version='2.3.0',
+    version=version['__version__'],
     packages=find_packages(),
     entry_points={
         'console_scripts': [
@@ -18,3 +18,25 @@ def test_valid_empty():
     topo = fully_connected(num_nodes)
     algo = Algorithm.make_implementation(null_collective(num_nodes), topo, Instance(1), [Step(1,[])])
     assert algo != None
+
+def test_missing_chunk_reported():
+    num_nodes = 3
+    topo = fully_connected(num_nodes)
+    # Rank 1 receives chunk 0 but rank 2 gets nothing
+    with pytest.raises(RuntimeError, match='rank 0 does not get chunk 1'):
+        Algorithm.make_implementation(allgather(num_nodes), topo, Instance(1), [Step(1,[(0,0,1)])])
+
+def test_bandwidth_violation():
+    num_nodes = 2
+    topo = fully_connected(num_nodes)
+    with pytest.raises(AssertionError, match='constraint 1→0 only allows for 1 bandwidth'):
+        Algorithm.make_implementation(allgather(num_nodes), topo, Instance(1, chunks=2), [Step(1,[(0,0,1),(1,0,1),(2,1,0),(3,1,0)])])
+
+def test_pipelined_bandwidth_violation():
+    num_nodes = 2
+    topo = fully_connected(num_nodes)
+    steps = [Step(1,[(0,0,1),(1,1,0)]), Step(1,[]), Step(1,[(0,0,1),(1,1,0)])]
+    # Steps 0 and 2 overlap when pipelined with a period of 2
+    Algorithm('unpipelined', allgather(num_nodes), topo, Instance(3), steps)
+    with pytest.raises(AssertionError, match='Step 0 uses 2 bandwidth'):
+        Algorithm('pipelined', allgather(num_nodes), topo, Instance(3, pipeline=2), steps)
@@ -2,11 +2,87 @@
 # Licensed under the MIT License.
 
 import pytest
-from msccl.topologies import Topology
-from msccl.collectives import build_collective
+import json
+from msccl.topologies import Topology, dgx1, hub_and_spoke, star, amd8, ring, line, fully_connected
+from msccl.collectives import build_collective, allgather, alltoall, reduce_scatter, gather, broadcast
 from msccl.rounds_bound import *
+from msccl.steps_bound import lower_bound_steps
+from msccl.isomorphisms import find_automorphisms, find_isomorphisms, topology_certificate, IsomorphismCache
 
 def test_rounds_bound_unimplementable():
     topo = Topology('Unconnected', [[0,0],[0,0]])
     coll = build_collective('Send', 2, 1, lambda r, c: r == 0, lambda r, c: r == 1)
     assert lower_bound_rounds(topo, coll) == None
+    assert lower_bound_rounds(topo, coll, backend='z3') == None
+
+def test_steps_bound():
+    assert lower_bound_steps(dgx1(), allgather(8)) == 2
+    assert lower_bound_steps(ring(8), alltoall(8)) == 4
+    assert lower_bound_steps(line(5), broadcast(5, 0).chunk_up(2)) == 4
+    assert lower_bound_steps(star(4), gather(4, 0)) == 1
+    assert lower_bound_steps(Topology('Unconnected', [[0,0],[0,0]]), allgather(2)) == None
+
+def test_rounds_bound_backends():
+    for topo, coll in [(dgx1(), allgather(8)), (dgx1(), reduce_scatter(8)), (hub_and_spoke(4), alltoall(4)),
+        (fully_connected(5), alltoall(5)), (line(5), alltoall(5)), (star(5), gather(5, 0)), (amd8(), allgather(8).chunk_up(2))]:
+        native = lower_bound_rounds(topo, coll)
+        assert native == lower_bound_rounds(topo, coll, backend='z3')
+        assert isinstance(native, Fraction)
+    assert lower_bound_rounds(ring(6), allgather(6)) == Fraction(5, 2)
+    with pytest.raises(ValueError):
+        lower_bound_rounds(ring(4), allgather(4), backend='magic')
+
+def test_automorphisms():
+    assert len(find_automorphisms(dgx1())) == 4
+    assert len(find_automorphisms(hub_and_spoke(3))) == 6
+    assert len(find_automorphisms(star(4, non_blocking=False), limit=2)) == 2
+    assert len(find_isomorphisms(hub_and_spoke(3), hub_and_spoke(3))) == 0
+
+def test_isomorphism_backends():
+    for topology in [dgx1(), amd8(), ring(5)]:
+        native = find_isomorphisms(topology, topology)
+        z3 = find_isomorphisms(topology, topology, backend='z3')
+        assert sorted(perm.nodes for perm in native) == sorted(perm.nodes for perm in z3)
+    assert len(find_isomorphisms(amd8(), amd8(), limit=3)) == 3
+    assert find_isomorphisms(ring(4), line(4)) == []
+    with pytest.raises(ValueError):
+        find_isomorphisms(ring(4), ring(4), backend='magic')
+
+def _relabel(topology, perm):
+    links = [[topology.links[perm[dst]][perm[src]] for src in topology.nodes()] for dst in topology.nodes()]
+    return Topology(topology.name, links)
+
+def test_topology_certificate():
+    assert topology_certificate(dgx1()) == topology_certificate(_relabel(dgx1(), [3, 1, 6, 0, 7, 2, 5, 4]))
+    assert topology_certificate(ring(4)) != topology_certificate(line(4))
+    assert topology_certificate(ring(6)) != topology_certificate(star(6))
+
+def test_isomorphism_cache(tmp_path):
+    def as_lists(isomorphisms):
+        return sorted(isomorphism.nodes for isomorphism in isomorphisms)
+    relabeled = _relabel(dgx1(), [3, 1, 6, 0, 7, 2, 5, 4])
+    expected = as_lists(find_isomorphisms(dgx1(), relabeled))
+    cache = IsomorphismCache(tmp_path)
+    assert as_lists(find_isomorphisms(dgx1(), relabeled, cache=cache)) == expected
+    assert len(list(tmp_path.glob('*.json'))) == 1
+    cache = IsomorphismCache(tmp_path)
+    assert as_lists(cache.lookup(dgx1(), relabeled)) == expected
+    assert as_lists(find_isomorphisms(dgx1(), relabeled, cache=cache)) == expected
+    # Cached isomorphisms that do not map a relabeling of the topologies onto each other are misses
+    swapped = _relabel(dgx1(), [7, 6, 5, 4, 3, 2, 1, 0])
+    assert cache.lookup(swapped, relabeled) == None
+    assert as_lists(find_isomorphisms(swapped, relabeled, cache=cache)) == as_lists(find_isomorphisms(swapped, relabeled))
+    assert as_lists(cache.lookup(swapped, relabeled)) == as_lists(find_isomorphisms(swapped, relabeled))
+    assert cache.lookup(ring(8), relabeled) == None
+    # Entries store the certificates instead of the links
+    entry = json.loads(next(tmp_path.glob('*.json')).read_text())
+    assert sorted(entry.keys()) == ['certificate', 'isomorphisms']
+
+def test_isomorphism_cache_failed_store(tmp_path, monkeypatch):
+    def fail(src, dst):
+        raise OSError('replace failed')
+    monkeypatch.setattr('os.replace', fail)
+    cache = IsomorphismCache(tmp_path)
+    assert len(find_isomorphisms(ring(4), ring(4), cache=cache)) == 8
+    assert list(tmp_path.iterdir()) == []
+    assert len(cache.lookup(ring(4), ring(4))) == 8
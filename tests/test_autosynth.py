@@ -3,11 +3,21 @@
 
 import pytest
 import msccl
+import json
 import os
-from msccl.autosynth.registry import register_synthesis_plan
+import re
+import subprocess
+import sys
+from msccl.autosynth.registry import register_synthesis_plan, register_msccl_program, synthesis_plans
+from msccl.autosynth import plan_cache
+from msccl.autosynth.plan_cache import PlanCache
+from msccl.version import __version__
+from msccl.topologies import fully_connected
+from msccl.language import *
 
 
-def test_msccl_init(capsys):
+def test_msccl_init(capsys, tmp_path, monkeypatch):
+    monkeypatch.setenv('MSCCL_CACHE_DIR', str(tmp_path))
     msccl.init('not_a_machine_type', 4, ('alltoall', 0))
     out, err = capsys.readouterr()
     assert 'No plan found' in out
@@ -27,6 +37,8 @@ def test_msccl_init(capsys):
     assert 'ndv4_alltoall' in out
     assert 'NCCL_IB_AR_THRESHOLD' in os.environ
     assert 'NCCL_ALGO' in os.environ and os.environ['NCCL_ALGO'] == 'MSCCL,RING,FAKE_MSCCL'
+    with open(os.environ['MSCCL_CONFIG']) as f:
+        assert str(tmp_path / 'plans') in f.read()
 
     os.environ['NCCL_ALGO'] = 'HELLO,MSCCL,WORLD'
     msccl.init('ndv4', 16, (msccl.Collective.alltoall, '35MB'))
@@ -43,3 +55,94 @@ def test_register_plan():
     @register_synthesis_plan('allgather', ['m1', 'm2'], sizes=[(0, '4MB'), ('1GiB', None)])
     def dummy_plan(m, s):
         pass
+
+
+def test_plan_cache(tmp_path, monkeypatch):
+    monkeypatch.setenv('MSCCL_CACHE_DIR', str(tmp_path))
+    compiled = []
+
+    @register_msccl_program(fully_connected(2), 'allgather', 'cached_machine', chunk_factor=2)
+    def cached_allgather(prog, nodes):
+        compiled.append(nodes)
+        size = 2 * nodes
+        for r1 in range(size):
+            for r2 in range(size):
+                chunk(r1, Buffer.input, 0, 2).copy(r2, Buffer.output, 2 * r1)
+
+    _, plan, _, _, _, _ = synthesis_plans[('allgather', 'cached_machine')][0]
+    path = plan(1)
+    assert path.startswith(str(tmp_path / 'plans'))
+    assert plan(1) == path
+    assert compiled == [1]
+    assert plan(2) != path
+    assert compiled == [1, 2]
+    monkeypatch.setenv('MSCCL_BYPASS_PLAN_CACHE', '1')
+    assert plan(1) == path
+    assert compiled == [1, 2, 1]
+    with open(path) as f:
+        assert 'cached_allgather' in f.read()
+    # Lock files are removed once the entries exist
+    assert list((tmp_path / 'plans').glob('*.lock')) == []
+
+    # Edits to the sources of MSCCL invalidate the entries
+    fingerprint = plan_cache.plan_fingerprint(cached_allgather, {}, 1)
+    monkeypatch.setattr(plan_cache, '_package_source_hash_value', 'edited')
+    assert plan_cache.plan_fingerprint(cached_allgather, {}, 1) != fingerprint
+
+    # An unusable cache directory falls back to not caching
+    (tmp_path / 'file').write_text('')
+    assert PlanCache(tmp_path / 'file').path('key', lambda f: None) == None
+
+
+def test_precompiled_plans(tmp_path, monkeypatch):
+    monkeypatch.setenv('MSCCL_CACHE_DIR', str(tmp_path / 'cache'))
+    assert 0 == os.system(f'msccl plans compile ndv4 1 allreduce -d {tmp_path / "plans"}')
+    msccl.init('ndv4', 1, ('allreduce', '1MB'), precompiled=tmp_path / 'plans')
+    with open(os.environ['MSCCL_CONFIG']) as f:
+        paths = re.findall('path="([^"]*)"', f.read())
+    # Only the precompiled plans are loaded
+    assert paths == [str(tmp_path / 'plans' / 'allreduce.1.ndv4_ring_allreduce_config1.xml')]
+
+def test_broken_precompiled_plans(tmp_path, monkeypatch, capsys):
+    monkeypatch.setenv('MSCCL_CACHE_DIR', str(tmp_path / 'cache'))
+    # Missing, corrupt and partial manifests fall back to compiling the plans
+    (tmp_path / 'corrupt').mkdir()
+    (tmp_path / 'corrupt' / 'manifest.json').write_text('{"version": ')
+    (tmp_path / 'partial').mkdir()
+    (tmp_path / 'partial' / 'manifest.json').write_text(json.dumps({'version': __version__}))
+    for directory in ['missing', 'corrupt', 'partial']:
+        monkeypatch.setenv('MSCCL_PRECOMPILED_PLANS', str(tmp_path / directory))
+        msccl.init('ndv4', 1, ('allreduce', '1MB'))
+        out, err = capsys.readouterr()
+        assert f'Ignoring plans in {tmp_path / directory}' in out
+        with open(os.environ['MSCCL_CONFIG']) as f:
+            assert str(tmp_path / 'cache' / 'plans') in f.read()
+
+
+def _run_python(code):
+    return subprocess.run([sys.executable, '-c', code], stdout=subprocess.PIPE, check=True, universal_newlines=True).stdout
+
+def test_import_is_lazy():
+    # The compiler, the synthesizer, the plans and heavy dependencies are only imported once plans are needed
+    modules = set(_run_python('import sys, msccl; print(*sys.modules)').split())
+    for heavy in ['z3', 'lxml', 'humanfriendly', 'tabulate', 'msccl.language', 'msccl.programs', 'msccl.ncclize',
+        'msccl.strategies', 'msccl.isomorphisms', 'msccl.solution_cache', 'msccl.autosynth.ndv2_plans',
+        'msccl.autosynth.ndv4_plans']:
+        assert heavy not in modules
+
+@pytest.mark.benchmark
+def test_import_time():
+    code = 'import time; start = time.perf_counter(); import msccl; print(time.perf_counter() - start)'
+    assert min(float(_run_python(code)) for _ in range(3)) < 0.1
+
+def test_builtin_plans_loaded_lazily():
+    # Plans registered before the built-in ones are loaded still take precedence over them
+    code = """
+import msccl
+from msccl.autosynth.registry import register_ef_file, load_builtin_plans
+register_ef_file('custom.xml', 'alltoall', 'ndv4', 8, sizes=('1MB', '32MB'), protocol='LL128')
+print(*[desc for desc, _, _, _, _, _ in load_builtin_plans('ndv4')[('alltoall', 'ndv4')]], sep='\\n')
+"""
+    descs = _run_python(code).splitlines()
+    assert descs[-1] == 'load custom.xml'
+    assert 'run ndv4_alltoall_hierarchical_config1' in descs[:-1]
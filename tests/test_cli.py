@@ -5,6 +5,7 @@ from msccl.topologies import *
 from msccl.collectives import *
 from msccl.serialization import *
 
+import json
 import os
 import sys
 import tempfile
@@ -50,6 +51,8 @@ def test_extra_memory():
 def test_solve_least_steps():
     assert 0 == os.system('msccl solve least-steps Ring Allgather --nodes 2')
     assert 0 == os.system('msccl solve least-steps Ring Allgather --nodes 2 --initial-steps 2')
+    assert 0 == os.system('msccl solve least-steps Ring Allgather --nodes 4 --initial-steps 3 --incremental')
+    assert 0 == os.system('msccl solve least-steps DGX1 Allgather --symmetry-breaking')
 
 def test_solve_pareto_optimal():
     with in_tempdir():
@@ -60,6 +63,19 @@ def test_solve_pareto_optimal():
         assert len(os.listdir('.')) == 2
     assert 0 == os.system('msccl solve pareto-optimal Ring Alltoall --nodes 2 --assume-rpc-bound 1/1')
     assert 0 == os.system('msccl solve pareto-optimal Ring Alltoall --nodes 2 --no-monotonic-feasibility')
+    assert 0 == os.system('msccl solve pareto-optimal Ring Alltoall --nodes 2 --incremental')
+    assert 0 == os.system('msccl solve pareto-optimal Ring Allgather --nodes 4 --max-chunks 3 --workers 4')
+    assert 0 != os.system('msccl solve pareto-optimal Ring Allgather --nodes 4 --incremental --workers 2 2>/dev/null')
+
+def test_solution_cache():
+    with in_tempdir():
+        assert 0 == os.system('msccl solve instance Ring Allgather --nodes 4 --steps 2 --cache-dir cache --no-save')
+        assert len(os.listdir('cache')) == 1
+        assert 0 == os.system('msccl solve least-steps Ring Allgather --nodes 4 --initial-steps 3 --cache-dir cache --no-save')
+        assert len(os.listdir('cache')) == 2
+        assert 0 == os.system('msccl solve least-steps Ring Allgather --nodes 4 --cache-dir cache --bypass-cache --no-save')
+        assert 0 == os.system('msccl solve pareto-optimal Ring Allgather --nodes 4 --cache-dir cache --clear-cache --no-save')
+        assert 0 != os.system('msccl solve instance Ring Allgather --nodes 4 --steps 2 --cache --cache-max-size lots')
 
 def test_ncclize():
     with in_tempdir():
@@ -70,10 +86,34 @@ def test_ncclize():
         assert 0 == os.system('msccl ncclize algo.json -f --channel-policy One')
         assert 0 == os.system('msccl ncclize algo.json -f --channel-policy MatchTopology')
         assert 0 == os.system('msccl ncclize algo.json -f --no-merge-contiguous')
+        assert 0 == os.system('msccl ncclize algo.json -f --workers 2')
+        assert 0 == os.system('msccl ncclize algo.json -f --threadblock-policy MinThreadblocks')
         assert 0 == os.system('msccl solve instance Star Alltoall --nodes 4 --steps 2 --rounds 4 -o algo_scratch.json')
         assert 0 == os.system('msccl ncclize algo_scratch.json -f --remap-scratch')
+        assert 0 == os.system('msccl ncclize algo_scratch.json -f --remap-scratch --optimize-scratch-remap')
         assert 0 == os.system('msccl ncclize algo_scratch.json -f --greedy-scratch-sorting')
 
+def test_plans_profile():
+    with in_tempdir():
+        assert 0 == os.system('msccl plans profile ndv4 allreduce 1 --json profile.jsonl')
+        with open('profile.jsonl') as f:
+            profiles = [json.loads(line) for line in f]
+        assert len(profiles) == 4
+        assert all(p['machines'] == 1 for p in profiles)
+        assert 0 != os.system('msccl plans profile ndv4 allreduce 2')
+
+def test_plans_compile():
+    with in_tempdir():
+        assert 0 == os.system('MSCCL_CACHE_DIR=cache msccl plans compile ndv4 1-2 allreduce -d plans -j 2')
+        with open(os.path.join('plans', 'manifest.json')) as f:
+            manifest = json.load(f)
+        assert len(manifest['plans']) == 4
+        assert all(p['machines'] == 1 for p in manifest['plans'])
+        assert all(os.path.exists(os.path.join('plans', p['file'])) for p in manifest['plans'])
+        assert os.path.exists(os.path.join('plans', 'msccl_algos.1.xml'))
+        assert 0 != os.system('msccl plans compile ndv4 2 allreduce -d plans')
+        assert 0 != os.system('msccl plans compile ndv4 1-x allreduce -d plans')
+
 def test_custom_topology_and_collective():
     with in_tempdir():
         topo = Topology('CT', [[0, 1], [1, 0]])
@@ -84,9 +124,12 @@ def test_custom_topology_and_collective():
 
 def test_solve_bound_rounds():
     assert '7/6' in os.popen('msccl analyze rounds DGX1 Allgather').read()
+    assert '7/6' in os.popen('msccl analyze rounds DGX1 Allgather --backend z3').read()
 
 def test_find_isomorphisms():
     assert 0 == os.system('msccl analyze isomorphisms DGX1 DGX1')
+    assert 0 == os.system('msccl analyze isomorphisms DGX1 DGX1 --backend z3')
+    assert 0 == os.system('msccl analyze isomorphisms DGX1 DGX1 --no-cache')
 
 def test_distribute_alltoall_greedy():
     with in_tempdir():
@@ -0,0 +1,50 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from msccl.collectives import *
+from msccl.serialization import MSCCLEncoder, MSCCLDecoder
+
+def test_condition_accessors():
+    coll = alltoall(3)
+    assert coll.num_chunks == 9
+    assert coll.precondition_mask(5) == 0b100
+    assert coll.postcondition_ranks(5) == [1]
+    assert coll.precondition_chunks(1) == [1, 4, 7]
+    assert coll.postcondition_chunks(1) == [3, 4, 5]
+    assert allgather(4).postcondition_ranks(0) == [0, 1, 2, 3]
+    assert gather(4, 7).postcondition_mask(0) == 0
+
+def test_chunk_up():
+    coll = allreduce(3).chunk_up(2)
+    assert coll.num_chunks == 6
+    assert coll.num_addresses == 2
+    assert coll.is_combining
+    assert [coll.address(chunk) for chunk in coll.chunks()] == [0, 1, 0, 1, 0, 1]
+    assert coll.precondition_chunks(1) == [2, 3]
+    assert all(coll.precondition(1, chunk) == (chunk in (2, 3)) for chunk in coll.chunks())
+    # Chunking up twice is the same as chunking up once by the product
+    twice = alltoall(3).chunk_up(2).chunk_up(3)
+    once = alltoall(3).chunk_up(6)
+    for chunk in once.chunks():
+        assert twice.address(chunk) == once.address(chunk)
+        assert twice.precondition_mask(chunk) == once.precondition_mask(chunk)
+        assert twice.postcondition_mask(chunk) == once.postcondition_mask(chunk)
+
+def test_chunked_up_roundtrip():
+    coll = alltoall(3).chunk_up(2)
+    decoded = MSCCLDecoder().decode(MSCCLEncoder().encode(coll))
+    assert decoded.num_chunks == coll.num_chunks
+    for chunk in coll.chunks():
+        assert decoded.address(chunk) == coll.address(chunk)
+        assert decoded.precondition_ranks(chunk) == coll.precondition_ranks(chunk)
+        assert decoded.postcondition_ranks(chunk) == coll.postcondition_ranks(chunk)
+
+def test_from_masks():
+    coll = Collective.from_masks('Send', 2, [0b01], [0b10], [0], {(1, 0): 3})
+    assert coll.precondition_ranks(0) == [0]
+    assert coll.postcondition_ranks(0) == [1]
+    assert coll.trigger(1, 0) == 3
+    assert coll.triggers() == {(1, 0): 3}
+    chunked = Collective.from_masks('Send', 2, [0b01], [0b10], [0], div=2)
+    assert chunked.num_chunks == 2
+    assert [chunked.address(chunk) for chunk in chunked.chunks()] == [0, 1]
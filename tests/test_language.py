@@ -6,8 +6,17 @@ from msccl.topologies import line, fully_connected
 from msccl.language import *
 from msccl.language.routines import *
 from msccl.language.collectives import *
+from msccl.language import rank_dag
+from msccl.language.rank_dag import SlotIntervals, visit_once
+from collections import defaultdict
+import copy
+import io
+import json
 import os
 import pytest
+import random
+import time
+import xml.etree.ElementTree as ET
 
 class Send(Collective):
     # Initial state is chunk0 is on rank0 in the input buffer
@@ -219,11 +228,255 @@ def test_replication():
             chunk(1, Buffer.input, 0).copy(0, Buffer.output, 1)
             chunk(1, Buffer.input, 1).copy(1, Buffer.output, 1)
 
+    xml = ET.fromstring(prgm.generate_xml())
+    replicated_xml = ET.fromstring(replicated_prgm.generate_xml())
+
+    for gpu1, gpu2 in zip(xml.findall('gpu'), replicated_xml.findall('gpu')):
+        tbs1 = gpu1.findall('tb')
+        tbs2 = gpu2.findall('tb')
+        assert len(tbs1) * instances == len(tbs2)
+        assert sorted(int(tb.get('id')) for tb in tbs2) == list(range(len(tbs2)))
+        # Interleaved replication puts instance i of chunk c at c * instances + i
+        offsets1 = sorted(int(step.get('dstoff')) for tb in tbs1 for step in tb.findall('step') if step.get('dstbuf') == 'o')
+        offsets2 = sorted(int(step.get('dstoff')) for tb in tbs2 for step in tb.findall('step') if step.get('dstbuf') == 'o')
+        assert offsets2 == sorted(c * instances + i for c in offsets1 for i in range(instances))
+    assert int(replicated_xml.get('nchannels')) == instances * int(xml.get('nchannels'))
+
+def test_dependency_nop_order():
+    num_ranks = 5
+    topology = fully_connected(num_ranks)
+    collective = AllGather(num_ranks, 1, False)
+    prgm = MSCCLProgram("allgather", topology, collective, 1)
+    with prgm:
+        for r in range(num_ranks):
+            chunk(r, Buffer.input, 0).copy(r, Buffer.output, r)
+        for r in reversed(range(1, num_ranks)):
+            chunk(r, Buffer.input, 0).copy(0, Buffer.output, r)
+        received = chunk(0, Buffer.output, 1, num_ranks - 1)
+        for r in range(1, num_ranks):
+            received.copy(r, Buffer.output, 1)
+            chunk(0, Buffer.output, 0).copy(r, Buffer.output, 0)
+        assert Check()
+        xml = ET.fromstring(prgm.generate_xml())
+
+    # The sends of the received chunks depend on all receiving threadblocks. The dependency on the first of them stays
+    # on the op and the others are expanded into nops before it in threadblock order.
+    gpu = xml.findall('gpu')[0]
+    recv_tbs = sorted(int(tb.get('id')) for tb in gpu.findall('tb') if tb.get('recv') != '-1')
+    for tb in gpu.findall('tb'):
+        if tb.get('send') != '-1':
+            steps = [(step.get('type'), int(step.get('depid'))) for step in tb.findall('step')]
+            first = steps.index(('nop', recv_tbs[1]))
+            expected = [('nop', tb_id) for tb_id in recv_tbs[1:]] + [('s', recv_tbs[0])]
+            assert steps[first:first + num_ranks - 1] == expected
+
+def test_lowering_profile():
+    topology = fully_connected(3)
+    collective = AllReduce(3, 3, True)
+    prgm = MSCCLProgram("allreduce", topology, collective, 2, profile=True)
+    with prgm:
+        allreduce_ring_inplace(3)
+    prgm.generate_xml()
+    names = [p.name for p in prgm.profile.passes]
+    assert names == ['convert_set_list', 'optimize', 'complete_metadata', 'auto_assign_tbs', 'lower_pt1', 'lower_pt2',
+        'check_threadblocks', 'ir_to_xml']
+    ops = 2 * sum(len(tb.ops) for rank_tbs in prgm.instr_dag.tbs for tb in rank_tbs.values())
+    assert prgm.profile.passes[-1].ops == ops
+    assert prgm.profile.passes[-1].threadblocks == 2 * prgm.profile.passes[3].threadblocks
+    assert json.loads(prgm.profile.to_json())['passes'][0]['name'] == 'convert_set_list'
+    assert 'total' in prgm.profile.table()
+
+    prgm = MSCCLProgram("allreduce", topology, collective, 1)
+    with prgm:
+        allreduce_ring_inplace(3)
+    prgm.lower()
+    assert prgm.profile == None
+
+def _matched_ops(src_rank, dst_rank, index):
+    ref = ChunkRef(src_rank, Buffer.input, index, 1)
+    send = Op(Instruction.send, src_rank, ref, ChunkRef(dst_rank, Buffer.input, index, 1))
+    recv = Op(Instruction.recv, dst_rank, ref, ChunkRef(dst_rank, Buffer.input, index, 1))
+    send.recv_match = recv
+    recv.send_match = send
+    return send, recv
+
+def _threadblocks(rank_ops):
+    tbs = []
+    for ops in rank_ops:
+        tb = Threadblock(ops=ops)
+        for step, op in enumerate(ops):
+            op.step = step
+            op.tb = 0
+        tbs.append({0: tb})
+    return tbs
+
+def test_threadblock_violations():
+    # Both ranks wait for the other to send before sending themselves
+    s01, r01 = _matched_ops(0, 1, 0)
+    s10, r10 = _matched_ops(1, 0, 0)
+    violations = find_threadblock_violations(_threadblocks([[r10, s01], [r01, s10]]))
+    assert len(violations) == 3
+    assert violations[0].startswith('Rank 0 threadblock 0 can not run past step 0')
+    assert violations[1].startswith('Rank 1 threadblock 0 can not run past step 0')
+    assert violations[2].startswith('Cyclic dependency')
+    assert all(str(op) in violations[2] for op in [s01, r01, s10, r10])
+    # Without strict checking only cycles of dependencies count
+    assert find_threadblock_violations(_threadblocks([[r10, s01], [r01, s10]]), strict=False) == []
+
+    # Receives in the opposite order of the sends do not deadlock but mix up the chunks
+    sa, ra = _matched_ops(0, 1, 0)
+    sb, rb = _matched_ops(0, 1, 1)
+    violations = find_threadblock_violations(_threadblocks([[sa, sb], [rb, ra]]))
+    assert len(violations) == 1
+    assert 'opposite order' in violations[0]
+
+    sa, ra = _matched_ops(0, 1, 0)
+    sb, rb = _matched_ops(0, 1, 1)
+    assert find_threadblock_violations(_threadblocks([[sa, sb], [ra, rb]])) == []
+
+    # Dependencies across threadblocks are part of the ordering
+    sa, ra = _matched_ops(0, 1, 0)
+    sb, rb = _matched_ops(1, 0, 1)
+    sa.depends = [rb]
+    rb.depends = [sa]
+    tbs = _threadblocks([[sa], [ra]])
+    tbs[0][1] = Threadblock(ops=[rb])
+    tbs[1][1] = Threadblock(ops=[sb])
+    rb.tb = sb.tb = 1
+    violations = find_threadblock_violations(tbs)
+    # Both threadblocks of rank 0 and the one on rank 1 waiting for the send of rank 0 are blocked
+    assert len(violations) == 4
+    assert violations[-1].startswith('Cyclic dependency')
+    assert str(ra) not in violations[-1]
+    violations = find_threadblock_violations(tbs, strict=False)
+    assert violations[-1].startswith('Cyclic dependency')
+    with pytest.raises(SystemExit):
+        check_dependency_cycles(tbs)
+
+    # Dependencies on ops that are in no threadblock are reported
+    sa, ra = _matched_ops(0, 1, 0)
+    dropped, _ = _matched_ops(1, 0, 1)
+    ra.depends = [dropped]
+    violations = find_threadblock_violations(_threadblocks([[sa], [ra]]))
+    assert len(violations) == 1
+    assert 'in no threadblock' in violations[0]
+
+def test_threadblock_ordering_compatibility():
+    sa, ra = _matched_ops(0, 1, 0)
+    sb, rb = _matched_ops(0, 1, 1)
+    dag = InstructionDAG(2, [])
+    dag.tbs = _threadblocks([[sa, sb], [ra, rb]])
+    check_threadblock_ordering(dag)
+    check_dependency_cycles(dag.tbs)
+    dag.tbs = _threadblocks([[sa, sb], [rb, ra]])
+    with pytest.raises(AssertionError):
+        check_threadblock_ordering(dag)
+
+def test_shared_successors():
+    num_gpus = 3
+    topology = fully_connected(num_gpus)
+    collective = Send(num_gpus, 1, inplace=False)
+    prgm = MSCCLProgram("diamonds", topology, collective, 1)
+    with prgm:
+        # Every rewrite of scratch 0 waits for both of its readers, doubling the number of paths through the DAG
+        c = chunk(0, Buffer.input, 0).copy(0, 'scratch', 0)
+        for _ in range(64):
+            c.copy(0, 'scratch', 1)
+            c.copy(0, 'scratch', 2)
+            c = chunk(0, 'scratch', 1).copy(0, 'scratch', 0)
+        c.copy(1, 'scratch').copy(2, Buffer.output, 0)
+        assert Check()
     lowered_prgm = prgm.lower()
-    lowered_replicated_prgm = replicated_prgm.lower()
+    ops = [op for tb in lowered_prgm.gpus[0].threadblocks for op in tb.ops]
+    assert len(ops) == 64 * 3 + 2
+    assert max(op.chunk_step for op in ops) == 64 * 2 + 1
+
+def test_slot_intervals():
+    # Compare against tracking the last writer and readers of every slot on its own
+    rng = random.Random(0)
+    intervals = SlotIntervals()
+    last_writer = {}
+    last_readers = defaultdict(list)
+    for op in range(2000):
+        index = rng.randrange(64)
+        size = rng.randrange(1, 9)
+        slots = range(index, index+size)
+        if rng.random() < 0.5:
+            expected = set()
+            for i in slots:
+                if len(last_readers[i]) > 0:
+                    expected.update(last_readers[i])
+                elif i in last_writer:
+                    expected.add(last_writer[i])
+            expected_unwritten = [i for i in slots if i not in last_writer]
+            for i in slots:
+                last_writer[i] = op
+                last_readers[i] = []
+            assert intervals.write(index, size, op) == (expected, expected_unwritten)
+        else:
+            expected = set(last_writer[i] for i in slots if i in last_writer)
+            expected_unwritten = [i for i in slots if i not in last_writer]
+            for i in slots:
+                if i in last_writer:
+                    last_readers[i].append(op)
+            assert intervals.read(index, size, op) == (expected, expected_unwritten)
+
+def _alltoall_hierarchical(num_nodes, gpus_per_node):
+    num_ranks = num_nodes * gpus_per_node
+    topology = fully_connected(num_ranks)
+    collective = AllToAll(num_ranks, 1, inplace=False)
+    prgm = MSCCLProgram("hierarchical_all_to_all", topology, collective, 1)
+    with prgm:
+        for n1 in range(num_nodes):
+            for n2 in range(num_nodes):
+                if n1 != n2:
+                    # Gather chunks for node n2 on the gpus of n1, then send them in one go to their peer on n2
+                    for g1 in range(gpus_per_node):
+                        for g2 in range(gpus_per_node):
+                            chunk(n1 * gpus_per_node + g1, Buffer.input, n2 * gpus_per_node + g2).copy(n1 * gpus_per_node + g2, f'copy_{n2}')
+                    for g in range(gpus_per_node):
+                        c = chunk(n1 * gpus_per_node + g, f'copy_{n2}', 0, gpus_per_node)
+                        c.copy(n2 * gpus_per_node + g, Buffer.output, c.get_dst_index())
+        for rank in range(num_ranks):
+            for g in range(gpus_per_node):
+                c = chunk(rank, Buffer.input, (rank // gpus_per_node) * gpus_per_node + g)
+                c.copy(c.get_dst_rank(), Buffer.output, c.get_dst_index())
+        assert Check()
+    return prgm
 
-    for gpu1, gpu2 in zip(lowered_prgm.gpus, lowered_replicated_prgm.gpus):
-        assert len(gpu1.threadblocks) * instances == len(gpu2.threadblocks)
+def _lowering_time(prgm):
+    start = time.perf_counter()
+    lowered_prgm = prgm.lower()
+    elapsed = time.perf_counter() - start
+    num_ops = sum(len(tb.ops) for gpu in lowered_prgm.gpus for tb in gpu.threadblocks)
+    return elapsed, num_ops
+
+def test_lowering_visits_each_op_once(monkeypatch):
+    visits = []
+    def counting_visit_once(roots):
+        visited = []
+        visits.append(visited)
+        for op in visit_once(roots):
+            visited.append(op)
+            yield op
+    monkeypatch.setattr(rank_dag, 'visit_once', counting_visit_once)
+    prgm = _alltoall_hierarchical(4, 4)
+    lowered_prgm = prgm.lower()
+    num_ops = sum(len(tb.ops) for gpu in lowered_prgm.gpus for tb in gpu.threadblocks)
+    num_starts = sum(1 for op in prgm.instr_dag.operations.values() if op.inst == Instruction.start)
+    # convert_set_list, _optimize_rcs, _optimize_rrcs_rrs and infer_dependencies each walk the DAG once
+    assert len(visits) == 4
+    for visited in visits:
+        assert len(set(id(op) for op in visited)) == len(visited)
+    assert len(visits[-1]) == num_ops + num_starts
+
+@pytest.mark.benchmark
+def test_lowering_scales_linearly():
+    # Hierarchical alltoall on 16 nodes has 16x the operations of 4 nodes, lowering time per op should stay flat
+    small_time, small_ops = _lowering_time(_alltoall_hierarchical(4, 8))
+    large_time, large_ops = _lowering_time(_alltoall_hierarchical(16, 8))
+    assert large_ops > 10 * small_ops
+    assert large_time / large_ops < 4 * small_time / small_ops
 
 def test_illegal_tb_assignment():
     num_gpus = 3
@@ -287,4 +540,17 @@ def test_routines_allreduce_nodes():
             c.reduce(chunk(r, Buffer.output, exchange_index, 4))
             c = c.copy(r, Buffer.output, exchange_index)
         XML()
-        assert Check()
\ No newline at end of file
+        assert Check()
+
+def test_streamed_xml():
+    topology = fully_connected(3)
+    collective = AllReduce(3, 3, True)
+    with MSCCLProgram("streamed<&>", topology, collective, 2):
+        allreduce_ring_inplace(3)
+        program = msccl.language._curr().lower()
+    for pretty_print in [True, False]:
+        f = io.StringIO()
+        assert ir_to_xml(copy.deepcopy(program), pretty_print=pretty_print, file=f) == None
+        assert f.getvalue() == ir_to_xml(copy.deepcopy(program), pretty_print=pretty_print)
+    empty = Program('empty', 'custom', False, 'Simple')
+    assert ir_to_xml(empty, old_format=False) == '<algo name="empty" proto="Simple" nchannels="0" ngpus="0" coll="custom" inplace="0"/>'
@@ -0,0 +1,69 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+from msccl.ncclize import ncclize, ThreadblockPolicy, _Gpu, _allocate_scratch_intervals, _match_groups
+from msccl.strategies import solve_instance
+from msccl.topologies import star, ring, dgx1
+from msccl.algorithm import Algorithm, Step
+from msccl.collectives import alltoall, allgather
+from msccl.instance import Instance
+import io
+import math
+import pytest
+import re
+
+def test_allocate_scratch_intervals():
+    # Input 0 is last read on step 1 and output 0 is first written on step 3
+    gpu = _Gpu([], [], {'i0': 0}, {'o0': 0}, 1, 1, scratch={'a': 0, 'b': 1, 'c': 2, 'd': 3})
+    liveness = ({0: [[(-1, 1)]]}, {0: [[(3, math.inf)]]}, {0: [[(0, 1)], [(1, 2)], [(2, 2)], [(2, 4)]]})
+    new_idxs = _allocate_scratch_intervals(0, gpu, liveness)
+    # a and c fit before output 0 is written, b overlaps both of them and input 0 and d reuses input 0
+    assert new_idxs == {'a': 1, 'b': 2, 'c': 1, 'd': 0}
+
+def test_remap_scratch_deterministic():
+    algo = solve_instance(star(4), alltoall(4), Instance(2, extra_rounds=2), logging=False)
+    xml = ncclize(algo, remap_scratch=True)
+    assert xml == ncclize(algo, remap_scratch=True)
+    optimized = ncclize(algo, remap_scratch=True, optimize_scratch_remap=True)
+    # The interval allocation is optimal for these livenesses, so Z3 can not improve on it
+    scratch_sizes = lambda xml: [int(size) for size in re.findall(r's_chunks="(\d+)"', xml)]
+    assert scratch_sizes(xml) == scratch_sizes(optimized)
+
+def test_ncclize_workers(monkeypatch):
+    num_nodes = 32
+    topology = ring(num_nodes)
+    # A ring allgather has dependency chains spanning all of its steps
+    steps = [Step(1, [((rank - step) % num_nodes, rank, (rank + 1) % num_nodes) for rank in range(num_nodes)])
+        for step in range(num_nodes - 1)]
+    algo = Algorithm.make_implementation(allgather(num_nodes), topology, Instance(num_nodes - 1), steps)
+    serial = ncclize(algo, instances=2)
+    # Small algorithms are lowered without starting worker processes
+    def no_pool(processes):
+        raise AssertionError('worker processes started')
+    monkeypatch.setattr('multiprocessing.Pool', no_pool)
+    assert ncclize(algo, instances=2, workers=2) == serial
+    monkeypatch.undo()
+    monkeypatch.setattr('msccl.ncclize._MIN_PARALLEL_OPS', 0)
+    assert ncclize(algo, instances=2, workers=2) == serial
+    with pytest.raises(ValueError):
+        ncclize(algo, workers=0)
+
+def test_match_groups():
+    # Greedily pairing the first send group with the first receive group would leave both receive groups unmatched
+    assert _match_groups([0b001, 0b010], [0b100, 0b010]) == [1, 0]
+    assert _match_groups([0b011], [0b001, 0b010]) == [None]
+
+def test_threadblock_policies():
+    for topology, instance in [(dgx1(), Instance(2)), (ring(4), Instance(3, chunks=2))]:
+        algo = solve_instance(topology, allgather(topology.num_nodes()), instance, logging=False)
+        first_fit = ncclize(algo, threadblock_policy=ThreadblockPolicy.FirstFit)
+        min_tbs = ncclize(algo, threadblock_policy=ThreadblockPolicy.MinThreadblocks)
+        assert min_tbs.count('<tb ') <= first_fit.count('<tb ')
+        assert min_tbs.count('<step ') == first_fit.count('<step ')
+
+def test_ncclize_to_file():
+    algo = solve_instance(star(4), alltoall(4), Instance(2, extra_rounds=2), logging=False)
+    for pretty_print in [True, False]:
+        f = io.StringIO()
+        assert ncclize(algo, pretty_print=pretty_print, file=f) == None
+        assert f.getvalue() == ncclize(algo, pretty_print=pretty_print)
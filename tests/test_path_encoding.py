@@ -2,7 +2,7 @@
 # Licensed under the MIT License.
 
 from msccl.path_encoding import PathEncoding
-from msccl.topologies import fully_connected, line, dgx1
+from msccl.topologies import fully_connected, line, dgx1, hub_and_spoke
 from msccl.collectives import *
 from msccl.instance import Instance
 
@@ -47,3 +47,30 @@ def test_memory_constraint():
     enc = PathEncoding(topo, alltoall(topo.num_nodes()))
     assert enc.solve(Instance(2, extra_memory=0)) == None
     assert enc.solve(Instance(2, extra_memory=1)) != None
+
+def test_incremental():
+    topo = dgx1()
+    coll = allgather(topo.num_nodes())
+    enc = PathEncoding(topo, coll, incremental=True)
+    assert enc.solve(Instance(1)) == None
+    assert enc.solve(Instance(2)) != None
+    assert enc.solve(Instance(1)) == None
+    assert enc.solve(Instance(2, extra_rounds=1, chunks=2)) != None
+    enc = PathEncoding(line(3), alltoall(3), incremental=True)
+    assert enc.solve(Instance(2, extra_memory=0)) == None
+    assert enc.solve(Instance(2, extra_memory=1)) != None
+    enc = PathEncoding(fully_connected(2), allreduce(2), incremental=True)
+    assert enc.solve(Instance(1, chunks=2)) == None
+    assert enc.solve(Instance(2, chunks=2)) != None
+
+def test_symmetry_breaking():
+    topo = dgx1()
+    enc = PathEncoding(topo, allgather(topo.num_nodes()), symmetry_breaking=True)
+    assert enc.solve(Instance(1)) == None
+    assert enc.solve(Instance(2)) != None
+    topo = hub_and_spoke(4)
+    enc = PathEncoding(topo, alltoall(topo.num_nodes()), symmetry_breaking=True)
+    assert enc.solve(Instance(1, extra_rounds=1)) == None
+    assert enc.solve(Instance(1, extra_rounds=2)) != None
+    enc = PathEncoding(fully_connected(3), allreduce(3), symmetry_breaking=True)
+    assert enc.solve(Instance(2, extra_memory=0)) != None
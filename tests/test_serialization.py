@@ -4,7 +4,7 @@
 from .common import *
 from msccl.serialization import MSCCLEncoder, MSCCLDecoder
 from msccl.algorithm import Algorithm, Step
-from msccl.topologies import fully_connected
+from msccl.topologies import fully_connected, distributed_hub_and_spoke, star
 from msccl.instance import Instance
 
 def test_algorithm_roundtrip():
@@ -22,3 +22,12 @@ def test_algorithm_roundtrip():
     assert algo2.name == name
     assert algo2.instance == instance
     assert algo2.steps == steps
+
+def test_distributed_topology_roundtrip():
+    topo1 = distributed_hub_and_spoke(star(4), 3, 2)
+    json = MSCCLEncoder().encode(topo1)
+    assert json.count('links') == 1
+    topo2 = MSCCLDecoder().decode(json)
+    assert topo2.name == topo1.name
+    assert topo2.links == topo1.links
+    assert topo2.switches == topo1.switches
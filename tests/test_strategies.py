@@ -0,0 +1,68 @@
+# Copyright (c) Microsoft Corporation.
+# Licensed under the MIT License.
+
+import pytest
+from msccl.strategies import *
+from msccl.solution_cache import SolutionCache
+from msccl.topologies import ring, line, distributed_fully_connected
+from msccl.collectives import allgather
+
+def test_least_steps_incremental():
+    topo = line(4)
+    coll = allgather(topo.num_nodes())
+    algo = solve_least_steps(topo, coll, initial_steps=5, incremental=True)
+    assert algo.num_steps() == 3
+
+def test_pareto_parallel_matches_sequential():
+    topo = ring(6)
+    coll = allgather(topo.num_nodes())
+    sequential = list(solve_all_latency_bandwidth_tradeoffs(topo, coll, max_chunks=3, assume_monotonic_feasibility=True))
+    parallel = list(solve_all_latency_bandwidth_tradeoffs(topo, coll, max_chunks=3, assume_monotonic_feasibility=True, workers=4))
+    assert len(sequential) == 2
+    assert [algo.name for algo in parallel] == [algo.name for algo in sequential]
+
+def test_pareto_invalid_workers():
+    with pytest.raises(ValueError):
+        next(solve_all_latency_bandwidth_tradeoffs(ring(2), allgather(2), workers=0))
+    with pytest.raises(ValueError):
+        next(solve_all_latency_bandwidth_tradeoffs(ring(2), allgather(2), incremental=True, workers=2))
+
+def test_solution_cache(tmp_path):
+    topo = ring(4)
+    coll = allgather(topo.num_nodes())
+    cache = SolutionCache(tmp_path)
+    algo = solve_instance(topo, coll, Instance(2), cache=cache)
+    assert solve_instance(topo, coll, Instance(1), cache=cache) == None
+    assert len(list(tmp_path.glob('*.json'))) == 2
+    assert cache.lookup(topo, coll, Instance(1)) == (True, None)
+    hit, cached = cache.lookup(ring(4), allgather(4), Instance(2))
+    assert hit and cached.steps == algo.steps
+    assert cache.lookup(topo, coll, Instance(3)) == (False, None)
+    assert SolutionCache(tmp_path, bypass=True).lookup(topo, coll, Instance(1)) == (False, None)
+    cache.clear()
+    assert cache.lookup(topo, coll, Instance(1)) == (False, None)
+
+def test_solution_cache_distributed_topology(tmp_path):
+    topo = distributed_fully_connected(ring(2), 2, 1)
+    coll = allgather(topo.num_nodes())
+    cache = SolutionCache(tmp_path)
+    cache.store(topo, coll, Instance(1), None)
+    assert cache.lookup(distributed_fully_connected(ring(2), 2, 1), coll, Instance(1)) == (True, None)
+    assert cache.lookup(distributed_fully_connected(ring(2), 3, 1), allgather(6), Instance(1)) == (False, None)
+    # The fingerprint is taken from the compact form, so the links between all ranks are never materialized
+    assert topo._links == None
+
+def test_solution_cache_eviction(tmp_path):
+    topo = ring(4)
+    coll = allgather(topo.num_nodes())
+    cache = SolutionCache(tmp_path, max_size=1)
+    solve_instance(topo, coll, Instance(1), cache=cache)
+    assert len(list(tmp_path.glob('*.json'))) == 0
+
+def test_solution_cache_failed_store(tmp_path, monkeypatch):
+    def fail(src, dst):
+        raise OSError('replace failed')
+    monkeypatch.setattr('os.replace', fail)
+    with pytest.raises(OSError):
+        SolutionCache(tmp_path).store(ring(4), allgather(4), Instance(1), None)
+    assert list(tmp_path.iterdir()) == []
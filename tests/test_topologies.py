@@ -2,6 +2,7 @@
 # Licensed under the MIT License.
 
 from msccl.topologies import *
+import math
 
 def test_local_topologies():
     assert hub_and_spoke(4) != None
@@ -48,3 +49,43 @@ Legend:
     topo = nvlink_only(dgx1_topo)
     assert topo != None
     assert topo.num_nodes() == 8
+
+def test_distances():
+    dist = line(4).distances()
+    assert dist[0] == [0, 1, 2, 3]
+    assert dist[3][0] == 3
+    assert line(4).distances() is not dist
+    topology = ring(5)
+    assert topology.distances() is topology.distances()
+    assert Topology('Unconnected', [[0, 0], [0, 0]]).distances() == [[0, math.inf], [math.inf, 0]]
+
+def test_distributed_topology_matches_dense():
+    for make_topology in [distributed_fully_connected, distributed_hub_and_spoke]:
+        for local, bw in [(dgx1(), 1), (star(3), 2), (ring(4), 0)]:
+            if make_topology == distributed_hub_and_spoke and bw == 0:
+                continue
+            topology = make_topology(local, 3, bw)
+            dense = Topology(topology.name, topology.links, topology.switches)
+            assert topology.num_nodes() == dense.num_nodes()
+            for node in topology.nodes():
+                assert list(topology.sources(node)) == list(dense.sources(node))
+                assert list(topology.destinations(node)) == list(dense.destinations(node))
+                assert [topology.link(src, node) for src in topology.nodes()] == dense.links[node]
+            assert list(topology.bandwidth_constraints()) == list(dense.bandwidth_constraints())
+            assert topology.distances() == dense.distances()
+
+def test_distributed_topology_is_sparse():
+    topology = distributed_fully_connected(fully_connected(4), 256, 1)
+    assert topology.num_nodes() == 1024
+    assert list(topology.sources(5)) == [0, 1, 2, 3, 4, 6, 7] + list(range(8, 1024))
+    assert topology._links == None
+
+def test_constraints_of():
+    topology = distributed_hub_and_spoke(star(3), 2, 1)
+    constraints = topology.bandwidth_constraints()
+    assert topology.bandwidth_constraints() is constraints
+    for src in topology.nodes():
+        for dst in topology.nodes():
+            expected = [idx for idx, (srcs, dsts, _, _) in enumerate(constraints) if src in srcs and dst in dsts]
+            assert topology.constraints_of(src, dst) == expected
+    assert [constraints[idx][3] for idx in topology.constraints_of(0, 3)] == ['0→3', 'copy_0_out_remote', 'copy_1_in_remote']